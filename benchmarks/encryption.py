@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Measures the WebPush encryption throughput by amount of processes.
+
+For every amount of processes, encrypts a payload for random subscriptions the
+way webpush_send_bulk_message() does, with and without WP_SHARED_SERVER_KEY,
+and reports the subscriptions encrypted per second and the speedup over a
+single process. Nothing is sent.
+
+Usage: python benchmarks/encryption.py [--recipients 20000] [--processes 1,2,4,8]
+	[--batch-size 1000] [--payload-size 512]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+from timeit import default_timer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+settings.configure(INSTALLED_APPS=["django.contrib.auth", "django.contrib.contenttypes", "push_notifications"])
+django.setup()
+
+from cryptography.hazmat.backends import default_backend  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec  # noqa: E402
+from push_notifications.webpush import (  # noqa: E402
+	WebPushEncryptor, _b64url_encode, _encrypt_in_processes, _public_key_bytes
+)
+
+
+def generate_subscriptions(n):
+	return [(
+		"https://push.example.com/%i" % (i),
+		_b64url_encode(_public_key_bytes(ec.generate_private_key(ec.SECP256R1(), default_backend()).public_key())),
+		_b64url_encode(os.urandom(16)),
+	) for i in range(n)]
+
+
+def run(subscriptions, processes, batch_size, encryptor):
+	start = default_timer()
+	if processes > 1:
+		batches = [subscriptions[i:i + batch_size] for i in range(0, len(subscriptions), batch_size)]
+		for bodies in _encrypt_in_processes(encryptor, batches, processes):
+			pass
+	else:
+		for endpoint, p256dh, auth in subscriptions:
+			encryptor.encrypt(p256dh, auth)
+	return default_timer() - start
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+	parser.add_argument("--recipients", type=int, default=20000)
+	parser.add_argument(
+		"--processes", default=",".join(str(2 ** i) for i in range(8) if 2 ** i <= multiprocessing.cpu_count()),
+		help="Comma separated amounts of processes"
+	)
+	parser.add_argument("--batch-size", type=int, default=1000)
+	parser.add_argument("--payload-size", type=int, default=512)
+	args = parser.parse_args()
+
+	subscriptions = generate_subscriptions(args.recipients)
+	payload = b"x" * args.payload_size
+	print("%-10s %9s %10s %8s" % ("server key", "processes", "msgs/s", "speedup"))
+	for shared in (False, True):
+		server_key = ec.generate_private_key(ec.SECP256R1(), default_backend()) if shared else None
+		encryptor = WebPushEncryptor(payload, server_key)
+		base = None
+		for processes in [int(p) for p in args.processes.split(",")]:
+			elapsed = run(subscriptions, processes, args.batch_size, encryptor)
+			base = base or elapsed
+			print("%-10s %9i %10.0f %7.2fx" % (
+				"shared" if shared else "per-sub", processes, len(subscriptions) / elapsed, base / elapsed
+			))
+
+
+if __name__ == "__main__":
+	main()
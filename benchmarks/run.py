@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Measures the throughput of the querysets' send_message() against the local
+provider stand-ins of benchmarks/servers.py.
+
+For every scenario and amount of recipients, reports the messages sent per
+second, the failed deliveries, the p50/p99 latency of the provider requests
+(per GCM/FCM chunk, WNS request or APNS connection), the amount of database
+queries and the peak memory allocated while sending.
+
+Usage: python benchmarks/run.py [--recipients 1000,100000] [--latency 0.01]
+	[--error-rate 0.01] [--canonical-rate 0.1] [scenario ...]
+
+APNS is benchmarked over plain TCP: the binary protocol framing is measured,
+the TLS handshake and encryption are not.
+"""
+import argparse
+import gc
+import os
+import sys
+from timeit import default_timer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+settings.configure(
+	DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}},
+	INSTALLED_APPS=["django.contrib.auth", "django.contrib.contenttypes", "push_notifications"],
+)
+django.setup()
+
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+from push_notifications.models import APNSDevice, GCMDevice, WebPushDevice, WNSDevice  # noqa: E402
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS  # noqa: E402
+from push_notifications.webpush import _b64url_encode, _public_key_bytes  # noqa: E402
+from servers import FakeAPNSServer, FakeGCMServer, FakeWebPushServer, FakeWNSServer, PlainAPNSSocket  # noqa: E402
+
+try:
+	import tracemalloc
+except ImportError:
+	# Python 2 support
+	tracemalloc = None
+
+
+BATCH_SIZE = 10000
+
+
+def _create(model, n, registration_id, **kwargs):
+	for start in range(0, n, BATCH_SIZE):
+		model.objects.bulk_create(
+			model(registration_id=registration_id(i), **kwargs) for i in range(start, min(n, start + BATCH_SIZE))
+		)
+
+
+def gcm_scenario(n, servers, cloud_types=("GCM", )):
+	for i, cloud_type in enumerate(cloud_types):
+		count = n // len(cloud_types) + (1 if i < n % len(cloud_types) else 0)
+		_create(
+			GCMDevice, count, lambda j: "%s-%i-%s" % (cloud_type, j, "x" * 140), cloud_message_type=cloud_type
+		)
+	return lambda: GCMDevice.objects.all().send_message("Hello world", title="Benchmark")
+
+
+def fcm_scenario(n, servers):
+	return gcm_scenario(n, servers, ("FCM", ))
+
+
+def mixed_scenario(n, servers):
+	return gcm_scenario(n, servers, ("GCM", "FCM"))
+
+
+def canonical_scenario(n, servers):
+	servers["gcm"].canonical_rate = max(servers["gcm"].canonical_rate, 0.1)
+	return gcm_scenario(n, servers)
+
+
+def apns_scenario(n, servers):
+	import push_notifications.apns
+
+	_create(APNSDevice, n, lambda i: "%064x" % (i))
+	sockets = []
+
+	def connect(certfile=None):
+		sockets.append(PlainAPNSSocket(servers["apns"].address))
+		return sockets[-1]
+
+	def send():
+		result = APNSDevice.objects.all().send_message("Hello world", badge=1)
+		# The frames rejected by the server, whose identifier is their index in the broadcast
+		for sock in sockets:
+			for identifier, error in sock.failures:
+				result.add_failure(identifier, error)
+		return result
+
+	push_notifications.apns._apns_create_socket_to_push = connect
+	return send
+
+
+def wns_scenario(n, servers):
+	_create(WNSDevice, n, lambda i: "%s/%i" % (servers["wns"].url, i))
+	return lambda: WNSDevice.objects.all().send_message("Hello world")
+
+
+def webpush_scenario(n, servers):
+	from cryptography.hazmat.backends import default_backend
+	from cryptography.hazmat.primitives.asymmetric import ec
+
+	p256dh = _b64url_encode(_public_key_bytes(ec.generate_private_key(ec.SECP256R1(), default_backend()).public_key()))
+	_create(
+		WebPushDevice, n, lambda i: "%s/%i" % (servers["webpush"].url, i),
+		p256dh=p256dh, auth=_b64url_encode(b"0123456789abcdef")
+	)
+	return lambda: WebPushDevice.objects.all().send_message({"title": "Hello world"})
+
+
+SCENARIOS = (
+	("gcm", gcm_scenario),
+	("fcm", fcm_scenario),
+	("mixed", mixed_scenario),
+	("canonical", canonical_scenario),
+	("apns", apns_scenario),
+	("wns", wns_scenario),
+	("webpush", webpush_scenario),
+)
+
+
+def percentile(values, p):
+	if not values:
+		return 0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(name, scenario, n, servers):
+	for model in (GCMDevice, APNSDevice, WNSDevice, WebPushDevice):
+		model.objects.all().delete()
+	send = scenario(n, servers)
+	gc.collect()
+
+	if tracemalloc:
+		tracemalloc.start()
+	with CaptureQueriesContext(connection) as queries:
+		start = default_timer()
+		result = send()
+		elapsed = default_timer() - start
+	if tracemalloc:
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	else:
+		import resource
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+	timings = list(result.timings)
+	print("%-10s %9i %10.0f %8i %8.2f %8.2f %8i %8.1f" % (
+		name, n, result.total / elapsed, result.failure, percentile(timings, 0.5) * 1000,
+		percentile(timings, 0.99) * 1000, len(queries), peak / 1024.0 / 1024
+	))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+	parser.add_argument("scenarios", nargs="*", default=[name for name, scenario in SCENARIOS])
+	parser.add_argument("--recipients", default="1000", help="Comma separated amounts of recipients")
+	parser.add_argument("--latency", type=float, default=0, help="Seconds per provider request")
+	parser.add_argument("--error-rate", type=float, default=0)
+	parser.add_argument("--canonical-rate", type=float, default=0)
+	parser.add_argument("--wp-processes", type=int, default=0, help="WP_ENCRYPTION_PROCESSES of the webpush scenario")
+	parser.add_argument("--wp-shared-key", action="store_true", help="Enables WP_SHARED_SERVER_KEY")
+	args = parser.parse_args()
+
+	call_command("migrate", verbosity=0)
+	server_kwargs = {"latency": args.latency, "error_rate": args.error_rate}
+	servers = {
+		"gcm": FakeGCMServer(canonical_rate=args.canonical_rate, **server_kwargs).start(),
+		"apns": FakeAPNSServer(**server_kwargs).start(),
+		"wns": FakeWNSServer(**server_kwargs).start(),
+		"webpush": FakeWebPushServer(**server_kwargs).start(),
+	}
+	SETTINGS.update({
+		"GCM_API_KEY": "benchmark",
+		"FCM_API_KEY": "benchmark",
+		"GCM_POST_URL": servers["gcm"].url,
+		"FCM_POST_URL": servers["gcm"].url,
+		"WNS_PACKAGE_SECURITY_ID": "benchmark",
+		"WNS_SECRET_KEY": "benchmark",
+		"WNS_ACCESS_URL": servers["wns"].url + "/accesstoken.srf",
+		"APNS_ERROR_TIMEOUT": None,
+		"WP_PRIVATE_KEY": _b64url_encode(b"\x01" * 32),
+	})
+	if "webpush" in args.scenarios:
+		SETTINGS.update({"WP_ENCRYPTION_PROCESSES": args.wp_processes, "WP_SHARED_SERVER_KEY": args.wp_shared_key})
+
+	print("%-10s %9s %10s %8s %8s %8s %8s %8s" % (
+		"scenario", "recipients", "msgs/s", "failed", "p50 ms", "p99 ms", "queries", "peak MB"
+	))
+	scenarios = dict(SCENARIOS)
+	for name in args.scenarios:
+		for n in [int(n) for n in args.recipients.split(",")]:
+			run(name, scenarios[name], n, servers)
+
+	for server in servers.values():
+		server.stop()
+
+
+if __name__ == "__main__":
+	main()
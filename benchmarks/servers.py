@@ -0,0 +1,275 @@
+"""
+Local stand-ins for the GCM/FCM, WNS, WebPush and APNS servers, used by the benchmarks.
+
+Every server runs in a daemon thread on 127.0.0.1, sleeps `latency` seconds per
+request, and answers with random per-token errors at `error_rate`. The GCM/FCM
+server also returns canonical ids at `canonical_rate`.
+"""
+import json
+import random
+import socket
+import struct
+import threading
+import time
+
+from push_notifications.apns import APNS_ERROR_MESSAGES
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+except ImportError:
+	# Python 2 support
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+
+class FakeServer(object):
+	def __init__(self, latency=0, error_rate=0, error="NotRegistered", seed=0):
+		self.latency = latency
+		self.error_rate = error_rate
+		self.error = error
+		self.random = random.Random(seed)
+		self.requests = 0
+		self.bytes_received = 0
+		self._lock = threading.Lock()
+
+	def _count(self, length):
+		with self._lock:
+			self.requests += 1
+			self.bytes_received += length
+
+	def _wait(self):
+		if self.latency:
+			time.sleep(self.latency)
+
+	def start(self):
+		self.server = self.create_server()
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	@property
+	def address(self):
+		return self.server.server_address
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		self.server.fake._count(len(body))
+		self.server.fake._wait()
+		status, headers, data = self.server.fake.respond(self.path, body)
+		self.send_response(status)
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+
+class FakeHTTPServer(FakeServer):
+	def create_server(self):
+		server = ThreadingHTTPServer(("127.0.0.1", 0), _HTTPHandler)
+		server.fake = self
+		return server
+
+	@property
+	def url(self):
+		return "http://%s:%i" % self.address
+
+
+class FakeGCMServer(FakeHTTPServer):
+	"""
+	Answers GCM/FCM JSON requests.
+	"""
+
+	def __init__(self, canonical_rate=0, **kwargs):
+		super(FakeGCMServer, self).__init__(**kwargs)
+		self.canonical_rate = canonical_rate
+
+	def respond(self, path, body):
+		registration_ids = json.loads(body.decode("utf-8")).get("registration_ids", [])
+		results = []
+		with self._lock:
+			for i, registration_id in enumerate(registration_ids):
+				r = self.random.random()
+				if r < self.error_rate:
+					results.append({"error": self.error})
+				elif r < self.error_rate + self.canonical_rate:
+					results.append({"message_id": "0:%i" % (i), "registration_id": "%s-c" % (registration_id)})
+				else:
+					results.append({"message_id": "0:%i" % (i)})
+		response = {
+			"multicast_id": 1,
+			"success": sum(1 for result in results if "message_id" in result),
+			"failure": sum(1 for result in results if "error" in result),
+			"canonical_ids": sum(1 for result in results if "registration_id" in result),
+			"results": results,
+		}
+		return 200, {"Content-Type": "application/json"}, json.dumps(response).encode("utf-8")
+
+
+class FakeWNSServer(FakeHTTPServer):
+	"""
+	Answers WNS access token requests on /accesstoken.srf and notifications on
+	any other path, with an X-WNS-Status of "dropped" at error_rate.
+	"""
+
+	def respond(self, path, body):
+		if path == "/accesstoken.srf":
+			data = json.dumps({"access_token": "token", "token_type": "bearer", "expires_in": 86400})
+			return 200, {"Content-Type": "application/json"}, data.encode("utf-8")
+		with self._lock:
+			status = "dropped" if self.random.random() < self.error_rate else "received"
+		headers = {
+			"X-WNS-Status": status,
+			"X-WNS-Msg-ID": "1",
+			"X-WNS-DeviceConnectionStatus": "connected",
+		}
+		return 200, headers, b""
+
+
+class FakeWebPushServer(FakeHTTPServer):
+	"""
+	Answers WebPush requests, with 410 (expired subscription) at error_rate.
+	"""
+
+	def respond(self, path, body):
+		with self._lock:
+			status = 410 if self.random.random() < self.error_rate else 201
+		return status, {}, b""
+
+
+def _frame_identifier(frame):
+	offset = 0
+	while offset < len(frame):
+		item, length = struct.unpack("!BH", frame[offset:offset + 3])
+		if item == 3:
+			return struct.unpack("!I", frame[offset + 3:offset + 7])[0]
+		offset += 3 + length
+	return 0
+
+
+class FakeAPNSServer(FakeServer):
+	"""
+	Reads binary APNS frames over plain TCP. At error_rate, answers a frame with
+	an error response (status 8, invalid token) and closes the connection, as
+	APNS does. The latency is applied once per connection.
+	"""
+
+	def __init__(self, error=8, **kwargs):
+		super(FakeAPNSServer, self).__init__(error=error, **kwargs)
+
+	def start(self):
+		self.server = socket.socket()
+		self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.server.bind(("127.0.0.1", 0))
+		self.server.listen(64)
+		thread = threading.Thread(target=self._serve)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def stop(self):
+		self.server.close()
+
+	@property
+	def address(self):
+		return self.server.getsockname()
+
+	def _serve(self):
+		while True:
+			try:
+				conn, address = self.server.accept()
+			except (socket.error, OSError):
+				return
+			thread = threading.Thread(target=self._handle, args=(conn, ))
+			thread.daemon = True
+			thread.start()
+
+	def _recv(self, conn, length):
+		data = b""
+		while len(data) < length:
+			chunk = conn.recv(length - len(data))
+			if not chunk:
+				return None
+			data += chunk
+		return data
+
+	def _handle(self, conn):
+		self._wait()
+		try:
+			while True:
+				header = self._recv(conn, 5)
+				if header is None:
+					return
+				command, length = struct.unpack("!BI", header)
+				frame = self._recv(conn, length)
+				if frame is None:
+					return
+				self._count(length + 5)
+				with self._lock:
+					failed = self.random.random() < self.error_rate
+				if failed:
+					conn.sendall(struct.pack("!BBI", 8, self.error, _frame_identifier(frame)))
+					return
+		except (socket.error, OSError):
+			# The client reset the connection
+			return
+		finally:
+			conn.close()
+
+
+class PlainAPNSSocket(object):
+	"""
+	A plain TCP socket with the write() method of SSL sockets, to connect to
+	FakeAPNSServer without TLS.
+
+	When the server closed the connection after rejecting a frame, write()
+	reconnects and sends the frame again, as APNS clients do, and records the
+	(identifier, error) of the rejected frame in `failures`. If the error
+	response of the server was lost with the connection, the frame which could
+	not be written is recorded instead, with the error of the write.
+	"""
+
+	def __init__(self, address):
+		self.address = address
+		self.failures = []
+		self.sock = socket.create_connection(address)
+
+	def write(self, data):
+		try:
+			self.sock.sendall(data)
+		except (socket.error, OSError) as e:
+			self.failures.append(self._read_error() or (_frame_identifier(data[5:]), str(e)))
+			self.sock.close()
+			self.sock = socket.create_connection(self.address)
+			self.sock.sendall(data)
+
+	def _read_error(self):
+		try:
+			self.sock.settimeout(0.1)
+			data = self.sock.recv(6)
+		except (socket.error, OSError):
+			return None
+		if len(data) != 6:
+			return None
+		command, status, identifier = struct.unpack("!BBI", data)
+		return identifier, APNS_ERROR_MESSAGES.get(status, status)
+
+	def __getattr__(self, name):
+		return getattr(self.sock, name)
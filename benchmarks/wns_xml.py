@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Compares the streaming WNS XML serializer and compiled templates against
+the ElementTree serializer.
+
+Usage: python benchmarks/wns_xml.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from django.conf import settings  # noqa: E402
+settings.configure()
+
+import xml.etree.ElementTree as ET  # noqa: E402
+from push_notifications.wns import WNSTemplate, dict_to_xml_schema, dict_to_xml_string  # noqa: E402
+
+
+XML_DATA = {
+	"toast": {
+		"attrs": {"launch": "action=view&id=1234", "duration": "long"},
+		"children": {
+			"visual": {
+				"children": {
+					"binding": {
+						"attrs": {"template": "ToastImageAndText04"},
+						"children": {
+							"text": [
+								{"attrs": {"id": "1"}, "children": "Hello {name} <3"},
+								{"attrs": {"id": "2"}, "children": "Your order #1234 has shipped"},
+								{"attrs": {"id": "3"}, "children": "Fish & Chips, delivered"},
+							],
+							"image": [
+								{"attrs": {"id": "1", "src": "ms-appx:///images/order.png"}},
+							],
+						},
+					},
+				},
+			},
+			"audio": {"attrs": {"src": "ms-winsoundevent:Notification.Default"}},
+		},
+	},
+}
+
+
+def main():
+	iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	assert dict_to_xml_string(XML_DATA) == ET.tostring(dict_to_xml_schema(XML_DATA))
+
+	template = WNSTemplate(XML_DATA)
+	context = {"name": "Jane"}
+	results = (
+		("ElementTree", lambda: ET.tostring(dict_to_xml_schema(XML_DATA))),
+		("streaming", lambda: dict_to_xml_string(XML_DATA)),
+		("template", lambda: template.render(context)),
+	)
+	baseline = None
+	for name, func in results:
+		elapsed = min(timeit.repeat(func, number=iterations, repeat=3))
+		baseline = baseline or elapsed
+		print("%-12s %8.2f us/op  %5.2fx" % (name, elapsed / iterations * 1e6, baseline / elapsed))
+
+
+if __name__ == "__main__":
+	main()
@@ -1,48 +1,132 @@
 from django.apps import apps
 from django.contrib import admin, messages
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 from .gcm import GCMError
 from .apns import APNSServerError, APNS_ERROR_MESSAGES
-from .models import APNSDevice, GCMDevice, WNSDevice, get_expired_tokens
+from .webpush import WebPushError
+from .wns import WNSError
+from .models import APNSDevice, GCMDevice, WebPushDevice, WNSDevice, deactivate_devices, get_expired_tokens
+from .pipeline import enqueue_prune
+from .probe import prune_probed_devices
 from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 
 User = apps.get_model(*SETTINGS["USER_MODEL"].split("."))
 
 
+class EstimatedCountPaginator(Paginator):
+	"""
+	Counts the unfiltered changelist of a large table on PostgreSQL from the
+	planner's statistics (pg_class.reltuples), rather than with a COUNT(*)
+	reading every row. Filtered changelists, tables smaller than
+	`min_estimated_count` rows and other databases are counted exactly.
+	"""
+	min_estimated_count = 100000
+
+	@cached_property
+	def count(self):
+		queryset = self.object_list
+		if hasattr(queryset, "query") and not queryset.query.where:
+			connection = connections[queryset.db]
+			if connection.vendor == "postgresql":
+				with connection.cursor() as cursor:
+					cursor.execute(
+						"SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+						[connection.ops.quote_name(queryset.model._meta.db_table)]
+					)
+					row = cursor.fetchone()
+				if row and row[0] >= self.min_estimated_count:
+					return int(row[0])
+		return super(EstimatedCountPaginator, self).count
+
+
 class DeviceAdmin(admin.ModelAdmin):
 	list_display = ("__str__", "device_id", "user", "active", "date_created")
 	list_filter = ("active",)
+	list_select_related = ("user",)
 	actions = ("send_message", "send_bulk_message", "prune_devices", "enable", "disable")
 	raw_id_fields = ("user",)
+	paginator = EstimatedCountPaginator
+	# Filtered changelists don't count the whole table a second time
+	show_full_result_count = False
+	# Larger selections are sent a single message with the queryset's send_message()
+	max_single_sends = 10
+	# Larger selections are only sent through the asynchronous pipeline
+	max_sync_sends = 1000
 
+	# Searched by exact match, see get_search_results()
 	if hasattr(User, "USERNAME_FIELD"):
-		search_fields = ("name", "device_id", "user__%s" % (User.USERNAME_FIELD))
+		search_fields = ("registration_id", "device_id", "user__%s" % (User.USERNAME_FIELD))
 	else:
-		search_fields = ("name", "device_id")
+		search_fields = ("registration_id", "device_id")
+
+	def get_search_results(self, request, queryset, search_term):
+		"""
+		Finds the devices whose registration id, device id or user's username is
+		exactly the search term. Unlike the default substring search, each of
+		these lookups is done on an index (registration ids on their digest,
+		see RegistrationIDField), so that large tables are never scanned.
+		"""
+		search_term = search_term.strip()
+		if not search_term:
+			return queryset, False
+
+		q = Q(registration_id=search_term)
+		try:
+			q |= Q(device_id=self.model._meta.get_field("device_id").clean(search_term, None))
+		except (ValueError, ValidationError):
+			pass
+		if hasattr(User, "USERNAME_FIELD"):
+			# Looked up beforehand rather than joined, so that every condition is indexed
+			user_ids = list(
+				User._default_manager.filter(**{User.USERNAME_FIELD: search_term}).values_list("pk", flat=True)
+			)
+			if user_ids:
+				q |= Q(user_id__in=user_ids)
+		return queryset.filter(q), False
 
 	def send_messages(self, request, queryset, bulk=False):
 		"""
 		Provides error handling for DeviceAdmin send_message and send_bulk_message methods.
+
+		Up to `max_single_sends` selected devices are sent a message each by
+		send_message. Larger selections, and send_bulk_message, go through the
+		queryset's send_message(): enqueued to the asynchronous pipeline when
+		QUEUE_BROKER is set, or sent within the request up to `max_sync_sends`
+		devices and refused beyond, so that the admin doesn't tie up a worker for long.
 		"""
+		message = "Test bulk notification" if bulk else "Test single notification"
+		if SETTINGS["QUEUE_BROKER"] is not None:
+			job_id = queryset.send_message(message)
+			self.message_user(request, _("The message was enqueued as job %s, push_worker sends it.") % (job_id))
+			return
+
+		count = queryset.count()
+		if count > self.max_sync_sends:
+			self.message_user(request, _(
+				"%d devices are selected: sending to more than %d devices requires the asynchronous pipeline "
+				"(QUEUE_BROKER)."
+			) % (count, self.max_sync_sends), level=messages.ERROR)
+			return
+
 		ret = []
 		errors = []
-		r = ""
-
-		for device in queryset:
+		bulk = bulk or count > self.max_single_sends
+		for target in [queryset] if bulk else queryset:
 			try:
-				if bulk:
-					r = queryset.send_message("Test bulk notification")
-				else:
-					r = device.send_message("Test single notification")
+				r = target.send_message(message)
 				if r:
-					ret.append(r)
+					ret.append(str(r))
 			except GCMError as e:
 				errors.append(str(e))
 			except APNSServerError as e:
 				errors.append(APNS_ERROR_MESSAGES[e.status])
-
-			if bulk:
-				break
+			except (WebPushError, WNSError) as e:
+				errors.append(str(e))
 
 		if errors:
 			self.message_user(
@@ -50,8 +134,7 @@ class DeviceAdmin(admin.ModelAdmin):
 				level=messages.ERROR
 			)
 		if ret:
-			if not bulk:
-				ret = ", ".join(ret)
+			ret = ", ".join(ret)
 			if errors:
 				msg = _("Some messages were sent: %s" % (ret))
 			else:
@@ -78,27 +161,99 @@ class DeviceAdmin(admin.ModelAdmin):
 
 	disable.short_description = _("Disable selected devices")
 
-	def prune_devices(self, request, queryset):
+	def get_dead_registration_ids(self, queryset):
+		"""
+		Returns the [(sender, queryset, registration ids)] of the selected
+		devices which don't receive notifications anymore.
+		"""
 		# Note that when get_expired_tokens() is called, Apple's
 		# feedback service resets, so, calling it again won't return
 		# the device again (unless a message is sent to it again).  So,
 		# if the user doesn't select all the devices for pruning, we
 		# could very easily leave an expired device as active.  Maybe
 		#  this is just a bad API.
-		expired = get_expired_tokens()
-		devices = queryset.filter(registration_id__in=expired)
-		for d in devices:
-			d.active = False
-			d.save()
+		return [("APNS", queryset, get_expired_tokens())]
+
+	def prune_devices(self, request, queryset):
+		total = 0
+		for sender, devices, registration_ids in self.get_dead_registration_ids(queryset):
+			for deactivated in deactivate_devices(devices, registration_ids, sender):
+				total += len(deactivated)
+		self.message_user(request, _("%d devices were deactivated.") % (total))
 
+	prune_devices.short_description = _("Prune devices")
 
-class GCMDeviceAdmin(DeviceAdmin):
+
+class ProbedDeviceAdmin(DeviceAdmin):
+	"""
+	Prunes the devices by probing them, see probe.py. The probes are enqueued to
+	the asynchronous pipeline when QUEUE_BROKER is set, push_worker reports the
+	progress. Otherwise up to `max_sync_probes` active devices are probed within
+	the request, and larger selections are left to the prune_devices command.
+	"""
+	max_sync_probes = 100
+
+	def get_probe_options(self):
+		"""
+		Returns the keyword arguments of probe.prune_probed_devices().
+		"""
+		return {}
+
+	def prune_devices(self, request, queryset):
+		options = self.get_probe_options()
+		if SETTINGS["QUEUE_BROKER"] is not None:
+			job_id = enqueue_prune(queryset, **options)
+			self.message_user(request, _(
+				"Pruning was enqueued as job %s, push_worker probes the devices and reports the progress."
+			) % (job_id))
+			return
+
+		count = queryset.filter(active=True).count()
+		if count > self.max_sync_probes:
+			self.message_user(request, _(
+				"%d devices are selected: probing more than %d devices requires the asynchronous pipeline "
+				"(QUEUE_BROKER) or the prune_devices command."
+			) % (count, self.max_sync_probes), level=messages.ERROR)
+			return
+
+		deactivated, errors = prune_probed_devices(queryset, **options)
+		if errors:
+			self.message_user(request, _("%d probes failed: %s") % (
+				len(errors), ", ".join(sorted(set(repr(error) for error in errors)))
+			), level=messages.ERROR)
+		self.message_user(request, _("%d devices were deactivated.") % (deactivated))
+
+	prune_devices.short_description = _("Prune devices")
+
+
+class GCMDeviceAdmin(ProbedDeviceAdmin):
 	list_display = (
 		"__str__", "device_id", "user", "active", "date_created", "cloud_message_type"
 	)
 	list_filter = ("active", "cloud_message_type")
 
 
+class WNSDeviceAdmin(ProbedDeviceAdmin):
+	# The probes are raw notifications, which wake up the apps handling them:
+	# the "prune devices" action is only offered once this is set to True.
+	wns_raw_probes = False
+
+	def get_actions(self, request):
+		actions = super(WNSDeviceAdmin, self).get_actions(request)
+		if not self.wns_raw_probes:
+			actions.pop("prune_devices", None)
+		return actions
+
+	def get_probe_options(self):
+		return {"wns_raw_probes": self.wns_raw_probes}
+
+
+class WebPushDeviceAdmin(DeviceAdmin):
+	# Expired subscriptions are deactivated when they are sent to
+	actions = ("send_message", "send_bulk_message", "enable", "disable")
+
+
 admin.site.register(APNSDevice, DeviceAdmin)
 admin.site.register(GCMDevice, GCMDeviceAdmin)
-admin.site.register(WNSDevice, DeviceAdmin)
+admin.site.register(WNSDevice, WNSDeviceAdmin)
+admin.site.register(WebPushDevice, WebPushDeviceAdmin)
@@ -1,13 +1,24 @@
 from __future__ import absolute_import
 
+from collections import OrderedDict, defaultdict
+
 from rest_framework import permissions
 from rest_framework.response import Response
-from rest_framework.serializers import Serializer, ModelSerializer, ValidationError
+from rest_framework.serializers import Serializer, ListSerializer, ModelSerializer, ValidationError
 from rest_framework import status
+from rest_framework.validators import UniqueValidator
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.fields import IntegerField
 
-from push_notifications.models import APNSDevice, GCMDevice, WNSDevice
+try:
+	from rest_framework.decorators import action
+	bulk_route = action(detail=False, methods=["post"], url_path="bulk")
+except ImportError:
+	# DRF < 3.8
+	from rest_framework.decorators import list_route
+	bulk_route = list_route(methods=["post"], url_path="bulk")
+
+from push_notifications.models import APNSDevice, GCMDevice, WebPushDevice, WNSDevice
 from push_notifications.fields import hex_re
 from push_notifications.fields import UNSIGNED_64BIT_INT_MAX_VALUE
 from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
@@ -35,16 +46,109 @@ class HexIntegerField(IntegerField):
 
 
 # Serializers
+class DeviceListSerializer(ListSerializer):
+	"""
+	Creates many devices at once. Existing registration ids are looked up for
+	the whole list in a few queries instead of once per device, then the devices
+	are written with bulk inserts and updates.
+
+	Existing devices are updated when UPDATE_ON_DUPLICATE_REG_ID is set,
+	otherwise they are reported as validation errors.
+	"""
+	batch_size = 500
+
+	def _get_existing(self, registration_ids):
+		Device = self.child.Meta.model
+		existing = {}
+		for i in range(0, len(registration_ids), self.batch_size):
+			chunk = registration_ids[i:i + self.batch_size]
+			for device in Device.objects.filter(registration_id__in=chunk):
+				existing[device.registration_id] = device
+		return existing
+
+	def validate(self, attrs):
+		if not SETTINGS.get("UPDATE_ON_DUPLICATE_REG_ID"):
+			registration_ids = [item["registration_id"] for item in attrs]
+			duplicates = self._get_existing(registration_ids)
+			if len(set(registration_ids)) != len(registration_ids) or duplicates:
+				raise ValidationError({"registration_id": "This field must be unique."})
+		return attrs
+
+	def create(self, validated_data):
+		Device = self.child.Meta.model
+
+		# The last occurrence of a registration id wins
+		devices = OrderedDict()
+		for item in validated_data:
+			item.pop("id", None)
+			devices[item["registration_id"]] = item
+
+		existing = {}
+		if SETTINGS.get("UPDATE_ON_DUPLICATE_REG_ID"):
+			existing = self._get_existing(list(devices.keys()))
+
+		self.created, self.updated = [], []
+		update_fields = set()
+		for registration_id, item in devices.items():
+			device = existing.get(registration_id)
+			if device is None:
+				self.created.append(Device(**item))
+			else:
+				for attr, value in item.items():
+					setattr(device, attr, value)
+				update_fields.update(item.keys())
+				self.updated.append(device)
+
+		Device.objects.bulk_create(self.created, batch_size=self.batch_size)
+		if self.updated:
+			_bulk_update(Device, self.updated, update_fields, self.batch_size)
+
+		return self.created + self.updated
+
+
+def _bulk_update(Device, devices, field_names, batch_size):
+	fields = [Device._meta.get_field(name) for name in field_names if name != "registration_id"]
+	if hasattr(Device.objects, "bulk_update"):
+		Device.objects.bulk_update(devices, [field.name for field in fields], batch_size=batch_size)
+		return
+
+	# Django < 2.2: one UPDATE per distinct set of values
+	groups = defaultdict(list)
+	for device in devices:
+		values = tuple(getattr(device, field.attname) for field in fields)
+		groups[values].append(device.pk)
+	for values, pks in groups.items():
+		update = dict(zip((field.attname for field in fields), values))
+		for i in range(0, len(pks), batch_size):
+			Device.objects.filter(pk__in=pks[i:i + batch_size]).update(**update)
+
+
+class BulkDeviceSerializerMixin(Serializer):
+	@property
+	def skip_unique_registration(self):
+		# Uniqueness is checked once for the whole list by DeviceListSerializer,
+		# or enforced by the database when registering with DeviceManager.register()
+		return isinstance(self.parent, DeviceListSerializer) or self.context.get("register", False)
+
+	def get_fields(self):
+		fields = super(BulkDeviceSerializerMixin, self).get_fields()
+		if self.skip_unique_registration:
+			field = fields["registration_id"]
+			field.validators = [v for v in field.validators if not isinstance(v, UniqueValidator)]
+		return fields
+
+
 class DeviceSerializerMixin(ModelSerializer):
 	class Meta:
 		fields = ("id", "name", "registration_id", "device_id", "active", "date_created")
 		read_only_fields = ("date_created",)
+		list_serializer_class = DeviceListSerializer
 
 		# See https://github.com/tomchristie/django-rest-framework/issues/1101
 		extra_kwargs = {"active": {"default": True}}
 
 
-class APNSDeviceSerializer(ModelSerializer):
+class APNSDeviceSerializer(BulkDeviceSerializerMixin, ModelSerializer):
 	class Meta(DeviceSerializerMixin.Meta):
 		model = APNSDevice
 
@@ -60,6 +164,9 @@ class APNSDeviceSerializer(ModelSerializer):
 
 class UniqueRegistrationSerializerMixin(Serializer):
 	def validate(self, attrs):
+		if getattr(self, "skip_unique_registration", False):
+			return attrs
+
 		devices = None
 		primary_key = None
 		request_method = None
@@ -89,7 +196,7 @@ class UniqueRegistrationSerializerMixin(Serializer):
 		return attrs
 
 
-class GCMDeviceSerializer(UniqueRegistrationSerializerMixin, ModelSerializer):
+class GCMDeviceSerializer(UniqueRegistrationSerializerMixin, BulkDeviceSerializerMixin, ModelSerializer):
 	device_id = HexIntegerField(
 		help_text="ANDROID_ID / TelephonyManager.getDeviceId() (e.g: 0x01)",
 		style={"input_type": "text"},
@@ -112,11 +219,19 @@ class GCMDeviceSerializer(UniqueRegistrationSerializerMixin, ModelSerializer):
 		return value
 
 
-class WNSDeviceSerializer(UniqueRegistrationSerializerMixin, ModelSerializer):
+class WNSDeviceSerializer(UniqueRegistrationSerializerMixin, BulkDeviceSerializerMixin, ModelSerializer):
 	class Meta(DeviceSerializerMixin.Meta):
 		model = WNSDevice
 
 
+class WebPushDeviceSerializer(UniqueRegistrationSerializerMixin, BulkDeviceSerializerMixin, ModelSerializer):
+	class Meta(DeviceSerializerMixin.Meta):
+		model = WebPushDevice
+		fields = (
+			"id", "name", "registration_id", "device_id", "active", "date_created", "p256dh", "auth",
+		)
+
+
 # Permissions
 class IsOwner(permissions.BasePermission):
 	def has_object_permission(self, request, view, obj):
@@ -129,26 +244,52 @@ class DeviceViewSetMixin(object):
 	lookup_field = "registration_id"
 
 	def create(self, request, *args, **kwargs):
-		serializer = None
-		is_update = False
-		if SETTINGS.get('UPDATE_ON_DUPLICATE_REG_ID') and 'registration_id' in request.data:
-			instance = self.queryset.model.objects.filter(
-				registration_id=request.data['registration_id']
-			).first()
-			if instance:
-				serializer = self.get_serializer(instance, data=request.data)
-				is_update = True
-		if not serializer:
-			serializer = self.get_serializer(data=request.data)
+		if SETTINGS.get("UPDATE_ON_DUPLICATE_REG_ID") and "registration_id" in request.data:
+			return self.register(request)
 
+		serializer = self.get_serializer(data=request.data)
 		serializer.is_valid(raise_exception=True)
-		if is_update:
-			self.perform_update(serializer)
-			return Response(serializer.data)
-		else:
-			self.perform_create(serializer)
+		self.perform_create(serializer)
+		headers = self.get_success_headers(serializer.data)
+		return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+	def register(self, request):
+		"""
+		Creates the device or updates the one with the same registration id
+		with a single upsert, see DeviceManager.register().
+		"""
+		context = self.get_serializer_context()
+		context["register"] = True
+		serializer = self.get_serializer_class()(data=request.data, context=context)
+		serializer.is_valid(raise_exception=True)
+
+		data = dict(serializer.validated_data)
+		data.pop("id", None)
+		if self.request.user.is_authenticated():
+			data["user"] = self.request.user
+		serializer.instance, created = self.queryset.model.objects.register(**data)
+
+		if created:
 			headers = self.get_success_headers(serializer.data)
 			return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+		return Response(serializer.data)
+
+	@bulk_route
+	def bulk(self, request, *args, **kwargs):
+		"""
+		Registers a list of devices in a handful of queries.
+		Existing registration ids are updated if UPDATE_ON_DUPLICATE_REG_ID is set.
+		"""
+		serializer = self.get_serializer(data=request.data, many=True)
+		serializer.is_valid(raise_exception=True)
+		if self.request.user.is_authenticated():
+			serializer.save(user=self.request.user)
+		else:
+			serializer.save()
+		return Response(
+			{"created": len(serializer.created), "updated": len(serializer.updated)},
+			status=status.HTTP_201_CREATED if serializer.created else status.HTTP_200_OK
+		)
 
 	def perform_create(self, serializer):
 		if self.request.user.is_authenticated():
@@ -195,3 +336,12 @@ class WNSDeviceViewSet(DeviceViewSetMixin, ModelViewSet):
 
 class WNSDeviceAuthorizedViewSet(AuthorizedMixin, WNSDeviceViewSet):
 	pass
+
+
+class WebPushDeviceViewSet(DeviceViewSetMixin, ModelViewSet):
+	queryset = WebPushDevice.objects.all()
+	serializer_class = WebPushDeviceSerializer
+
+
+class WebPushDeviceAuthorizedViewSet(AuthorizedMixin, WebPushDeviceViewSet):
+	pass
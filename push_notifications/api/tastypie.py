@@ -3,7 +3,7 @@ from __future__ import absolute_import
 from tastypie.authorization import Authorization
 from tastypie.authentication import BasicAuthentication
 from tastypie.resources import ModelResource
-from push_notifications.models import APNSDevice, GCMDevice, WNSDevice
+from push_notifications.models import APNSDevice, GCMDevice, WebPushDevice, WNSDevice
 
 
 class APNSDeviceResource(ModelResource):
@@ -27,6 +27,13 @@ class WNSDeviceResource(ModelResource):
 		resource_name = "device/wns"
 
 
+class WebPushDeviceResource(ModelResource):
+	class Meta:
+		authorization = Authorization()
+		queryset = WebPushDevice.objects.all()
+		resource_name = "device/webpush"
+
+
 class APNSDeviceAuthenticatedResource(APNSDeviceResource):
 	# user = ForeignKey(UserResource, "user")
 
@@ -61,3 +68,15 @@ class WNSDeviceAuthenticatedResource(WNSDeviceResource):
 	def obj_create(self, bundle, **kwargs):
 		# See https://github.com/toastdriven/django-tastypie/issues/854
 		return super(WNSDeviceAuthenticatedResource, self).obj_create(bundle, user=bundle.request.user, **kwargs)
+
+
+class WebPushDeviceAuthenticatedResource(WebPushDeviceResource):
+	# user = ForeignKey(UserResource, "user")
+
+	class Meta(WebPushDeviceResource.Meta):
+		authentication = BasicAuthentication()
+	# authorization = SameUserAuthorization()
+
+	def obj_create(self, bundle, **kwargs):
+		# See https://github.com/toastdriven/django-tastypie/issues/854
+		return super(WebPushDeviceAuthenticatedResource, self).obj_create(bundle, user=bundle.request.user, **kwargs)
@@ -11,10 +11,13 @@ import struct
 import socket
 import time
 from contextlib import closing
+from timeit import default_timer
 from binascii import unhexlify
 from django.core.exceptions import ImproperlyConfigured
 from . import NotificationError
+from .ratelimit import throttle
 from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from .signals import connection_opened, request_finished, request_started
 
 
 APNS_ERROR_MESSAGES = {
@@ -84,6 +87,7 @@ def _apns_create_socket(address_tuple, certfile=None):
 	sock = socket.socket()
 	sock = ssl.wrap_socket(sock, ssl_version=ssl.PROTOCOL_TLSv1, certfile=certfile, ca_certs=ca_certs)
 	sock.connect(address_tuple)
+	connection_opened.send(sender="APNS", reused=False)
 
 	return sock
 
@@ -192,17 +196,30 @@ def _apns_send(
 	expiration_time = expiration if expiration is not None else int(time.time()) + 2592000
 
 	frame = _apns_pack_frame(token, json_data, identifier, expiration_time, priority)
+	throttle("APNS", certfile or SETTINGS.get("APNS_CERTIFICATE"))
 
 	if socket:
-		socket.write(frame)
+		connection_opened.send(sender="APNS", reused=True)
+		_apns_write(socket, frame)
 	else:
 		with closing(_apns_create_socket_to_push(certfile)) as socket:
-			socket.write(frame)
+			_apns_write(socket, frame)
 			_apns_check_errors(socket)
 
 	return token
 
 
+def _apns_write(sock, frame):
+	request_started.send(sender="APNS", url=None, bytes_sent=len(frame))
+	start = default_timer()
+	try:
+		sock.write(frame)
+	except Exception as e:
+		request_finished.send(sender="APNS", url=None, elapsed=default_timer() - start, error=e)
+		raise
+	request_finished.send(sender="APNS", url=None, elapsed=default_timer() - start, error=None)
+
+
 def _apns_read_and_unpack(socket, data_format):
 	length = struct.calcsize(data_format)
 	data = socket.recv(length)
@@ -0,0 +1,192 @@
+"""
+Micro-batching of single GCM/FCM sends.
+
+Transactional notifications are usually sent one device at a time, with
+GCMDevice.send_message(), which costs one HTTP request per notification. When
+CM_BATCH_WINDOW is set, the single sends of the same message (same cloud type,
+payloads and options) made concurrently, e.g. by the threads of a web server
+or of a task worker, are collected for up to CM_BATCH_WINDOW seconds or
+CM_BATCH_SIZE recipients, and sent as one multicast JSON request. Each caller
+waits for its own result in the response.
+
+Batching delays every single send by up to CM_BATCH_WINDOW, and the result of
+a batched send is its entry of the JSON response (e.g. {"message_id": "..."})
+rather than the plain text response of an unbatched send.
+"""
+
+import json
+import threading
+from django.db import connections
+
+from . import NotificationError
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+
+class PendingSend(object):
+	"""
+	The result of a batched send, available once its batch is sent.
+	"""
+
+	def __init__(self):
+		self._done = threading.Event()
+		self._result = None
+		self._error = None
+
+	def done(self):
+		return self._done.is_set()
+
+	def set_result(self, result):
+		self._result = result
+		self._done.set()
+
+	def set_exception(self, error):
+		self._error = error
+		self._done.set()
+
+	def result(self, timeout=None):
+		"""
+		Waits for the batch to be sent.
+
+		:return: The result of the registration id in the response, e.g. {"message_id": "..."}
+		Raises GCMError when the server returned an error other than
+		NotRegistered or InvalidRegistration, or the exception raised by the request.
+		"""
+		if not self._done.wait(timeout):
+			raise NotificationError("The batch was not sent within %s seconds" % (timeout))
+		if self._error is not None:
+			raise self._error
+		return self._result
+
+
+class _Batch(object):
+	def __init__(self, key, cloud_type, data_payload, notification_payload, kwargs):
+		self.key = key
+		self.cloud_type = cloud_type
+		self.data_payload = data_payload
+		self.notification_payload = notification_payload
+		self.kwargs = kwargs
+		self.registration_ids = []
+		self.pending = []
+		self.timer = None
+
+
+class MicroBatcher(object):
+	"""
+	Collects the single sends of identical messages, and sends each batch once
+	`window` seconds passed since its first send, or once it holds `max_size`
+	registration ids (at most GCM/FCM_MAX_RECIPIENTS).
+	"""
+
+	def __init__(self, window, max_size):
+		self.window = window
+		self.max_size = max_size
+		self._batches = {}
+		self._lock = threading.Lock()
+
+	def _make_key(self, cloud_type, data_payload, notification_payload, kwargs):
+		return (cloud_type, json.dumps(
+			[data_payload, notification_payload, kwargs], separators=(",", ":"), sort_keys=True
+		))
+
+	def submit(self, registration_id, data_payload, notification_payload, cloud_type, **kwargs):
+		"""
+		Adds the registration id to the batch of the message.
+
+		:return: PendingSend
+		"""
+		key = self._make_key(cloud_type, data_payload, notification_payload, kwargs)
+		max_size = min(self.max_size, SETTINGS["%s_MAX_RECIPIENTS" % (cloud_type)])
+		pending = PendingSend()
+		full = None
+		with self._lock:
+			batch = self._batches.get(key)
+			if batch is None:
+				batch = self._batches[key] = _Batch(key, cloud_type, data_payload, notification_payload, kwargs)
+				batch.timer = threading.Timer(self.window, self._flush_on_timer, (batch,))
+				batch.timer.daemon = True
+				batch.timer.start()
+			batch.registration_ids.append(registration_id)
+			batch.pending.append(pending)
+			if len(batch.registration_ids) >= max_size:
+				full = self._pop(batch)
+		if full is not None:
+			full.timer.cancel()
+			self._send(full)
+		return pending
+
+	def flush(self):
+		"""
+		Sends every pending batch now.
+		"""
+		with self._lock:
+			batches = [self._pop(batch) for batch in list(self._batches.values())]
+		for batch in batches:
+			batch.timer.cancel()
+			self._send(batch)
+
+	def _pop(self, batch):
+		# Called with the lock held. Returns None when the batch was already taken.
+		if self._batches.get(batch.key) is not batch:
+			return None
+		del self._batches[batch.key]
+		return batch
+
+	def _flush_on_timer(self, batch):
+		with self._lock:
+			batch = self._pop(batch)
+		if batch is not None:
+			try:
+				self._send(batch)
+			finally:
+				# Deactivated devices and canonical ids are saved from the timer's thread
+				connections.close_all()
+
+	def _send(self, batch):
+		from .gcm import GCMError, _cm_send_json
+
+		errors = []
+
+		def on_error(registration_id, error):
+			if isinstance(error, Exception):
+				errors.append(error)
+
+		try:
+			response = _cm_send_json(
+				batch.registration_ids, batch.data_payload, batch.notification_payload,
+				cloud_type=batch.cloud_type, on_error=on_error, **batch.kwargs
+			)
+			if errors:
+				raise errors[0]
+			for pending, result in zip(batch.pending, response["results"]):
+				error = result.get("error")
+				if error and error not in ("NotRegistered", "InvalidRegistration"):
+					pending.set_exception(GCMError(result))
+				else:
+					pending.set_result(result)
+		except Exception as e:
+			for pending in batch.pending:
+				if not pending.done():
+					pending.set_exception(e)
+		finally:
+			for pending in batch.pending:
+				if not pending.done():
+					pending.set_exception(NotificationError("The batch was not sent"))
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher():
+	"""
+	Returns the MicroBatcher of the process, or None when CM_BATCH_WINDOW isn't set.
+	"""
+	global _batcher
+	if not SETTINGS["CM_BATCH_WINDOW"]:
+		return None
+	with _batcher_lock:
+		if _batcher is None or (_batcher.window, _batcher.max_size) != (
+			SETTINGS["CM_BATCH_WINDOW"], SETTINGS["CM_BATCH_SIZE"]
+		):
+			_batcher = MicroBatcher(SETTINGS["CM_BATCH_WINDOW"], SETTINGS["CM_BATCH_SIZE"])
+		return _batcher
@@ -0,0 +1,142 @@
+"""
+Deduplication of bulk sends.
+
+send_message() called on a queryset with a `dedup_key` (e.g. a campaign id or
+the collapse key) skips the devices the same dedup_key was sent to within the
+last DEDUP_TTL seconds, so retried triggers don't send duplicate notifications.
+Sends are recorded in the Django cache named by DEDUP_CACHE, or in an
+in-process LRUCache of DEDUP_MAX_SIZE entries when it is None.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import time
+from django.core.cache import caches
+
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+
+class LRUCache(object):
+	"""
+	A thread-safe in-memory cache with expiring keys, evicting the least recently
+	used keys past `max_size`. Implements add() and the bulk methods of Django's
+	cache API.
+	"""
+
+	def __init__(self, max_size=100000):
+		self.max_size = max_size
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._data)
+
+	def get_many(self, keys):
+		now = time()
+		ret = {}
+		with self._lock:
+			for key in keys:
+				item = self._data.pop(key, None)
+				if item is not None and item[1] > now:
+					# Move the key to the end, as the most recently used
+					self._data[key] = item
+					ret[key] = item[0]
+		return ret
+
+	def add(self, key, value, timeout=None):
+		"""
+		Sets the key unless it is already set and not expired.
+
+		:return: bool: Whether the key was set
+		"""
+		now = time()
+		with self._lock:
+			item = self._data.get(key)
+			if item is not None and item[1] > now:
+				return False
+			self._data.pop(key, None)
+			self._data[key] = (value, now + timeout if timeout is not None else float("inf"))
+			while len(self._data) > self.max_size:
+				self._data.popitem(last=False)
+		return True
+
+	def set_many(self, data, timeout=None):
+		expires = time() + timeout if timeout is not None else float("inf")
+		with self._lock:
+			for key, value in data.items():
+				self._data.pop(key, None)
+				self._data[key] = (value, expires)
+			while len(self._data) > self.max_size:
+				self._data.popitem(last=False)
+		return []
+
+	def delete_many(self, keys):
+		with self._lock:
+			for key in keys:
+				self._data.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+
+_local_cache = None
+
+
+def get_cache():
+	global _local_cache
+	if SETTINGS["DEDUP_CACHE"] is not None:
+		return caches[SETTINGS["DEDUP_CACHE"]]
+	if _local_cache is None:
+		_local_cache = LRUCache(SETTINGS["DEDUP_MAX_SIZE"])
+	return _local_cache
+
+
+def _make_key(dedup_key, registration_id):
+	# Registration ids can be too long for memcached keys
+	digest = hashlib.sha1(("%s\0%s" % (dedup_key, registration_id)).encode("utf-8")).hexdigest()
+	return "push_notifications:dedup:%s" % (digest)
+
+
+def claim(dedup_key, registration_ids):
+	"""
+	Returns the registration ids the dedup_key wasn't sent to yet, and records
+	them as sent. The ones already sent are filtered with one get_many(), and the
+	others recorded with an atomic cache.add() each, so concurrent claims of the
+	same registration id return it only once. A retried send then costs one
+	cache round trip per chunk.
+	"""
+	cache = get_cache()
+	keys = [_make_key(dedup_key, registration_id) for registration_id in registration_ids]
+	sent = cache.get_many(keys)
+	return [
+		registration_id for key, registration_id in zip(keys, registration_ids)
+		if key not in sent and cache.add(key, 1, SETTINGS["DEDUP_TTL"])
+	]
+
+
+def release(dedup_key, registration_ids):
+	"""
+	Forgets that the dedup_key was sent to the registration ids.
+	"""
+	get_cache().delete_many([_make_key(dedup_key, registration_id) for registration_id in registration_ids])
+
+
+@contextmanager
+def deduplicate(dedup_key, registration_ids):
+	"""
+	Yields the registration ids to send to. They are released if sending them
+	raises, to be sent again on retry. A dedup_key of None disables deduplication.
+	"""
+	if dedup_key is None:
+		yield registration_ids
+		return
+
+	registration_ids = claim(dedup_key, registration_ids)
+	try:
+		yield registration_ids
+	except Exception:
+		release(dedup_key, registration_ids)
+		raise
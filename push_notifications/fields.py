@@ -1,3 +1,4 @@
+import hashlib
 import re
 import struct
 from django import forms
@@ -5,13 +6,14 @@ from django.core.validators import MaxValueValidator
 from django.core.validators import MinValueValidator
 from django.core.validators import RegexValidator
 from django.db import models, connection
+from django.db.models.lookups import Exact, In
 from django.utils import six
 from django.utils.translation import ugettext_lazy as _
 
 UNSIGNED_64BIT_INT_MIN_VALUE = 0
 UNSIGNED_64BIT_INT_MAX_VALUE = 2 ** 64 - 1
 
-__all__ = ["HexadecimalField", "HexIntegerField"]
+__all__ = ["HexadecimalField", "HexIntegerField", "RegistrationIDField", "RegistrationIDHashField"]
 
 
 hex_re = re.compile(r"^(([0-9A-f])|(0x[0-9A-f]))+$")
@@ -43,6 +45,13 @@ def _unsigned_integer_to_hex_string(value):
 	return hex(value).rstrip("L")
 
 
+def hash_registration_id(registration_id):
+	""" Return the fixed width digest stored by RegistrationIDHashField """
+	if registration_id is None:
+		return None
+	return hashlib.sha256(registration_id.encode("utf-8")).hexdigest()
+
+
 class HexadecimalField(forms.CharField):
 	"""
 	A form field that accepts only hexadecimal numbers
@@ -124,3 +133,78 @@ class HexIntegerField(models.BigIntegerField):
 		# make sure validation is performed on integer value not string value
 		value = _hex_string_to_unsigned_integer(value)
 		return super(models.BigIntegerField, self).run_validators(value)
+
+
+class RegistrationIDHashField(models.CharField):
+	"""
+	Stores the SHA-256 digest of a long registration id, so that it can be
+	indexed on all backends (TextField can't be indexed on MySQL and the btree
+	of long values is huge elsewhere). The digest is computed on save.
+
+	Lookups on the registration id go through this field, see RegistrationIDField.
+	"""
+
+	def __init__(self, *args, **kwargs):
+		self.source = kwargs.pop("source", "registration_id")
+		kwargs["max_length"] = 64
+		kwargs.setdefault("editable", False)
+		super(RegistrationIDHashField, self).__init__(*args, **kwargs)
+
+	def deconstruct(self):
+		name, path, args, kwargs = super(RegistrationIDHashField, self).deconstruct()
+		del kwargs["max_length"]
+		if self.source != "registration_id":
+			kwargs["source"] = self.source
+		return name, path, args, kwargs
+
+	def pre_save(self, model_instance, add):
+		value = hash_registration_id(getattr(model_instance, self.source))
+		setattr(model_instance, self.attname, value)
+		return value
+
+
+class RegistrationIDField(models.TextField):
+	"""
+	A TextField whose exact and `in` lookups are done on the indexed digest
+	stored by the RegistrationIDHashField named `hash_field_name`.
+	"""
+
+	def __init__(self, *args, **kwargs):
+		self.hash_field_name = kwargs.pop("hash_field_name", "registration_id_hash")
+		super(RegistrationIDField, self).__init__(*args, **kwargs)
+
+	def deconstruct(self):
+		name, path, args, kwargs = super(RegistrationIDField, self).deconstruct()
+		if self.hash_field_name != "registration_id_hash":
+			kwargs["hash_field_name"] = self.hash_field_name
+		return name, path, args, kwargs
+
+
+def _get_hash_col(lookup):
+	target = getattr(lookup.lhs, "target", None)
+	if not isinstance(target, RegistrationIDField):
+		return None
+	return target.model._meta.get_field(target.hash_field_name).get_col(lookup.lhs.alias)
+
+
+@RegistrationIDField.register_lookup
+class RegistrationIDExact(Exact):
+	def as_sql(self, compiler, connection):
+		hash_col = _get_hash_col(self)
+		if hash_col is None or not isinstance(self.rhs, six.string_types):
+			return super(RegistrationIDExact, self).as_sql(compiler, connection)
+		lookup = Exact(hash_col, hash_registration_id(self.rhs))
+		return lookup.as_sql(compiler, connection)
+
+
+@RegistrationIDField.register_lookup
+class RegistrationIDIn(In):
+	def as_sql(self, compiler, connection):
+		hash_col = _get_hash_col(self)
+		hashable = isinstance(self.rhs, (list, tuple, set)) and all(
+			isinstance(value, six.string_types) for value in self.rhs
+		)
+		if hash_col is None or not hashable:
+			return super(RegistrationIDIn, self).as_sql(compiler, connection)
+		lookup = In(hash_col, [hash_registration_id(value) for value in self.rhs])
+		return lookup.as_sql(compiler, connection)
@@ -5,7 +5,10 @@ Documentation is available on the Android Developer website:
 https://developer.android.com/google/gcm/index.html
 """
 
+import hashlib
 import json
+from collections import OrderedDict
+from timeit import default_timer
 from .models import GCMDevice
 
 
@@ -18,8 +21,14 @@ except ImportError:
 	from urllib import urlencode
 
 from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
 from . import NotificationError
+from .batching import get_batcher
+from .ratelimit import throttle
 from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from .signals import (
+	connection_opened, devices_deactivated, registration_id_changed, request_finished, request_started
+)
 
 
 class GCMError(NotificationError):
@@ -34,6 +43,22 @@ def _chunks(l, n):
 		yield l[i:i + n]
 
 
+def _cm_post(cloud_type, key, payload, headers):
+	url = SETTINGS["%s_POST_URL" % (cloud_type)]
+	request = Request(url, payload, headers)
+	throttle(cloud_type, key)
+	connection_opened.send(sender=cloud_type, reused=False)
+	request_started.send(sender=cloud_type, url=url, bytes_sent=len(payload))
+	start = default_timer()
+	try:
+		response = urlopen(request, timeout=SETTINGS["%s_ERROR_TIMEOUT" % (cloud_type)]).read().decode("utf-8")
+	except Exception as e:
+		request_finished.send(sender=cloud_type, url=url, elapsed=default_timer() - start, error=e)
+		raise
+	request_finished.send(sender=cloud_type, url=url, elapsed=default_timer() - start, error=None)
+	return response
+
+
 def _gcm_send(payload, content_type):
 	key = SETTINGS.get("GCM_API_KEY")
 	if not key:
@@ -46,8 +71,7 @@ def _gcm_send(payload, content_type):
 		"Authorization": "key=%s" % (key),
 		"Content-Length": str(len(payload)),
 	}
-	request = Request(SETTINGS["GCM_POST_URL"], payload, headers)
-	return urlopen(request, timeout=SETTINGS["GCM_ERROR_TIMEOUT"]).read().decode("utf-8")
+	return _cm_post("GCM", key, payload, headers)
 
 
 def _fcm_send(payload, content_type):
@@ -62,9 +86,7 @@ def _fcm_send(payload, content_type):
 		"Authorization": "key=%s" % (key),
 		"Content-Length": str(len(payload)),
 	}
-	import pdb; pdb.set_trace()
-	request = Request(SETTINGS["FCM_POST_URL"], payload, headers)
-	return urlopen(request, timeout=SETTINGS["FCM_ERROR_TIMEOUT"]).read().decode("utf-8")
+	return _cm_post("FCM", key, payload, headers)
 
 
 def _cm_send_plain(registration_id, data_payload, notification_payload, cloud_type="GCM", **kwargs):
@@ -118,6 +140,7 @@ def _cm_send_plain(registration_id, data_payload, notification_payload, cloud_ty
 				cloud_message_type=cloud_type,
 			)
 			device.update(active=0)
+			devices_deactivated.send(sender=cloud_type, registration_ids=[values["registration_id"]])
 			return result
 
 		raise GCMError(result)
@@ -125,7 +148,7 @@ def _cm_send_plain(registration_id, data_payload, notification_payload, cloud_ty
 	return result
 
 
-def _handler_cm_message_json(registration_ids, response_data, cloud_type):
+def _handler_cm_message_json(registration_ids, response_data, cloud_type, on_error=None):
 	response = response_data
 	if response.get("failure") or response.get("canonical_ids"):
 		ids_to_remove, old_new_ids = [], []
@@ -133,6 +156,8 @@ def _handler_cm_message_json(registration_ids, response_data, cloud_type):
 		for index, result in enumerate(response["results"]):
 			error = result.get("error")
 			if error:
+				if on_error is not None:
+					on_error(registration_ids[index], error)
 				# Information from Google docs
 				# https://developers.google.com/cloud-messaging/http
 				# If error is NotRegistered or InvalidRegistration,
@@ -156,20 +181,25 @@ def _handler_cm_message_json(registration_ids, response_data, cloud_type):
 		if ids_to_remove:
 			removed = GCMDevice.objects.filter(registration_id__in=ids_to_remove, cloud_message_type=cloud_type)
 			removed.update(active=0)
+			devices_deactivated.send(sender=cloud_type, registration_ids=ids_to_remove)
 
 		for old_id, new_id in old_new_ids:
 			_gcm_handle_canonical_id(new_id, old_id, cloud_type)
 
-		if throw_error:
+		if throw_error and on_error is None:
 			raise GCMError(response)
 	return response
 
 
-def _cm_send_json(registration_ids, data_payload, notification_payload, cloud_type="GCM", **kwargs):
+def _cm_send_json(registration_ids, data_payload, notification_payload, cloud_type="GCM", on_error=None, **kwargs):
 	"""
 	Sends a GCM notification to one or more registration_ids. The registration_ids
 	needs to be a list.
 	This will send the notification as json data.
+
+	If `on_error` is set, nothing raises: on_error(registration_id, error) is called
+	for every failed registration_id, with the error code returned by the server,
+	or the exception raised by the request.
 	"""
 
 	values = {"registration_ids": registration_ids} if registration_ids else {}
@@ -186,23 +216,52 @@ def _cm_send_json(registration_ids, data_payload, notification_payload, cloud_ty
 	# Sort the keys for deterministic output (useful for tests)
 	payload = json.dumps(values, separators=(",", ":"), sort_keys=True).encode("utf-8")
 	if cloud_type == "GCM":
-		response = json.loads(_gcm_send(payload, "application/json"))
+		send_func = _gcm_send
 	elif cloud_type == "FCM":
-		response = json.loads(_fcm_send(payload, "application/json"))
+		send_func = _fcm_send
 	else:
 		raise ImproperlyConfigured("cloud_type must be GCM or FCM not %s" % str(cloud_type))
-	return _handler_cm_message_json(registration_ids, response, cloud_type)
+
+	try:
+		response = json.loads(send_func(payload, "application/json"))
+	except (IOError, ValueError) as e:
+		if on_error is None:
+			raise
+		registration_ids = registration_ids or []
+		for registration_id in registration_ids:
+			on_error(registration_id, e)
+		return {
+			"success": 0, "failure": len(registration_ids), "canonical_ids": 0,
+			"results": [{"error": e.__class__.__name__}] * len(registration_ids),
+		}
+	return _handler_cm_message_json(registration_ids, response, cloud_type, on_error)
 
 
 def _gcm_handle_canonical_id(canonical_id, current_id, cloud_type):
 	"""
 	Handle situation when GCM server response contains canonical ID
 	"""
-	if GCMDevice.objects.filter(registration_id=canonical_id, cloud_message_type=cloud_type, active=True).exists():
-		GCMDevice.objects.filter(registration_id=current_id, cloud_message_type=cloud_type).update(active=False)
-	else:
-		GCMDevice.objects.filter(registration_id=current_id, cloud_message_type=cloud_type)\
-			.update(registration_id=canonical_id)
+	# Registration ids are unique across cloud types, active or not. An inactive
+	# device holding the canonical ID is stale, and replaced by the current device.
+	# When an active device holds it, the current device is a duplicate.
+	try:
+		with transaction.atomic():
+			GCMDevice.objects.filter(registration_id=canonical_id, active=False).delete()
+			renamed = not GCMDevice.objects.filter(registration_id=canonical_id).exists()
+			if renamed:
+				GCMDevice.objects.filter(registration_id=current_id, cloud_message_type=cloud_type)\
+					.update(registration_id=canonical_id)
+	except IntegrityError:
+		# The canonical ID was registered in the meantime
+		renamed = False
+	if renamed:
+		registration_id_changed.send(
+			sender=cloud_type, old_registration_id=current_id, new_registration_id=canonical_id
+		)
+		return
+
+	GCMDevice.objects.filter(registration_id=current_id, cloud_message_type=cloud_type).update(active=False)
+	devices_deactivated.send(sender=cloud_type, registration_ids=[current_id])
 
 
 def send_message(registration_id, data_payload, notification_payload, cloud_type, **kwargs):
@@ -212,20 +271,34 @@ def send_message(registration_id, data_payload, notification_payload, cloud_type
 	If sending multiple notifications, it is more efficient to use
 	send_bulk_message() with a list of registration_ids
 
+	When CM_BATCH_WINDOW is set, concurrent sends of the same message are sent
+	together as one JSON request, and the result of the registration_id in the
+	response is returned, see batching.py.
+
 	A reference of extra keyword arguments sent to the server is available here:
 	https://developers.google.com/cloud-messaging/server-ref#downstream
 	"""
 
 	if registration_id:
+		batcher = get_batcher()
+		if batcher is not None:
+			return batcher.submit(
+				registration_id, data_payload, notification_payload, cloud_type, **kwargs
+			).result()
 		return _cm_send_plain(registration_id, data_payload, notification_payload, cloud_type, **kwargs)
 
 
-def send_bulk_message(registration_ids, data_payload, notification_payload, cloud_type, **kwargs):
+def send_bulk_message(registration_ids, data_payload, notification_payload, cloud_type, on_error=None, **kwargs):
 	"""
 	Sends a GCM or FCM notification to one or more registration_ids. The registration_ids
 	needs to be a list.
 	This will send the notification as json data.
 
+	By default, an error on any registration_id raises GCMError once its chunk is
+	sent, and the remaining chunks aren't. If `on_error` is set, every chunk is
+	sent and on_error(registration_id, error) is called for each failed registration_id,
+	with the error code (e.g. "Unavailable") or the exception raised by the request.
+
 	A reference of extra keyword arguments sent to the server is available here:
 	https://firebase.google.com/docs/cloud-messaging/send-message
 	"""
@@ -244,7 +317,59 @@ def send_bulk_message(registration_ids, data_payload, notification_payload, clou
 		if len(registration_ids) > max_recipients:
 			ret = []
 			for chunk in _chunks(registration_ids, max_recipients):
-				ret.append(_cm_send_json(chunk, data_payload, notification_payload, cloud_type=cloud_type, **kwargs))
+				ret.append(_cm_send_json(
+					chunk, data_payload, notification_payload, cloud_type=cloud_type, on_error=on_error, **kwargs
+				))
 			return ret
 
-	return _cm_send_json(registration_ids, data_payload, notification_payload, cloud_type=cloud_type, **kwargs)
+	return _cm_send_json(
+		registration_ids, data_payload, notification_payload, cloud_type=cloud_type, on_error=on_error, **kwargs
+	)
+
+
+def _payload_digest(data_payload, notification_payload):
+	rendered = json.dumps([data_payload, notification_payload], separators=(",", ":"), sort_keys=True)
+	return hashlib.sha1(rendered.encode("utf-8")).hexdigest()
+
+
+def send_personalized_messages(messages, cloud_type, on_error=None, **kwargs):
+	"""
+	Sends GCM or FCM notifications whose payloads differ per registration_id.
+
+	The registration_ids whose rendered payloads are identical are sent together,
+	in JSON requests of up to GCM/FCM_MAX_RECIPIENTS registration_ids, so that
+	campaigns where most devices get the same payload still use multicast. The
+	registration_ids with a payload of their own are sent a JSON request each.
+
+	Errors are handled as by send_bulk_message(), per request.
+
+	:param messages: list: (registration_id, data_payload, notification_payload) tuples
+	:param cloud_type: str: "GCM" or "FCM"
+	:return: list: The result of each registration_id in the responses (e.g.
+	{"message_id": "..."} or {"error": "NotRegistered"}), in the order of `messages`
+	"""
+	if cloud_type == "GCM":
+		max_recipients = SETTINGS.get("GCM_MAX_RECIPIENTS")
+	elif cloud_type == "FCM":
+		max_recipients = SETTINGS.get("FCM_MAX_RECIPIENTS")
+	else:
+		raise ImproperlyConfigured("cloud_type must be GCM or FCM not %s" % str(cloud_type))
+
+	groups = OrderedDict()
+	for index, (registration_id, data_payload, notification_payload) in enumerate(messages):
+		key = _payload_digest(data_payload, notification_payload)
+		if key not in groups:
+			groups[key] = (data_payload, notification_payload, [])
+		groups[key][2].append((index, registration_id))
+
+	results = [None] * len(messages)
+	for data_payload, notification_payload, recipients in groups.values():
+		for chunk in _chunks(recipients, max_recipients):
+			response = _cm_send_json(
+				[registration_id for index, registration_id in chunk], data_payload, notification_payload,
+				cloud_type=cloud_type, on_error=on_error, **kwargs
+			)
+			# Results are in the same order as the registration ids of the chunk
+			for (index, registration_id), result in zip(chunk, response.get("results", [])):
+				results[index] = result
+	return results
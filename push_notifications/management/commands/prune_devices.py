@@ -1,16 +1,80 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 
 class Command(BaseCommand):
 	can_import_settings = True
-	help = 'Deactivate APNS devices that are not receiving notifications'
+	help = 'Deactivate devices that are not receiving notifications'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--platform", action="append", choices=("apns", "gcm", "wns"), dest="platforms",
+			help=(
+				"Platform to prune, may be repeated. APNS devices are looked up in the feedback service, "
+				"GCM/FCM and WNS devices are probed. Defaults to apns. Probing WNS devices requires --wns-raw-probes"
+			)
+		)
+		parser.add_argument(
+			"--wns-raw-probes", action="store_true", default=False,
+			help=(
+				"Allow probing WNS devices. WARNING: every WNS device is sent a real, empty raw notification, "
+				"which wakes up apps with a raw notification handler"
+			)
+		)
+		parser.add_argument(
+			"--dry-run", action="store_true", default=False,
+			help="Report the devices that would be deactivated without deactivating them"
+		)
+		parser.add_argument(
+			"--batch-size", type=int, default=1000,
+			help="Amount of expired tokens looked up and deactivated per query"
+		)
+		parser.add_argument(
+			"--concurrency", type=int, default=8,
+			help="Amount of GCM/FCM and WNS probe requests sent concurrently"
+		)
 
 	def handle(self, *args, **options):
-		from push_notifications.models import APNSDevice, get_expired_tokens
-		expired = get_expired_tokens()
-		devices = APNSDevice.objects.filter(registration_id__in=expired)
-		for d in devices:
-			self.stdout.write('deactivating [%s]' % d.registration_id)
-			d.active = False
-			d.save()
-		self.stdout.write('deactivated %d devices' % len(devices))
+		from push_notifications.models import APNSDevice, GCMDevice, WNSDevice, get_expired_tokens
+		from push_notifications.probe import get_probe_audiences, probe_devices
+
+		for option in ("batch_size", "concurrency"):
+			if options[option] < 1:
+				raise CommandError("--%s must be at least 1" % (option.replace("_", "-")))
+
+		platforms = options["platforms"] or ["apns"]
+		if "wns" in platforms and not options["wns_raw_probes"]:
+			raise CommandError(
+				"WNS devices are probed with raw notifications which wake up their apps, "
+				"pass --wns-raw-probes to probe them anyway"
+			)
+
+		for platform in platforms:
+			if platform == "apns":
+				self.prune(APNSDevice.objects.all(), get_expired_tokens(), "APNS", options)
+				continue
+
+			model = GCMDevice if platform == "gcm" else WNSDevice
+			for sender, queryset in get_probe_audiences(model.objects.all()):
+				dead, errors = probe_devices(
+					queryset, concurrency=options["concurrency"], wns_raw_probes=options["wns_raw_probes"]
+				)
+				for error in errors:
+					self.stderr.write("%s probe failed: %r" % (sender, error))
+				self.prune(queryset, dead, sender, options)
+
+	def prune(self, queryset, expired, sender, options):
+		from push_notifications.models import deactivate_devices
+
+		batch_size = options["batch_size"]
+		batches = -(-len(set(expired)) // batch_size)
+		verb = "would deactivate" if options["dry_run"] else "deactivated"
+		total = 0
+		for i, registration_ids in enumerate(deactivate_devices(
+			queryset, expired, sender, batch_size=batch_size, dry_run=options["dry_run"]
+		)):
+			if options["verbosity"] > 1:
+				for registration_id in registration_ids:
+					self.stdout.write('deactivating [%s]' % registration_id)
+			total += len(registration_ids)
+			self.stdout.write('%s batch %d/%d: %s %d devices' % (sender, i + 1, batches, verb, len(registration_ids)))
+		self.stdout.write('%s: %s %d devices' % (sender, verb, total))
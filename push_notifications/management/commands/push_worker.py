@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+	can_import_settings = True
+	help = "Send the notifications enqueued by send_message() when QUEUE_BROKER is set"
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--burst", action="store_true", default=False,
+			help="Exit once the queue is empty instead of waiting for new jobs"
+		)
+		parser.add_argument(
+			"--timeout", type=float, default=5,
+			help="Seconds to wait for a job before checking the queue again"
+		)
+
+	def handle(self, *args, **options):
+		from push_notifications.pipeline import get_broker, process_job
+
+		broker = get_broker()
+		if broker is None:
+			raise CommandError("PUSH_NOTIFICATIONS_SETTINGS[\"QUEUE_BROKER\"] is not set")
+
+		while True:
+			item = broker.dequeue(timeout=options["timeout"])
+			if item is None:
+				if options["burst"]:
+					break
+				continue
+
+			job_id, job = item
+			try:
+				results, failed_chunks = process_job(broker, job)
+			except Exception as e:
+				# Not acked: brokers with a visibility timeout (DatabaseBroker) dequeue it again
+				self.stderr.write("job %s: %r" % (job_id, e))
+				continue
+			broker.ack(job_id)
+			for result in results:
+				self.stdout.write("job %s: %s" % (job_id, result))
+			if failed_chunks:
+				self.stdout.write("job %s: %d chunks failed" % (job_id, failed_chunks))
@@ -0,0 +1,132 @@
+"""
+Metrics receivers for the signals of signals.py.
+
+	from push_notifications.metrics import StatsdMetrics
+	StatsdMetrics(host="localhost", port=8125).connect()
+
+Both adapters record, per provider, the requests, failed requests, request
+durations, bytes sent, connections opened and reused, retries, deactivated
+devices and canonical id updates.
+"""
+
+import socket
+
+from . import signals
+
+
+class BaseMetrics(object):
+	def connect(self):
+		"""
+		Starts recording the metrics.
+		"""
+		for signal, receiver in self._receivers():
+			signal.connect(receiver, weak=False, dispatch_uid=self._dispatch_uid(receiver))
+		return self
+
+	def disconnect(self):
+		for signal, receiver in self._receivers():
+			signal.disconnect(dispatch_uid=self._dispatch_uid(receiver))
+
+	def _dispatch_uid(self, receiver):
+		return "%s.%s.%i" % (self.__class__.__name__, receiver.__name__, id(self))
+
+	def _receivers(self):
+		return (
+			(signals.request_started, self.on_request_started),
+			(signals.request_finished, self.on_request_finished),
+			(signals.connection_opened, self.on_connection_opened),
+			(signals.send_retried, self.on_send_retried),
+			(signals.devices_deactivated, self.on_devices_deactivated),
+			(signals.registration_id_changed, self.on_registration_id_changed),
+		)
+
+	def increment(self, name, provider, value=1):
+		raise NotImplementedError
+
+	def timing(self, name, provider, seconds):
+		raise NotImplementedError
+
+	def on_request_started(self, sender, bytes_sent, **kwargs):
+		self.increment("bytes_sent", sender, bytes_sent)
+
+	def on_request_finished(self, sender, elapsed, error, **kwargs):
+		self.increment("requests", sender)
+		if error is not None:
+			self.increment("request_errors", sender)
+		self.timing("request_time", sender, elapsed)
+
+	def on_connection_opened(self, sender, reused, **kwargs):
+		self.increment("connections_reused" if reused else "connections_opened", sender)
+
+	def on_send_retried(self, sender, **kwargs):
+		self.increment("retries", sender)
+
+	def on_devices_deactivated(self, sender, registration_ids, **kwargs):
+		self.increment("deactivations", sender, len(registration_ids))
+
+	def on_registration_id_changed(self, sender, **kwargs):
+		self.increment("canonical_ids", sender)
+
+
+class StatsdMetrics(BaseMetrics):
+	"""
+	Sends the metrics to a StatsD server over UDP, as
+	<prefix>.<provider>.<name>, e.g. push_notifications.fcm.requests.
+	"""
+
+	def __init__(self, host="localhost", port=8125, prefix="push_notifications"):
+		self.address = (host, port)
+		self.prefix = prefix
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+	def _send(self, data):
+		try:
+			self.socket.sendto(data.encode("utf-8"), self.address)
+		except socket.error:
+			# Metrics must never break sending
+			pass
+
+	def increment(self, name, provider, value=1):
+		self._send("%s.%s.%s:%i|c" % (self.prefix, provider.lower(), name, value))
+
+	def timing(self, name, provider, seconds):
+		self._send("%s.%s.%s:%.3f|ms" % (self.prefix, provider.lower(), name, seconds * 1000))
+
+
+class PrometheusMetrics(BaseMetrics):
+	"""
+	Records the metrics with prometheus_client, as counters and a histogram
+	labelled by provider, e.g. push_notifications_requests_total{provider="fcm"}.
+	"""
+
+	COUNTERS = (
+		("bytes_sent", "Bytes sent to the providers"),
+		("requests", "Requests sent to the providers"),
+		("request_errors", "Requests to the providers which failed"),
+		("connections_opened", "Connections opened to the providers"),
+		("connections_reused", "Requests sent over an open connection"),
+		("retries", "Chunks enqueued again after failing"),
+		("deactivations", "Devices deactivated"),
+		("canonical_ids", "Registration ids replaced by their canonical id"),
+	)
+
+	def __init__(self, registry=None, prefix="push_notifications"):
+		from prometheus_client import REGISTRY, Counter, Histogram
+
+		registry = registry or REGISTRY
+		self.counters = dict(
+			(name, Counter("%s_%s" % (prefix, name), description, ["provider"], registry=registry))
+			for name, description in self.COUNTERS
+		)
+		self.histograms = {
+			"request_time": Histogram(
+				"%s_request_seconds" % (prefix), "Duration of the requests to the providers", ["provider"],
+				registry=registry
+			),
+		}
+
+	def increment(self, name, provider, value=1):
+		self.counters[name].labels(provider=provider.lower()).inc(value)
+
+	def timing(self, name, provider, seconds):
+		self.histograms[name].labels(provider=provider.lower()).observe(seconds)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+import push_notifications.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('push_notifications', '0005_auto_20161117_1306'),
+    ]
+
+    operations = [
+        # The digest is indexed but not unique until it's backfilled in 0007
+        migrations.AddField(
+            model_name='gcmdevice',
+            name='registration_id_hash',
+            field=push_notifications.fields.RegistrationIDHashField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='wnsdevice',
+            name='registration_id_hash',
+            field=push_notifications.fields.RegistrationIDHashField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='gcmdevice',
+            name='registration_id',
+            field=push_notifications.fields.RegistrationIDField(verbose_name='Registration ID'),
+        ),
+        migrations.AlterField(
+            model_name='wnsdevice',
+            name='registration_id',
+            field=push_notifications.fields.RegistrationIDField(verbose_name='Notification URI'),
+        ),
+    ]
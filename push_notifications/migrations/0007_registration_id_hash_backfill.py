@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models, transaction
+import push_notifications.fields
+from push_notifications.fields import hash_registration_id
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_registration_id_hash(apps, schema_editor):
+    """
+    Computes the registration id digests in batches of primary keys, each in its
+    own transaction.
+
+    The digest becomes unique at the end of this migration: when several devices
+    share a registration id, only the most recent one is kept. The older
+    duplicates are deleted, since a device without its digest can neither be
+    looked up by registration id nor saved again.
+    """
+    db_alias = schema_editor.connection.alias
+    for model_name in ("GCMDevice", "WNSDevice"):
+        Device = apps.get_model("push_notifications", model_name)
+        queryset = Device.objects.using(db_alias).order_by("pk")
+        last_pk = None
+        while True:
+            batch = queryset.filter(registration_id_hash__isnull=True)
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch.values_list("pk", "registration_id")[:BATCH_SIZE])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            # Later rows of the batch override earlier duplicates
+            hashes = {}
+            for pk, registration_id in batch:
+                hashes[hash_registration_id(registration_id)] = pk
+            pks = set(hashes.values())
+
+            with transaction.atomic(using=db_alias):
+                # Delete the older devices with the same registration ids
+                older = queryset.filter(
+                    models.Q(registration_id_hash__in=list(hashes.keys()))
+                    | models.Q(pk__in=[pk for pk, registration_id in batch if pk not in pks])
+                )
+                older.delete()
+
+                queryset.filter(pk__in=list(pks)).update(registration_id_hash=models.Case(
+                    *[models.When(pk=pk, then=models.Value(digest)) for digest, pk in hashes.items()],
+                    output_field=models.CharField()
+                ))
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('push_notifications', '0006_registration_id_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_registration_id_hash, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='gcmdevice',
+            name='registration_id_hash',
+            field=push_notifications.fields.RegistrationIDHashField(editable=False, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='wnsdevice',
+            name='registration_id_hash',
+            field=push_notifications.fields.RegistrationIDHashField(editable=False, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# (model, column) pairs indexed for the rows with active=True, used to select
+# the audience of send_message().
+PARTIAL_INDEXES = (
+    ("APNSDevice", "user_id"),
+    ("GCMDevice", "user_id"),
+    ("GCMDevice", "cloud_message_type"),
+    ("WNSDevice", "user_id"),
+)
+
+
+def _supports_partial_indexes(connection):
+    return connection.vendor in ("postgresql", "sqlite")
+
+
+def _index_name(table, column):
+    return "%s_active_%s" % (table, column)
+
+
+def create_partial_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    if not _supports_partial_indexes(connection):
+        return
+
+    qn = connection.ops.quote_name
+    # Don't lock large device tables while building the indexes
+    concurrently = " CONCURRENTLY" if connection.vendor == "postgresql" else ""
+    for model_name, column in PARTIAL_INDEXES:
+        table = apps.get_model("push_notifications", model_name)._meta.db_table
+        schema_editor.execute("CREATE INDEX%s %s ON %s (%s) WHERE %s = %s" % (
+            concurrently, qn(_index_name(table, column)), qn(table), qn(column), qn("active"),
+            # Match the filter Django generates, SQLite only uses the index if it does
+            "true" if connection.vendor == "postgresql" else "1",
+        ))
+
+
+def drop_partial_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    if not _supports_partial_indexes(connection):
+        return
+
+    qn = connection.ops.quote_name
+    for model_name, column in PARTIAL_INDEXES:
+        table = apps.get_model("push_notifications", model_name)._meta.db_table
+        schema_editor.execute("DROP INDEX IF EXISTS %s" % (qn(_index_name(table, column))))
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('push_notifications', '0007_registration_id_hash_backfill'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_partial_indexes, drop_partial_indexes),
+    ]
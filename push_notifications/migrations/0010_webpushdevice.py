@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import push_notifications.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('push_notifications', '0009_pushjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebPushDevice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=255, null=True, verbose_name='Name')),
+                ('active', models.BooleanField(default=True, help_text='Inactive devices will not be sent notifications', verbose_name='Is active')),
+                ('date_created', models.DateTimeField(auto_now_add=True, null=True, verbose_name='Creation date')),
+                ('device_id', models.UUIDField(blank=True, db_index=True, help_text='UUID of the browser installation', null=True, verbose_name='Device ID')),
+                ('registration_id', push_notifications.fields.RegistrationIDField(verbose_name='Endpoint')),
+                ('registration_id_hash', push_notifications.fields.RegistrationIDHashField(editable=False, null=True, unique=True)),
+                ('p256dh', models.CharField(help_text='The p256dh key of the subscription, base64url encoded', max_length=88, verbose_name='Public key')),
+                ('auth', models.CharField(help_text='The auth key of the subscription, base64url encoded', max_length=24, verbose_name='Auth secret')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'WebPush device',
+            },
+        ),
+    ]
@@ -1,10 +1,19 @@
 from __future__ import unicode_literals
+import threading
+from collections import namedtuple
 from copy import deepcopy
-from django.db import models
-from django.utils.encoding import python_2_unicode_compatible
+from timeit import default_timer
+from django.db import connections, models, transaction
+from django.utils import six
+from django.utils.encoding import force_text, python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
-from .fields import HexIntegerField
+from .dedup import deduplicate
+from .fields import HexIntegerField, RegistrationIDField, RegistrationIDHashField, hash_registration_id
+from .pipeline import enqueue, should_enqueue
+from .results import BroadcastResult
+from .scheduling import ScheduledSendQuerySetMixin
+from .sharding import ShardedSendQuerySetMixin
 from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 
 
@@ -13,6 +22,9 @@ CLOUD_MESSAGE_TYPES = (
 	("FCM", "Firebase Cloud Message"),
 )
 
+# X-WNS-Status values of the notifications WNS didn't accept
+WNS_FAILED_STATUSES = ("dropped", "channelthrottled")
+
 
 @python_2_unicode_compatible
 class Device(models.Model):
@@ -35,47 +47,213 @@ class Device(models.Model):
 			"%s for %s" % (self.__class__.__name__, self.user or "unknown user")
 		)
 
-
-class GCMDeviceManager(models.Manager):
+	def save(self, *args, **kwargs):
+		update_fields = kwargs.get("update_fields")
+		if update_fields is not None:
+			# The digests are computed on save, and must be written with their registration id
+			update_fields = set(update_fields)
+			for field in self._meta.concrete_fields:
+				if isinstance(field, RegistrationIDHashField) and field.source in update_fields:
+					update_fields.add(field.name)
+			kwargs["update_fields"] = update_fields
+		return super(Device, self).save(*args, **kwargs)
+
+
+def _cm_build_payloads(message, title, extra, cloud_type):
+	"""
+	Returns the (data, notification) payloads of a GCM or FCM message.
+	GCM sends the message in the data payload, FCM as a notification.
+	"""
+	data_payload = deepcopy(extra)
+	notification_payload = {}
+	if message is not None:
+		if cloud_type == "FCM":
+			notification_payload["body"] = message
+		else:
+			data_payload["message"] = message
+	if title is not None and cloud_type == "FCM":
+		notification_payload["title"] = title
+	return data_payload, notification_payload
+
+
+def _pop_error_handler(kwargs):
+	"""
+	Pops the `on_error` and `raise_errors` arguments of the querysets' send_message().
+	Returns the on_error callback to pass to the provider, or None to raise errors.
+	"""
+	on_error = kwargs.pop("on_error", None)
+	if kwargs.pop("raise_errors", on_error is None):
+		return None
+	return on_error or (lambda registration_id, error: None)
+
+
+class DeviceManager(models.Manager):
+	def _get_conflict_field(self):
+		"""
+		Returns the unique field identifying a registration, if there is one.
+		"""
+		field = self.model._meta.get_field("registration_id")
+		if isinstance(field, RegistrationIDField):
+			field = self.model._meta.get_field(field.hash_field_name)
+		return field if field.unique else None
+
+	def _can_upsert(self, connection):
+		if connection.vendor in ("postgresql", "mysql"):
+			return True
+		if connection.vendor == "sqlite":
+			# ON CONFLICT was added in SQLite 3.24
+			import sqlite3
+			return sqlite3.sqlite_version_info >= (3, 24)
+		return False
+
+	def register(self, registration_id, **kwargs):
+		"""
+		Creates a device, or updates the fields given in kwargs of the device with the
+		same registration_id, in a single INSERT ... ON CONFLICT (PostgreSQL, SQLite)
+		or INSERT ... ON DUPLICATE KEY UPDATE (MySQL) statement. Concurrent
+		registrations of the same registration_id can't race each other.
+		Other databases, and models without a unique registration field, fall back
+		to update_or_create().
+
+		:return: (device, created)
+		"""
+		connection = connections[self.db]
+		conflict_field = self._get_conflict_field()
+		if conflict_field is None or not self._can_upsert(connection):
+			return self.update_or_create(registration_id=registration_id, defaults=kwargs)
+
+		qn = connection.ops.quote_name
+		meta = self.model._meta
+		device = self.model(registration_id=registration_id, **kwargs)
+		fields = [f for f in meta.concrete_fields if not f.primary_key]
+		columns = [qn(f.column) for f in fields]
+		params = [f.get_db_prep_save(f.pre_save(device, True), connection) for f in fields]
+		update_columns = [
+			qn(f.column) for f in fields if f.name in kwargs or f.attname in kwargs
+		] or [qn(conflict_field.column)]
+		pk_column = qn(meta.pk.column)
+
+		sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+			qn(meta.db_table), ", ".join(columns), ", ".join(["%s"] * len(columns))
+		)
+		with transaction.atomic(using=self.db), connection.cursor() as cursor:
+			if connection.vendor == "postgresql":
+				# xmax is 0 for freshly inserted rows
+				sql += " ON CONFLICT (%s) DO UPDATE SET %s RETURNING %s, (xmax = 0)" % (
+					qn(conflict_field.column),
+					", ".join("%s = EXCLUDED.%s" % (column, column) for column in update_columns),
+					pk_column,
+				)
+				cursor.execute(sql, params)
+				pk, created = cursor.fetchone()
+			elif connection.vendor == "mysql":
+				# Django connects with CLIENT_FOUND_ROWS, so an unchanged row counts as
+				# 1 affected row like an insert does (2 for a changed row): whether the
+				# row existed is looked up beforehand. A row inserted concurrently in
+				# between, with the same values, is reported as created.
+				conflict_value = params[fields.index(conflict_field)]
+				cursor.execute("SELECT %s FROM %s WHERE %s = %%s" % (
+					pk_column, qn(meta.db_table), qn(conflict_field.column)
+				), [conflict_value])
+				existed = cursor.fetchone() is not None
+				# LAST_INSERT_ID(id) makes lastrowid the id of the updated row as well
+				sql += " ON DUPLICATE KEY UPDATE %s, %s = LAST_INSERT_ID(%s)" % (
+					", ".join("%s = VALUES(%s)" % (column, column) for column in update_columns),
+					pk_column, pk_column,
+				)
+				cursor.execute(sql, params)
+				# Without CLIENT_FOUND_ROWS, an unchanged row counts as 0 affected rows
+				pk, created = cursor.lastrowid, not existed and cursor.rowcount == 1
+			else:
+				# SQLite locks the whole database on write, so the update can't race the insert.
+				cursor.execute(sql + " ON CONFLICT (%s) DO NOTHING" % (qn(conflict_field.column)), params)
+				created = cursor.rowcount == 1
+				if created:
+					pk = cursor.lastrowid
+				else:
+					conflict_value = params[fields.index(conflict_field)]
+					values = dict(zip(columns, params))
+					cursor.execute("UPDATE %s SET %s WHERE %s = %%s" % (
+						qn(meta.db_table),
+						", ".join("%s = %%s" % (column) for column in update_columns),
+						qn(conflict_field.column),
+					), [values[column] for column in update_columns] + [conflict_value])
+					pk = None
+
+		if pk is None:
+			return self.get(**{conflict_field.attname: getattr(device, conflict_field.attname)}), created
+		return self.get(pk=pk), bool(created)
+
+
+class RegistrationIDHashQuerySetMixin(object):
+	def update(self, **kwargs):
+		# Keep the indexed digest in sync, see RegistrationIDHashField
+		if isinstance(kwargs.get("registration_id"), six.string_types):
+			kwargs["registration_id_hash"] = hash_registration_id(kwargs["registration_id"])
+		return super(RegistrationIDHashQuerySetMixin, self).update(**kwargs)
+
+
+class GCMDeviceManager(DeviceManager):
 	def get_queryset(self):
 		return GCMDeviceQuerySet(self.model)
 
 
-class GCMDeviceQuerySet(models.query.QuerySet):
+class GCMDeviceQuerySet(ScheduledSendQuerySetMixin, ShardedSendQuerySetMixin, RegistrationIDHashQuerySetMixin, models.query.QuerySet):
 	def send_message(self, message, title=None, **kwargs):
-		if self:
-			from .gcm import send_bulk_message
-
-			extra = kwargs.pop("extra", {})
-
-			response = []
-			for cloud_type in ("GCM", "FCM"):
-				reg_ids = list(
-					self.filter(active=True, cloud_message_type=cloud_type).values_list(
-						"registration_id", flat=True
-					)
+		"""
+		Sends the message to the active devices, in chunks of GCM/FCM_MAX_RECIPIENTS.
+		The devices already sent the `dedup_key` are skipped, see dedup.py.
+
+		By default, errors other than unregistered devices raise GCMError and stop
+		the broadcast. With `raise_errors=False`, or an `on_error(registration_id, error)`
+		callback, all chunks are sent and the errors are reported in the result.
+
+		:return: BroadcastResult, or the id of the job when the pipeline is enabled
+		"""
+		from .gcm import send_bulk_message
+
+		if should_enqueue(kwargs):
+			return enqueue(self, message, title, **kwargs)
+
+		extra = kwargs.pop("extra", {})
+		dedup_key = kwargs.pop("dedup_key", None)
+		on_error = _pop_error_handler(kwargs)
+
+		result = BroadcastResult("gcm")
+		for cloud_type in ("GCM", "FCM"):
+			reg_ids = list(
+				self.filter(active=True, cloud_message_type=cloud_type).values_list(
+					"registration_id", flat=True
 				)
-				data_payload = deepcopy(extra)
-				notification_payload = {}
-				if message is not None:
-					if cloud_type == "FCM":
-						notification_payload["body"] = message
-					else:
-						data_payload["message"] = message
-				if title is not None and cloud_type == "FCM":
-					notification_payload["title"] = title
-
-				if reg_ids:
-					r = send_bulk_message(
-						registration_ids=reg_ids,
+			)
+			if not reg_ids:
+				continue
+
+			data_payload, notification_payload = _cm_build_payloads(message, title, extra, cloud_type)
+			max_recipients = SETTINGS["%s_MAX_RECIPIENTS" % (cloud_type)]
+			for start in range(0, len(reg_ids), max_recipients):
+				chunk = reg_ids[start:start + max_recipients]
+				with deduplicate(dedup_key, chunk) as chunk_ids:
+					result.skipped += len(chunk) - len(chunk_ids)
+					if not chunk_ids:
+						continue
+					offset = result.add_recipients(chunk_ids)
+					timer = default_timer()
+					response = send_bulk_message(
+						registration_ids=chunk_ids,
 						data_payload=data_payload,
 						notification_payload=notification_payload,
 						cloud_type=cloud_type,
+						on_error=on_error,
 						**kwargs
 					)
-					response.append(r)
+					result.add_timing(default_timer() - timer)
+				# Results are in the same order as the registration ids of the chunk
+				for index, chunk_result in enumerate(response.get("results", [])):
+					if "error" in chunk_result:
+						result.add_failure(offset + index, chunk_result["error"])
 
-			return response
+		return result
 
 
 class GCMDevice(Device):
@@ -86,7 +264,8 @@ class GCMDevice(Device):
 		verbose_name=_("Device ID"), blank=True, null=True, db_index=True,
 		help_text=_("ANDROID_ID / TelephonyManager.getDeviceId() (always as hex)")
 	)
-	registration_id = models.TextField(verbose_name=_("Registration ID"))
+	registration_id = RegistrationIDField(verbose_name=_("Registration ID"))
+	registration_id_hash = RegistrationIDHashField(unique=True, null=True)
 	cloud_message_type = models.CharField(
 		verbose_name=_("Cloud Message Type"), max_length=3,
 		choices=CLOUD_MESSAGE_TYPES, default="GCM",
@@ -100,15 +279,9 @@ class GCMDevice(Device):
 	def send_message(self, message, title=None, **kwargs):
 		from .gcm import send_message
 
-		data_payload = kwargs.pop("extra", {})
-		notification_payload = {}
-		if message is not None:
-			if self.cloud_type == "FCM":
-				notification_payload["body"] = message
-			else:
-				data_payload["message"] = message
-		if title is not None and self.cloud_type == "FCM":
-			notification_payload["title"] = title
+		data_payload, notification_payload = _cm_build_payloads(
+			message, title, kwargs.pop("extra", {}), self.cloud_message_type
+		)
 
 		return send_message(
 			registration_id=self.registration_id,
@@ -119,17 +292,35 @@ class GCMDevice(Device):
 		)
 
 
-class APNSDeviceManager(models.Manager):
+class APNSDeviceManager(DeviceManager):
 	def get_queryset(self):
 		return APNSDeviceQuerySet(self.model)
 
 
-class APNSDeviceQuerySet(models.query.QuerySet):
+class APNSDeviceQuerySet(ScheduledSendQuerySetMixin, ShardedSendQuerySetMixin, models.query.QuerySet):
 	def send_message(self, message, **kwargs):
-		if self:
-			from .apns import apns_send_bulk_message
-			reg_ids = list(self.filter(active=True).values_list("registration_id", flat=True))
-			return apns_send_bulk_message(registration_ids=reg_ids, alert=message, **kwargs)
+		"""
+		Sends the message to the active devices over a single connection.
+		The devices already sent the `dedup_key` are skipped, see dedup.py.
+
+		:return: BroadcastResult, or the id of the job when the pipeline is enabled
+		"""
+		from .apns import apns_send_bulk_message
+
+		if should_enqueue(kwargs):
+			return enqueue(self, message, **kwargs)
+
+		dedup_key = kwargs.pop("dedup_key", None)
+		result = BroadcastResult("apns")
+		reg_ids = list(self.filter(active=True).values_list("registration_id", flat=True))
+		with deduplicate(dedup_key, reg_ids) as send_ids:
+			result.skipped += len(reg_ids) - len(send_ids)
+			if send_ids:
+				result.add_recipients(send_ids)
+				timer = default_timer()
+				apns_send_bulk_message(registration_ids=send_ids, alert=message, **kwargs)
+				result.add_timing(default_timer() - timer)
+		return result
 
 
 class APNSDevice(Device):
@@ -152,18 +343,54 @@ class APNSDevice(Device):
 		return apns_send_message(registration_id=self.registration_id, alert=message, **kwargs)
 
 
-class WNSDeviceManager(models.Manager):
+class WNSDeviceManager(DeviceManager):
 	def get_queryset(self):
 		return WNSDeviceQuerySet(self.model)
 
 
-class WNSDeviceQuerySet(models.query.QuerySet):
+class WNSDeviceQuerySet(ScheduledSendQuerySetMixin, ShardedSendQuerySetMixin, RegistrationIDHashQuerySetMixin, models.query.QuerySet):
 	def send_message(self, message, **kwargs):
-		if self:
-			from .wns import wns_send_bulk_message
-
-			reg_ids = list(self.filter(active=True).values_list("registration_id", flat=True))
-			return wns_send_bulk_message(uri_list=reg_ids, message=message, **kwargs)
+		"""
+		Sends the message to the active devices, one request per device.
+		Notifications dropped or throttled by WNS are reported as failures.
+		The devices already sent the `dedup_key` are skipped, see dedup.py.
+
+		By default, a failed request raises and stops the broadcast. With
+		`raise_errors=False`, or an `on_error(uri, exception)` callback, all devices
+		are sent to and the errors are reported in the result.
+
+		:return: BroadcastResult, or the id of the job when the pipeline is enabled
+		"""
+		from .wns import wns_send_bulk_message
+
+		if should_enqueue(kwargs):
+			return enqueue(self, message, **kwargs)
+
+		dedup_key = kwargs.pop("dedup_key", None)
+		on_error = _pop_error_handler(kwargs)
+		errors = {}
+		if on_error is not None:
+			def record_error(uri, error):
+				errors[uri] = error
+				on_error(uri, error)
+			kwargs["on_error"] = record_error
+
+		result = BroadcastResult("wns")
+		reg_ids = list(self.filter(active=True).values_list("registration_id", flat=True))
+		with deduplicate(dedup_key, reg_ids) as send_ids:
+			result.skipped += len(reg_ids) - len(send_ids)
+			if send_ids:
+				result.add_recipients(send_ids)
+				wns_results = wns_send_bulk_message(uri_list=send_ids, message=message, **kwargs)
+			else:
+				wns_results = []
+		for index, wns_result in enumerate(wns_results):
+			result.add_timing(wns_result.elapsed)
+			if wns_result.uri in errors:
+				result.add_failure(index, errors[wns_result.uri].__class__.__name__)
+			elif wns_result.status in WNS_FAILED_STATUSES:
+				result.add_failure(index, wns_result.status)
+		return result
 
 
 class WNSDevice(Device):
@@ -171,7 +398,8 @@ class WNSDevice(Device):
 		verbose_name=_("Device ID"), blank=True, null=True, db_index=True,
 		help_text=_("GUID()")
 	)
-	registration_id = models.TextField(verbose_name=_("Notification URI"))
+	registration_id = RegistrationIDField(verbose_name=_("Notification URI"))
+	registration_id_hash = RegistrationIDHashField(unique=True, null=True)
 
 	objects = WNSDeviceManager()
 
@@ -184,8 +412,309 @@ class WNSDevice(Device):
 		return wns_send_message(uri=self.registration_id, message=message, **kwargs)
 
 
+class WebPushDeviceManager(DeviceManager):
+	def get_queryset(self):
+		return WebPushDeviceQuerySet(self.model)
+
+
+class WebPushDeviceQuerySet(ScheduledSendQuerySetMixin, ShardedSendQuerySetMixin, RegistrationIDHashQuerySetMixin, models.query.QuerySet):
+	def send_message(self, message, **kwargs):
+		"""
+		Sends the message to the active subscriptions, one encrypted request per
+		subscription, concurrently. Expired subscriptions are deactivated and
+		reported as failures.
+		The devices already sent the `dedup_key` are skipped, see dedup.py.
+
+		By default, a failed request raises once every subscription was sent to.
+		With `raise_errors=False`, or an `on_error(endpoint, exception)` callback,
+		the errors are reported in the result.
+
+		:return: BroadcastResult, or the id of the job when the pipeline is enabled
+		"""
+		from .webpush import webpush_send_bulk_message
+
+		if should_enqueue(kwargs):
+			return enqueue(self, message, **kwargs)
+
+		dedup_key = kwargs.pop("dedup_key", None)
+		on_error = _pop_error_handler(kwargs)
+		errors = {}
+		if on_error is not None:
+			def record_error(endpoint, error):
+				errors[endpoint] = error
+				on_error(endpoint, error)
+			kwargs["on_error"] = record_error
+
+		result = BroadcastResult("webpush")
+		keys = dict(
+			(endpoint, (p256dh, auth)) for endpoint, p256dh, auth in
+			self.filter(active=True).values_list("registration_id", "p256dh", "auth")
+		)
+		with deduplicate(dedup_key, list(keys)) as send_ids:
+			result.skipped += len(keys) - len(send_ids)
+			if send_ids:
+				result.add_recipients(send_ids)
+				wp_results = webpush_send_bulk_message(
+					[(endpoint, ) + keys[endpoint] for endpoint in send_ids], message, **kwargs
+				)
+			else:
+				wp_results = []
+		for index, (endpoint, wp_result) in enumerate(zip(send_ids, wp_results)):
+			if wp_result is None:
+				result.add_failure(index, errors[endpoint].__class__.__name__)
+				continue
+			result.add_timing(wp_result.elapsed)
+			if wp_result.status in (404, 410):
+				result.add_failure(index, "Expired")
+		return result
+
+
+class WebPushDevice(Device):
+	device_id = models.UUIDField(
+		verbose_name=_("Device ID"), blank=True, null=True, db_index=True,
+		help_text=_("UUID of the browser installation")
+	)
+	registration_id = RegistrationIDField(verbose_name=_("Endpoint"))
+	registration_id_hash = RegistrationIDHashField(unique=True, null=True)
+	p256dh = models.CharField(
+		verbose_name=_("Public key"), max_length=88,
+		help_text=_("The p256dh key of the subscription, base64url encoded")
+	)
+	auth = models.CharField(
+		verbose_name=_("Auth secret"), max_length=24,
+		help_text=_("The auth key of the subscription, base64url encoded")
+	)
+
+	objects = WebPushDeviceManager()
+
+	class Meta:
+		verbose_name = _("WebPush device")
+
+	def send_message(self, message, **kwargs):
+		from .webpush import webpush_send_message
+
+		return webpush_send_message(self.registration_id, self.p256dh, self.auth, message, **kwargs)
+
+
+class PushJob(models.Model):
+	"""
+	A job of the asynchronous sending pipeline, see DatabaseBroker.
+	"""
+	payload = models.TextField()
+	available_at = models.DateTimeField(db_index=True)
+
+	class Meta:
+		verbose_name = _("Push job")
+
+
 # This is an APNS-only function right now, but maybe GCM will implement it
 # in the future.  But the definition of 'expired' may not be the same. Whatevs
 def get_expired_tokens(cerfile=None):
 	from .apns import apns_fetch_inactive_ids
 	return apns_fetch_inactive_ids(cerfile)
+
+
+def deactivate_devices(queryset, registration_ids, sender, batch_size=1000, dry_run=False):
+	"""
+	Deactivates the active devices of the queryset with the given registration ids,
+	in batches of `batch_size` ids: a SELECT and a single UPDATE per batch, rather
+	than a query with every id and an UPDATE per device.
+	Sends devices_deactivated, with `sender`, per batch.
+
+	Yields the registration ids of the devices deactivated by every batch, or
+	that would be with `dry_run`.
+	"""
+	from .signals import devices_deactivated
+
+	registration_ids = sorted(set(force_text(registration_id) for registration_id in registration_ids))
+	for i in range(0, len(registration_ids), batch_size):
+		devices = queryset.filter(registration_id__in=registration_ids[i:i + batch_size], active=True)
+		matched = list(devices.values_list("registration_id", flat=True))
+		if matched and not dry_run:
+			queryset.model.objects.filter(registration_id__in=matched).update(active=False)
+			devices_deactivated.send(sender=sender, registration_ids=matched)
+		yield matched
+
+
+# The outcome of a send to one device, `error` is None on success
+DeviceSendResult = namedtuple("DeviceSendResult", ("platform", "device_id", "registration_id", "error"))
+
+
+def _run_concurrently(funcs):
+	"""
+	Calls every function in its own thread. Returns their return values, or the
+	exceptions they raised, in order.
+	"""
+	results = [None] * len(funcs)
+
+	def run(index, func):
+		try:
+			results[index] = func()
+		except Exception as e:
+			results[index] = e
+		finally:
+			connections.close_all()
+
+	threads = [threading.Thread(target=run, args=(i, func)) for i, func in enumerate(funcs)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return results
+
+
+def _collect_errors(kwargs):
+	"""
+	Returns ({registration_id: error}, kwargs): the copy of kwargs has an on_error
+	callback filling the errors, which calls the on_error of kwargs, if any, too.
+	"""
+	errors = {}
+	kwargs = dict(kwargs)
+	callback = kwargs.pop("on_error", None)
+
+	def on_error(registration_id, error):
+		errors[registration_id] = error
+		if callback is not None:
+			callback(registration_id, error)
+
+	kwargs["on_error"] = on_error
+	return errors, kwargs
+
+
+def _gcm_fan_out(devices, message, title, extra, kwargs):
+	from .gcm import send_bulk_message
+
+	results = []
+	for cloud_type in ("GCM", "FCM"):
+		cloud_devices = [(pk, reg_id) for pk, reg_id, type_ in devices if type_ == cloud_type]
+		if not cloud_devices:
+			continue
+		data_payload, notification_payload = _cm_build_payloads(message, title, extra, cloud_type)
+		# Every chunk is sent, and the failed devices are reported one by one
+		errors, send_kwargs = _collect_errors(kwargs)
+		try:
+			send_bulk_message(
+				registration_ids=[reg_id for pk, reg_id in cloud_devices],
+				data_payload=data_payload,
+				notification_payload=notification_payload,
+				cloud_type=cloud_type,
+				**send_kwargs
+			)
+		except Exception as e:
+			results += [DeviceSendResult("gcm", pk, reg_id, e) for pk, reg_id in cloud_devices]
+			continue
+
+		results += [DeviceSendResult("gcm", pk, reg_id, errors.get(reg_id)) for pk, reg_id in cloud_devices]
+	return results
+
+
+def _apns_fan_out(devices, message, kwargs):
+	from .apns import apns_send_bulk_message
+
+	error = None
+	try:
+		apns_send_bulk_message(registration_ids=[reg_id for pk, reg_id in devices], alert=message, **kwargs)
+	except Exception as e:
+		error = e
+	return [DeviceSendResult("apns", pk, reg_id, error) for pk, reg_id in devices]
+
+
+def _wns_fan_out(devices, message, kwargs):
+	from .wns import wns_send_bulk_message
+
+	errors, kwargs = _collect_errors(kwargs)
+	try:
+		results = wns_send_bulk_message(uri_list=[reg_id for pk, reg_id in devices], message=message, **kwargs)
+	except Exception as e:
+		return [DeviceSendResult("wns", pk, reg_id, e) for pk, reg_id in devices]
+
+	statuses = dict((result.uri, result.status) for result in results)
+	return [
+		DeviceSendResult("wns", pk, reg_id, errors.get(
+			reg_id, statuses.get(reg_id) if statuses.get(reg_id) in WNS_FAILED_STATUSES else None
+		))
+		for pk, reg_id in devices
+	]
+
+
+def _webpush_fan_out(devices, message, kwargs):
+	from .webpush import webpush_send_bulk_message
+
+	errors, kwargs = _collect_errors(kwargs)
+	try:
+		wp_results = webpush_send_bulk_message(
+			[(reg_id, p256dh, auth) for pk, reg_id, p256dh, auth in devices], message, **kwargs
+		)
+	except Exception as e:
+		return [DeviceSendResult("webpush", pk, reg_id, e) for pk, reg_id, p256dh, auth in devices]
+
+	results = []
+	for (pk, reg_id, p256dh, auth), wp_result in zip(devices, wp_results):
+		error = errors.get(reg_id)
+		if wp_result is not None and wp_result.status in (404, 410):
+			error = "Expired"
+		results.append(DeviceSendResult("webpush", pk, reg_id, error))
+	return results
+
+
+def send_to_users(
+	user_ids, message, title=None, extra=None, gcm_kwargs=None, apns_kwargs=None, wns_kwargs=None,
+	webpush_kwargs=None, concurrent=True
+):
+	"""
+	Sends a notification to all the active GCM/FCM, APNS, WNS and WebPush devices
+	of the given users. Devices are fetched with one query per device table, then
+	the platforms are sent to concurrently, each in its own thread.
+
+	`title` is only used by FCM. `extra` is sent as GCM/FCM data and APNS extra,
+	and WebPush devices are sent it as JSON, with the message as "message".
+	Platform specific keyword arguments are passed with `gcm_kwargs` (e.g.
+	collapse_key), `apns_kwargs` (e.g. badge, sound), `wns_kwargs` and
+	`webpush_kwargs` (e.g. ttl, urgency).
+
+	Every device is sent to: the failed devices are reported with their error
+	code or exception. A failing platform doesn't stop the others: its exception
+	is reported as the error of each of its devices.
+
+	:return: list of DeviceSendResult
+	"""
+	user_ids = list(user_ids)
+	extra = extra or {}
+	gcm_devices = list(GCMDevice.objects.filter(user_id__in=user_ids, active=True).values_list(
+		"pk", "registration_id", "cloud_message_type"
+	))
+	apns_devices = list(APNSDevice.objects.filter(user_id__in=user_ids, active=True).values_list(
+		"pk", "registration_id"
+	))
+	wns_devices = list(WNSDevice.objects.filter(user_id__in=user_ids, active=True).values_list(
+		"pk", "registration_id"
+	))
+	webpush_devices = list(WebPushDevice.objects.filter(user_id__in=user_ids, active=True).values_list(
+		"pk", "registration_id", "p256dh", "auth"
+	))
+
+	funcs = []
+	if gcm_devices:
+		funcs.append(lambda: _gcm_fan_out(gcm_devices, message, title, extra, gcm_kwargs or {}))
+	if apns_devices:
+		apns_kwargs = dict(apns_kwargs or {})
+		if extra:
+			apns_kwargs.setdefault("extra", extra)
+		funcs.append(lambda: _apns_fan_out(apns_devices, message, apns_kwargs))
+	if wns_devices:
+		funcs.append(lambda: _wns_fan_out(wns_devices, message, wns_kwargs or {}))
+	if webpush_devices:
+		webpush_message = dict(extra, message=message) if extra else message
+		funcs.append(lambda: _webpush_fan_out(webpush_devices, webpush_message, webpush_kwargs or {}))
+
+	if concurrent and len(funcs) > 1:
+		platform_results = _run_concurrently(funcs)
+	else:
+		platform_results = [func() for func in funcs]
+
+	results = []
+	for platform_result in platform_results:
+		if isinstance(platform_result, Exception):
+			raise platform_result
+		results += platform_result
+	return results
@@ -0,0 +1,476 @@
+"""
+Asynchronous sending pipeline.
+
+When ``QUEUE_BROKER`` is set, the querysets' send_message() don't send anything:
+they enqueue a compact job holding the audience and the payload, and return
+immediately. The audience is stored as the filter of the queryset and the range
+of primary keys of its active devices, read with one aggregate query, or as the
+ranges of consecutive primary keys of the active devices when the filter can't
+be stored as JSON. The ``push_worker`` management command consumes the jobs:
+it splits the audience in jobs of ``QUEUE_CONCURRENCY`` chunks of ``QUEUE_CHUNK_SIZE`` devices, sends the chunks
+of each job on ``QUEUE_CONCURRENCY`` threads per platform, and retries failed devices up to
+``QUEUE_MAX_RETRIES`` times.
+
+Jobs are JSON documents, so the arguments of send_message() must be JSON
+serializable (e.g. the APNS badge can't be a function). Nothing read from the
+broker is unpickled or evaluated.
+"""
+
+import heapq
+import itertools
+import json
+import threading
+import uuid
+from datetime import timedelta
+from time import sleep, time
+from timeit import default_timer
+from django.apps import apps
+from django.db.models import Max, Min
+from django.db.models.expressions import Col
+from django.db.models.lookups import Lookup
+from django.db.models.sql.where import AND, WhereNode
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from .signals import send_retried
+
+
+PLATFORMS = {
+	"gcmdevice": "gcm",
+	"apnsdevice": "apns",
+	"wnsdevice": "wns",
+	"webpushdevice": "webpush",
+}
+
+
+class BaseBroker(object):
+	"""
+	A queue of jobs. Dequeued jobs must be acked once processed.
+	"""
+
+	def enqueue(self, job, delay=0):
+		"""
+		Adds the job to the queue, to be dequeued in `delay` seconds at the earliest.
+		Returns the id of the job.
+		"""
+		raise NotImplementedError
+
+	def dequeue(self, timeout=None):
+		"""
+		Returns the next available (job_id, job), or None if there was none
+		within `timeout` seconds.
+		"""
+		raise NotImplementedError
+
+	def ack(self, job_id):
+		pass
+
+
+class LocalBroker(BaseBroker):
+	"""
+	An in-process broker, for tests and for running the worker in a thread.
+	"""
+
+	def __init__(self):
+		self._jobs = []
+		self._counter = itertools.count()
+		self._condition = threading.Condition()
+
+	def __len__(self):
+		return len(self._jobs)
+
+	def enqueue(self, job, delay=0):
+		job_id = next(self._counter)
+		with self._condition:
+			heapq.heappush(self._jobs, (default_timer() + delay, job_id, json.dumps(job)))
+			self._condition.notify()
+		return job_id
+
+	def dequeue(self, timeout=None):
+		deadline = None if timeout is None else default_timer() + timeout
+		with self._condition:
+			while True:
+				now = default_timer()
+				if self._jobs and self._jobs[0][0] <= now:
+					available_at, job_id, payload = heapq.heappop(self._jobs)
+					return job_id, json.loads(payload)
+				if deadline is not None and now >= deadline:
+					return None
+				waits = []
+				if deadline is not None:
+					waits.append(deadline - now)
+				if self._jobs:
+					waits.append(self._jobs[0][0] - now)
+				self._condition.wait(min(waits) if waits else None)
+
+
+class DatabaseBroker(BaseBroker):
+	"""
+	Stores the jobs in the PushJob table.
+
+	A dequeued job is hidden from the other workers for `visibility_timeout`
+	seconds. If it isn't acked by then, e.g. because its worker died, it is
+	dequeued again.
+	"""
+
+	def __init__(self, visibility_timeout=300, poll_interval=1):
+		self.visibility_timeout = visibility_timeout
+		self.poll_interval = poll_interval
+
+	def enqueue(self, job, delay=0):
+		from .models import PushJob
+
+		return PushJob.objects.create(
+			payload=json.dumps(job), available_at=timezone.now() + timedelta(seconds=delay)
+		).pk
+
+	def dequeue(self, timeout=None):
+		from .models import PushJob
+
+		deadline = None if timeout is None else default_timer() + timeout
+		while True:
+			now = timezone.now()
+			for pk, available_at in PushJob.objects.filter(available_at__lte=now).order_by(
+				"available_at", "pk"
+			).values_list("pk", "available_at")[:10]:
+				# Only one worker can move the job's available_at forward
+				claimed = PushJob.objects.filter(pk=pk, available_at=available_at).update(
+					available_at=now + timedelta(seconds=self.visibility_timeout)
+				)
+				if claimed:
+					return pk, json.loads(PushJob.objects.get(pk=pk).payload)
+			if deadline is not None and default_timer() >= deadline:
+				return None
+			sleep(self.poll_interval)
+
+	def ack(self, job_id):
+		from .models import PushJob
+
+		PushJob.objects.filter(pk=job_id).delete()
+
+
+class RedisBroker(BaseBroker):
+	"""
+	Stores the jobs in a Redis list, and the delayed ones in a sorted set.
+	Works with any client implementing the redis-py API.
+
+	Jobs are removed from Redis when dequeued: a job is lost if its worker dies.
+	"""
+
+	def __init__(self, url="redis://localhost:6379/0", key="push_notifications", client=None):
+		if client is None:
+			import redis
+			client = redis.StrictRedis.from_url(url)
+		self.client = client
+		self.key = key
+		self.delayed_key = key + ":delayed"
+
+	def enqueue(self, job, delay=0):
+		job_id = uuid.uuid4().hex
+		payload = json.dumps({"id": job_id, "job": job})
+		if delay:
+			self.client.zadd(self.delayed_key, {payload: time() + delay})
+		else:
+			self.client.lpush(self.key, payload)
+		return job_id
+
+	def _move_delayed(self):
+		for payload in self.client.zrangebyscore(self.delayed_key, 0, time()):
+			# Only one worker can remove the payload
+			if self.client.zrem(self.delayed_key, payload):
+				self.client.lpush(self.key, payload)
+
+	def dequeue(self, timeout=None):
+		deadline = None if timeout is None else default_timer() + timeout
+		while True:
+			self._move_delayed()
+			# Delayed jobs are moved at least every second
+			item = self.client.brpop(self.key, 1)
+			if item is not None:
+				data = json.loads(item[1].decode("utf-8") if isinstance(item[1], bytes) else item[1])
+				return data["id"], data["job"]
+			if deadline is not None and default_timer() >= deadline:
+				return None
+
+
+_broker = None
+
+
+def get_broker():
+	"""
+	Returns the broker configured by QUEUE_BROKER and QUEUE_BROKER_OPTIONS,
+	or None if the pipeline is disabled.
+	"""
+	global _broker
+	if SETTINGS["QUEUE_BROKER"] is None:
+		return None
+	if _broker is None:
+		_broker = import_string(SETTINGS["QUEUE_BROKER"])(**SETTINGS["QUEUE_BROKER_OPTIONS"])
+	return _broker
+
+
+def reset_broker():
+	global _broker
+	_broker = None
+
+
+def should_enqueue(kwargs):
+	"""
+	Pops the `enqueue` argument of send_message(), which defaults to True when
+	the pipeline is enabled.
+	"""
+	return kwargs.pop("enqueue", SETTINGS["QUEUE_BROKER"] is not None)
+
+
+def _filter_lookups(queryset):
+	"""
+	Returns the filter of the queryset as JSON {lookup: value}, or None when it
+	isn't a conjunction of lookups on the columns of the device table.
+	"""
+	query = queryset.query
+	if query.low_mark or query.high_mark is not None:
+		return None
+	lookups = {}
+	nodes = [query.where]
+	while nodes:
+		node = nodes.pop()
+		if node.connector != AND or node.negated:
+			return None
+		for child in node.children:
+			if isinstance(child, WhereNode):
+				nodes.append(child)
+				continue
+			if not isinstance(child, Lookup) or not isinstance(child.lhs, Col):
+				return None
+			if child.lhs.alias != queryset.model._meta.db_table:
+				# A column of a joined table
+				return None
+			key = "%s__%s" % (child.lhs.target.attname, child.lookup_name)
+			value = list(child.rhs) if isinstance(child.rhs, (list, tuple, set, frozenset)) else child.rhs
+			try:
+				if key in lookups or json.loads(json.dumps(value)) != value:
+					return None
+			except (TypeError, ValueError):
+				return None
+			lookups[key] = value
+	return lookups
+
+
+def _audience(queryset):
+	"""
+	Returns the audience of a job sending to the queryset: its filter and the
+	[start, stop] range of the primary keys of its active devices, read with one
+	aggregate query. The devices are then read page by page by the worker.
+
+	The filters which can't be stored as JSON lookups (joins, subqueries, "or",
+	exclude(), values which aren't JSON) are stored as the pk_runs of the audience.
+	"""
+	lookups = _filter_lookups(queryset)
+	if lookups is None:
+		return {"pk_runs": _pk_runs(queryset)}
+	bounds = queryset.filter(active=True).aggregate(start=Min("pk"), stop=Max("pk"))
+	if bounds["start"] is None:
+		return {"filter": lookups, "pk_range": [0, 0]}
+	return {"filter": lookups, "pk_range": [bounds["start"], bounds["stop"] + 1]}
+
+
+def _pk_runs(queryset):
+	"""
+	Returns the primary keys of the active devices of the queryset as
+	[[start, stop], ...] runs of consecutive primary keys.
+	"""
+	runs = []
+	for pk in queryset.filter(active=True).order_by("pk").values_list("pk", flat=True).iterator():
+		if runs and runs[-1][1] == pk:
+			runs[-1][1] = pk + 1
+		else:
+			runs.append([pk, pk + 1])
+	return runs
+
+
+def _make_job(model, args, kwargs, **audience):
+	job = {
+		"model": "%s.%s" % (model._meta.app_label, model._meta.model_name),
+		"args": args,
+		"kwargs": kwargs,
+		"attempts": 0,
+	}
+	job.update(audience)
+	return job
+
+
+def enqueue(queryset, *args, **kwargs):
+	"""
+	Enqueues a job sending the message to the devices of the queryset.
+	The arguments are those of the queryset's send_message().
+
+	:return: the id of the job
+	"""
+	return get_broker().enqueue(_make_job(queryset.model, args, kwargs, **_audience(queryset)))
+
+
+def enqueue_prune(queryset, **kwargs):
+	"""
+	Enqueues a job probing the active devices of a GCMDevice or WNSDevice
+	queryset, and deactivating the dead ones, see probe.prune_probed_devices().
+
+	:return: the id of the job
+	"""
+	return get_broker().enqueue(_make_job(queryset.model, [], kwargs, task="prune", **_audience(queryset)))
+
+
+def enqueue_devices(model, pks, args, kwargs, delay=0):
+	"""
+	Enqueues a job sending the message to the devices with the given pks, in
+	`delay` seconds at the earliest.
+
+	:return: the id of the job
+	"""
+	return get_broker().enqueue(_make_job(model, args, kwargs, pks=pks), delay=delay)
+
+
+# Jobs of devices enqueued per job reading the audience of a filter
+DISPATCH_BATCHES = 100
+
+
+def _dispatch(broker, job, model, platform, batch_size):
+	"""
+	Splits the job of a whole audience in jobs of up to `batch_size` devices,
+	which are processed in about the time one chunk takes to send. A job is
+	then acked well within the visibility timeout of the DatabaseBroker, which
+	would otherwise hand a long broadcast to a second worker.
+
+	The devices of a filter are read DISPATCH_BATCHES jobs at a time, and the
+	rest of the range is enqueued as another job reading the filter.
+
+	:return: ([progress], 0)
+	"""
+	batch = dict(job)
+	for key in ("pk_runs", "filter", "pk_range"):
+		batch.pop(key, None)
+	limit = None
+	if "pk_runs" in job:
+		pks = [pk for start, stop in job["pk_runs"] for pk in range(start, stop)]
+	else:
+		start, stop = job["pk_range"]
+		limit = batch_size * DISPATCH_BATCHES
+		pks = list(model.objects.filter(**job["filter"]).filter(
+			active=True, pk__gte=start, pk__lt=stop
+		).order_by("pk").values_list("pk", flat=True)[:limit])
+
+	for i in range(0, len(pks), batch_size):
+		broker.enqueue(dict(batch, pks=pks[i:i + batch_size]))
+	rest = None
+	if len(pks) == limit:
+		rest = broker.enqueue(dict(job, pk_range=[pks[-1] + 1, job["pk_range"][1]]))
+	progress = "%s: %d devices split in %d jobs" % (platform, len(pks), -(-len(pks) // batch_size))
+	if rest is not None:
+		progress += ", the next devices are read by job %s" % (rest)
+	return [progress], 0
+
+
+def _process_prune(model, chunks, platform, concurrency, kwargs):
+	"""
+	Probes the devices of a prune job chunk by chunk, see enqueue_prune().
+
+	:return: ([progress of every chunk], number of chunks with failed probes)
+	"""
+	from .probe import prune_probed_devices
+
+	progress, failed_chunks = [], 0
+	for i, chunk in enumerate(chunks):
+		deactivated, errors = prune_probed_devices(
+			model.objects.filter(pk__in=chunk), concurrency=concurrency, **kwargs
+		)
+		progress.append("%s prune chunk %d/%d: %d devices deactivated, %d probes failed%s" % (
+			platform, i + 1, len(chunks), deactivated, len(errors), " (%r)" % (errors[0]) if errors else ""
+		))
+		failed_chunks += bool(errors)
+	return progress, failed_chunks
+
+
+# Platforms whose send_message() takes raise_errors and reports the failed devices
+PER_DEVICE_RESULTS = ("gcm", "wns", "webpush")
+
+# Errors that fail again however many times they are retried
+PERMANENT_ERRORS = (
+	"NotRegistered", "InvalidRegistration", "MissingRegistration", "MismatchSenderId",
+	"MessageTooBig", "InvalidDataKey", "InvalidTtl", "InvalidPackageName", "Expired",
+)
+
+
+def process_job(broker, job):
+	"""
+	Sends the message of the job to its audience, in chunks of QUEUE_CHUNK_SIZE
+	devices, on up to QUEUE_CONCURRENCY[platform] threads. The job of a whole
+	audience is first split in jobs of QUEUE_CONCURRENCY[platform] chunks.
+
+	The devices which failed with a transient error are enqueued again, with an
+	exponential delay, up to QUEUE_MAX_RETRIES times. The devices of a chunk
+	which raised are all enqueued again: this only happens on APNS, which reports
+	no per-device results, or when sending the chunk failed as a whole.
+
+	:return: (list of BroadcastResult, number of chunks with retried devices)
+	"""
+	from .models import _run_concurrently
+
+	model = apps.get_model(job["model"])
+	chunk_size = SETTINGS["QUEUE_CHUNK_SIZE"]
+	platform = PLATFORMS.get(model._meta.model_name, model._meta.model_name)
+	concurrency = SETTINGS["QUEUE_CONCURRENCY"].get(platform, 1)
+	if "pks" not in job:
+		# Prune jobs probe their chunks one after the other
+		return _dispatch(broker, job, model, platform, chunk_size * (1 if job.get("task") == "prune" else concurrency))
+
+	pks = job["pks"]
+	chunks = [pks[i:i + chunk_size] for i in range(0, len(pks), chunk_size)]
+	if job.get("task") == "prune":
+		return _process_prune(model, chunks, platform, concurrency, job["kwargs"])
+
+	kwargs = dict(job["kwargs"])
+	if platform in PER_DEVICE_RESULTS:
+		kwargs.setdefault("raise_errors", False)
+
+	def retry(pks, error):
+		if job["attempts"] >= SETTINGS["QUEUE_MAX_RETRIES"]:
+			return
+		retry = dict(job, pks=pks, attempts=job["attempts"] + 1)
+		retry.pop("pk_runs", None)
+		delay = SETTINGS["QUEUE_RETRY_DELAY"] * 2 ** job["attempts"]
+		broker.enqueue(retry, delay=delay)
+		send_retried.send(sender=platform.upper(), attempt=retry["attempts"], delay=delay, error=error)
+
+	def send_chunk(chunk):
+		try:
+			result = model.objects.filter(pk__in=chunk).send_message(*job["args"], enqueue=False, **kwargs)
+		except Exception as e:
+			retry(chunk, e)
+			return None, True
+
+		failures = dict(
+			(registration_id, error) for registration_id, error in result.failures()
+			if error not in PERMANENT_ERRORS
+		)
+		if not failures:
+			return result, False
+		# Devices deactivated while sending aren't retried
+		failed_pks = list(model.objects.filter(
+			pk__in=chunk, registration_id__in=list(failures), active=True
+		).order_by("pk").values_list("pk", flat=True))
+		if failed_pks:
+			retry(failed_pks, next(iter(failures.values())))
+		return result, bool(failed_pks)
+
+	def send_chunks(chunks):
+		return [send_chunk(chunk) for chunk in chunks]
+
+	groups = [chunks[i::concurrency] for i in range(min(concurrency, len(chunks)))]
+	if len(groups) > 1:
+		group_results = _run_concurrently([lambda group=group: send_chunks(group) for group in groups])
+	else:
+		group_results = [send_chunks(group) for group in groups]
+
+	outcomes = [outcome for group in group_results for outcome in group]
+	results = [result for result, retried in outcomes if result is not None]
+	return results, len([retried for result, retried in outcomes if retried])
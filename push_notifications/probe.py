@@ -0,0 +1,143 @@
+"""
+Probing the registration ids of GCM/FCM and WNS devices, to deactivate the dead
+ones before a broadcast wastes capacity on them.
+
+GCM/FCM are probed with dry_run requests: the server validates up to
+GCM/FCM_MAX_RECIPIENTS registration ids per request, and delivers nothing.
+Registration ids answered with NotRegistered or InvalidRegistration are dead.
+
+WNS has no dry run: a channel is probed with an empty raw notification which
+WNS drops when the device is offline (X-WNS-Cache-Policy: no-cache), and apps
+without a raw notification handler ignore. Apps with one are woken up by the
+probe though, so WNS devices are only probed with wns_raw_probes=True.
+Channels answered with HTTP 404 or 410 are dead.
+"""
+
+import json
+
+from .models import _run_concurrently
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+
+DEAD_GCM_ERRORS = ("NotRegistered", "InvalidRegistration")
+DEAD_WNS_STATUSES = (404, 410)
+
+
+def _probe_cm_chunk(registration_ids, cloud_type):
+	from .gcm import _fcm_send, _gcm_send
+
+	payload = json.dumps(
+		{"registration_ids": registration_ids, "dry_run": True}, separators=(",", ":"), sort_keys=True
+	).encode("utf-8")
+	send = _gcm_send if cloud_type == "GCM" else _fcm_send
+	response = json.loads(send(payload, "application/json"))
+	return [
+		registration_ids[index] for index, result in enumerate(response["results"])
+		if result.get("error") in DEAD_GCM_ERRORS
+	]
+
+
+def _probe_wns_uri(uri, access_token):
+	from .wns import WNSNotificationResponseError, _wns_send
+
+	try:
+		_wns_send(
+			uri, b"", wns_type="wns/raw", extra_headers={"X-WNS-Cache-Policy": "no-cache"},
+			access_token=access_token
+		)
+	except WNSNotificationResponseError as e:
+		if e.status in DEAD_WNS_STATUSES:
+			return [uri]
+		raise
+	return []
+
+
+def _run_probes(probes, concurrency):
+	"""
+	Runs the probes on up to `concurrency` threads.
+
+	:return: (dead registration ids, exceptions raised by the probes)
+	"""
+	def run_group(group):
+		results = []
+		for probe in group:
+			try:
+				results.append(probe())
+			except Exception as e:
+				results.append(e)
+		return results
+
+	groups = [probes[i::concurrency] for i in range(min(concurrency, len(probes)))]
+	dead, errors = [], []
+	for results in _run_concurrently([lambda group=group: run_group(group) for group in groups]):
+		for result in results:
+			if isinstance(result, Exception):
+				errors.append(result)
+			else:
+				dead += result
+	return dead, errors
+
+
+def get_probe_audiences(queryset):
+	"""
+	Splits a GCMDevice or WNSDevice queryset by sender, as [(sender, queryset)].
+	"""
+	if queryset.model._meta.model_name == "gcmdevice":
+		return [(cloud_type, queryset.filter(cloud_message_type=cloud_type)) for cloud_type in ("GCM", "FCM")]
+	return [("WNS", queryset)]
+
+
+def probe_devices(queryset, concurrency=8, wns_raw_probes=False):
+	"""
+	Probes the active devices of a GCMDevice or WNSDevice queryset, without
+	deactivating any, see models.deactivate_devices().
+
+	:param wns_raw_probes: bool: Whether WNS devices may be sent the raw
+		notifications probing them, which wake up the apps handling raw notifications.
+	:return: (dead registration ids, exceptions raised by the failed probes)
+	"""
+	model_name = queryset.model._meta.model_name
+	devices = queryset.filter(active=True).order_by()
+	if model_name == "gcmdevice":
+		probes = []
+		for cloud_type in ("GCM", "FCM"):
+			registration_ids = list(
+				devices.filter(cloud_message_type=cloud_type).values_list("registration_id", flat=True)
+			)
+			max_recipients = SETTINGS["%s_MAX_RECIPIENTS" % (cloud_type)]
+			probes += [
+				lambda chunk=registration_ids[i:i + max_recipients], cloud_type=cloud_type: _probe_cm_chunk(chunk, cloud_type)
+				for i in range(0, len(registration_ids), max_recipients)
+			]
+	elif model_name == "wnsdevice":
+		if not wns_raw_probes:
+			raise ValueError(
+				"WNS devices are probed with raw notifications which wake up their apps, pass wns_raw_probes=True"
+			)
+		from .wns import _wns_authenticate
+
+		uris = list(devices.values_list("registration_id", flat=True))
+		# One access token for every probe, rather than an OAuth request per channel
+		access_token = _wns_authenticate() if uris else None
+		probes = [lambda uri=uri: _probe_wns_uri(uri, access_token) for uri in uris]
+	else:
+		raise ValueError("Only GCM/FCM and WNS devices can be probed, not %s" % (queryset.model.__name__))
+	return _run_probes(probes, concurrency)
+
+
+def prune_probed_devices(queryset, concurrency=8, wns_raw_probes=False):
+	"""
+	Probes the active devices of a GCMDevice or WNSDevice queryset, and
+	deactivates the dead ones, see probe_devices().
+
+	:return: (number of deactivated devices, exceptions raised by the failed probes)
+	"""
+	from .models import deactivate_devices
+
+	deactivated, errors = 0, []
+	for sender, devices in get_probe_audiences(queryset):
+		dead, probe_errors = probe_devices(devices, concurrency=concurrency, wns_raw_probes=wns_raw_probes)
+		errors += probe_errors
+		for registration_ids in deactivate_devices(devices, dead, sender):
+			deactivated += len(registration_ids)
+	return deactivated, errors
@@ -0,0 +1,146 @@
+"""
+Client side rate limiting of the requests sent to GCM, FCM, APNS and WNS.
+
+Limits are configured in RATE_LIMITS, by provider or by provider and
+credential (the API key, APNS certificate file or WNS package SID):
+
+	"RATE_LIMITS": {
+		"FCM": {"rate": 500, "burst": 1000},
+		"APNS:/etc/certs/other_app.pem": {"rate": 100},
+		"WNS": {"rate": 50, "cache": "default"},
+	}
+
+`rate` is the amount of requests per second, `burst` the amount of requests
+which can be sent at once after an idle period (defaults to `rate`). Limits are
+shared by the threads of a process, and by all the processes sharing the
+Django cache named by `cache`, if set.
+"""
+
+import hashlib
+import threading
+from time import sleep, time
+from timeit import default_timer
+from django.core.cache import caches
+
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+
+class TokenBucket(object):
+	"""
+	A thread-safe token bucket, refilled with `rate` tokens per second up to `burst`.
+	"""
+
+	def __init__(self, rate, burst=None):
+		self.rate = float(rate)
+		self.burst = float(burst or rate)
+		self._tokens = self.burst
+		self._updated = default_timer()
+		self._lock = threading.Lock()
+
+	def _reserve(self, tokens):
+		"""
+		Takes the tokens, and returns how long to wait before they are available.
+		"""
+		with self._lock:
+			now = default_timer()
+			self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+			self._updated = now
+			self._tokens -= tokens
+			if self._tokens >= 0:
+				return 0
+			return -self._tokens / self.rate
+
+	def acquire(self, tokens=1):
+		"""
+		Blocks until the tokens are available. Returns the time waited, in seconds.
+		"""
+		wait = self._reserve(tokens)
+		if wait:
+			sleep(wait)
+		return wait
+
+
+class CacheTokenBucket(TokenBucket):
+	"""
+	A token bucket shared through a Django cache. The bucket is stored as
+	(tokens, last update) under `key`, and updated while holding a lock taken
+	with the atomic cache.add() (e.g. memcached, Redis, database caches).
+	"""
+
+	# Seconds after which the lock of a crashed process is released
+	lock_timeout = 1
+
+	def __init__(self, rate, burst=None, cache="default", key="push_notifications:ratelimit"):
+		self.rate = float(rate)
+		self.burst = float(burst or rate)
+		self.cache = caches[cache]
+		self.key = key
+		self.lock_key = "%s:lock" % (key)
+
+	def _reserve(self, tokens):
+		"""
+		Takes the tokens, and returns how long to wait before they are available.
+		"""
+		while not self.cache.add(self.lock_key, 1, self.lock_timeout):
+			sleep(0.001)
+		try:
+			now = time()
+			available, updated = self.cache.get(self.key, (self.burst, now))
+			available = min(self.burst, available + (now - updated) * self.rate) - tokens
+			# Once expired, the bucket is full again
+			self.cache.set(self.key, (available, now), int((self.burst - available) / self.rate) + 1)
+		finally:
+			self.cache.delete(self.lock_key)
+		if available >= 0:
+			return 0
+		return -available / self.rate
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def _make_key(name):
+	# The credential may be an API key, which must not end up in cache keys
+	provider, sep, credential = name.partition(":")
+	if not credential:
+		return provider
+	return "%s:%s" % (provider, hashlib.sha256(credential.encode("utf-8")).hexdigest())
+
+
+def get_bucket(provider, credential=None):
+	"""
+	Returns the bucket limiting the requests sent to the provider with the
+	credential, or None if they aren't limited.
+	"""
+	names = ["%s:%s" % (provider, credential), provider] if credential else [provider]
+	for name in names:
+		if name in SETTINGS["RATE_LIMITS"]:
+			break
+	else:
+		return None
+
+	key = _make_key(name)
+	with _buckets_lock:
+		if key not in _buckets:
+			options = dict(SETTINGS["RATE_LIMITS"][name])
+			if options.get("cache"):
+				_buckets[key] = CacheTokenBucket(key="push_notifications:ratelimit:%s" % (key), **options)
+			else:
+				options.pop("cache", None)
+				_buckets[key] = TokenBucket(**options)
+		return _buckets[key]
+
+
+def reset_buckets():
+	with _buckets_lock:
+		_buckets.clear()
+
+
+def throttle(provider, credential=None):
+	"""
+	Blocks until a request can be sent to the provider with the credential.
+	"""
+	bucket = get_bucket(provider, credential)
+	if bucket is not None:
+		bucket.acquire()
@@ -0,0 +1,113 @@
+"""
+Results of notifications sent to many devices at once.
+"""
+
+from array import array
+from bisect import bisect_right
+from collections import Counter
+
+
+class BroadcastResult(object):
+	"""
+	The outcome of sending a notification to the devices of one platform, as
+	returned by the querysets' send_message().
+
+	Recipients are registered in the order they are sent to. To keep large
+	broadcasts cheap, only failures are stored, in compact arrays: the index of
+	the failed recipient and the index of its error in `errors`.
+	Timings are stored per chunk (GCM/FCM), connection (APNS) or request (WNS).
+	"""
+
+	def __init__(self, platform):
+		self.platform = platform
+		self.total = 0
+		# Recipients not sent to, as they were already sent the same dedup_key
+		self.skipped = 0
+		self.errors = []
+		self.timings = array("d")
+		self._error_codes = {}
+		self._failed_indexes = array("L")
+		self._failed_codes = array("H")
+		self._offsets = []
+		self._recipients = []
+
+	def __repr__(self):
+		return "<%s: %s>" % (self.__class__.__name__, self)
+
+	def __str__(self):
+		return "%s: %i sent, %i failed" % (self.platform, self.success, self.failure)
+
+	def add_recipients(self, registration_ids):
+		"""
+		Registers the next recipients. Returns the index of the first one.
+		"""
+		offset = self.total
+		self._offsets.append(offset)
+		self._recipients.append(registration_ids)
+		self.total += len(registration_ids)
+		return offset
+
+	def add_failure(self, index, error):
+		code = self._error_codes.get(error)
+		if code is None:
+			code = self._error_codes[error] = len(self.errors)
+			self.errors.append(error)
+		self._failed_indexes.append(index)
+		self._failed_codes.append(code)
+
+	def add_timing(self, elapsed):
+		self.timings.append(elapsed)
+
+	def merge(self, other):
+		"""
+		Appends the recipients, failures and timings of another result of the same
+		platform, e.g. the result of another shard of the broadcast.
+		"""
+		offset = self.total
+		self._offsets.extend(offset + o for o in other._offsets)
+		self._recipients.extend(other._recipients)
+		self.total += other.total
+		self.skipped += other.skipped
+		self.timings.extend(other.timings)
+		for index, code in zip(other._failed_indexes, other._failed_codes):
+			self.add_failure(offset + index, other.errors[code])
+		return self
+
+	def compact(self):
+		"""
+		Drops the registration ids of the recipients which did not fail, to send
+		the result to another process cheaply.
+		"""
+		failed = sorted(set(self._failed_indexes))
+		recipients = [[self.get_registration_id(index)] for index in failed]
+		# Every failed recipient becomes a range of its own
+		self._offsets, self._recipients = failed, recipients
+		return self
+
+	def get_registration_id(self, index):
+		i = bisect_right(self._offsets, index) - 1
+		return self._recipients[i][index - self._offsets[i]]
+
+	@property
+	def failure(self):
+		return len(self._failed_indexes)
+
+	@property
+	def success(self):
+		return self.total - self.failure
+
+	@property
+	def elapsed(self):
+		""" Total time spent sending, in seconds """
+		return sum(self.timings)
+
+	@property
+	def error_counts(self):
+		return Counter(self.errors[code] for code in self._failed_codes)
+
+	def failures(self):
+		"""
+		Yields the (registration_id, error) of every failed recipient.
+		"""
+		for index, code in zip(self._failed_indexes, self._failed_codes):
+			yield self.get_registration_id(index), self.errors[code]
@@ -0,0 +1,108 @@
+"""
+Scheduled and staggered broadcasts, on top of the asynchronous pipeline.
+
+The querysets' schedule_message() split the audience in chunks of
+QUEUE_CHUNK_SIZE devices when called, and enqueue each chunk with the delay
+after which it is released to the push_worker command. With a persistent
+broker (DatabaseBroker, RedisBroker) the schedule survives worker restarts.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+from .pipeline import enqueue_devices, get_broker
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+
+def _next_local_time(start, local_time, tz):
+	"""
+	Returns the first datetime at `local_time` in the time zone `tz`, from `start` on.
+	"""
+	day = start.astimezone(tz).date()
+	for days in (0, 1):
+		send_at = tz.normalize(tz.localize(datetime.combine(day + timedelta(days=days), local_time)))
+		if send_at >= start:
+			return send_at
+
+
+def _get_timezone(name):
+	import pytz
+
+	try:
+		return pytz.timezone(name)
+	except (pytz.UnknownTimeZoneError, AttributeError):
+		return timezone.get_default_timezone()
+
+
+def schedule(queryset, args, kwargs, start=None, window=None, local_time=None, timezone_field=None):
+	"""
+	Schedules sending the message to the active devices of the queryset.
+
+	:param args: list: The positional arguments of send_message()
+	:param kwargs: dict: The keyword arguments of send_message()
+	:param start: datetime: When to start sending. Defaults to now.
+	:param window: timedelta: Spreads the chunks evenly over the window, from the send time on.
+	:param local_time: time: Sends at this time of the day in the time zone of each device.
+	:param timezone_field: str: The field holding the time zone name of a device, e.g.
+	"user__profile__timezone". Devices without a valid time zone use TIME_ZONE.
+	:return: list of (datetime, job id) of the chunks, in the order they are sent
+	"""
+	if get_broker() is None:
+		raise ImproperlyConfigured(
+			'You need to set PUSH_NOTIFICATIONS_SETTINGS["QUEUE_BROKER"] to schedule messages.'
+		)
+	if local_time is not None and timezone_field is None:
+		raise ValueError("local_time requires a timezone_field.")
+	if local_time is not None:
+		# Only required to schedule at local times, Django < 1.11 doesn't depend on it
+		try:
+			import pytz  # noqa
+		except ImportError:
+			raise ImproperlyConfigured("Scheduling at a local_time requires pytz.")
+
+	now = datetime.now(timezone.utc)
+	if start is None:
+		start = now
+	elif timezone.is_naive(start):
+		start = timezone.make_aware(start, timezone.get_default_timezone())
+
+	# Bucket the devices by send time
+	queryset = queryset.filter(active=True).order_by("pk")
+	buckets = defaultdict(list)
+	if local_time is None:
+		buckets[start] = list(queryset.values_list("pk", flat=True))
+	else:
+		send_times = {}
+		for pk, tz_name in queryset.values_list("pk", timezone_field):
+			if tz_name not in send_times:
+				send_times[tz_name] = _next_local_time(start, local_time, _get_timezone(tz_name))
+			buckets[send_times[tz_name]].append(pk)
+
+	chunk_size = SETTINGS["QUEUE_CHUNK_SIZE"]
+	scheduled = []
+	for send_at, pks in buckets.items():
+		chunks = [pks[i:i + chunk_size] for i in range(0, len(pks), chunk_size)]
+		for i, chunk in enumerate(chunks):
+			chunk_send_at = send_at + window * i // len(chunks) if window else send_at
+			delay = max(0, (chunk_send_at - now).total_seconds())
+			scheduled.append((chunk_send_at, enqueue_devices(queryset.model, chunk, args, kwargs, delay=delay)))
+
+	return sorted(scheduled, key=lambda item: item[0])
+
+
+class ScheduledSendQuerySetMixin(object):
+	def schedule_message(self, *args, **kwargs):
+		"""
+		Sends the message later, through the asynchronous pipeline.
+		Takes the arguments of send_message(), and the `start`, `window`,
+		`local_time` and `timezone_field` arguments of scheduling.schedule().
+
+		:return: list of (datetime, job id)
+		"""
+		options = dict(
+			(name, kwargs.pop(name)) for name in ("start", "window", "local_time", "timezone_field")
+			if name in kwargs
+		)
+		return schedule(self, args, kwargs, **options)
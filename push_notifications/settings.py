@@ -12,6 +12,10 @@ PUSH_NOTIFICATIONS_SETTINGS.setdefault("FCM_POST_URL", "https://fcm.googleapis.c
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("FCM_MAX_RECIPIENTS", 1000)
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("FCM_ERROR_TIMEOUT", None)
 
+# Micro-batching of single GCM/FCM sends, see batching.py
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("CM_BATCH_WINDOW", None)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("CM_BATCH_SIZE", 100)
+
 # APNS
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("APNS_PORT", 2195)
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("APNS_FEEDBACK_PORT", 2196)
@@ -29,8 +33,39 @@ PUSH_NOTIFICATIONS_SETTINGS.setdefault("WNS_PACKAGE_SECURITY_ID", None)
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("WNS_SECRET_KEY", None)
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("WNS_ACCESS_URL", "https://login.live.com/accesstoken.srf")
 
+# WebPush
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_PRIVATE_KEY", None)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_CLAIMS", {})
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_JWT_EXPIRATION", 12 * 3600)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_TTL", 86400)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_MAX_WORKERS", 16)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_ERROR_TIMEOUT", None)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_SHARED_SERVER_KEY", False)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_ENCRYPTION_PROCESSES", 0)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_ENCRYPTION_BATCH_SIZE", 1000)
+
 # User model
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("USER_MODEL", settings.AUTH_USER_MODEL)
 
 # API endpoint settings
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("UPDATE_ON_DUPLICATE_REG_ID", False)
+
+# Asynchronous sending pipeline
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("QUEUE_BROKER", None)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("QUEUE_BROKER_OPTIONS", {})
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("QUEUE_CHUNK_SIZE", 1000)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("QUEUE_CONCURRENCY", {"gcm": 4, "apns": 1, "wns": 8, "webpush": 1})
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("QUEUE_MAX_RETRIES", 3)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("QUEUE_RETRY_DELAY", 30)
+
+# Broadcasts sharded over a pool of processes, see sharding.py
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("SHARD_PROCESSES", None)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("SHARDS_PER_PROCESS", 4)
+
+# Deduplication of bulk sends
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("DEDUP_CACHE", None)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("DEDUP_MAX_SIZE", 100000)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("DEDUP_TTL", 86400)
+
+# Client side rate limiting, see ratelimit.py
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("RATE_LIMITS", {})
@@ -0,0 +1,140 @@
+"""
+Broadcasts sharded over a pool of processes.
+
+A single process is bound by JSON encoding, TLS and response parsing well
+before the network is. The querysets' send_message_sharded() split the active
+devices in ranges of primary keys, and send every range from a worker process,
+which reads the devices of the range itself. The results of the ranges are
+merged in the parent.
+
+The workers are forked: each one sets the database connections inherited from
+the parent aside and opens its own, leaving the parent's untouched. As the
+workers don't see the uncommitted changes of the parent, nor take part in its
+transaction, sharded sends refuse to run within atomic(). Deduplication needs a
+shared DEDUP_CACHE, and `on_error` callbacks are called in the workers.
+"""
+
+import multiprocessing
+from django.apps import apps
+from django.db import connections
+from django.db.transaction import TransactionManagementError
+from django.db.models import Max, Min
+
+from .pipeline import PLATFORMS, _make_job
+from .results import BroadcastResult
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+
+def _pk_ranges(queryset, shards):
+	"""
+	Splits the primary keys of the active devices in up to `shards` ranges of
+	the same width, as [(start, stop), ...].
+	"""
+	bounds = queryset.filter(active=True).aggregate(low=Min("pk"), high=Max("pk"))
+	if bounds["low"] is None:
+		return []
+	low, high = bounds["low"], bounds["high"] + 1
+	width = -(-(high - low) // shards)
+	return [(start, min(start + width, high)) for start in range(low, high, width)]
+
+
+# The database connections a forked worker inherited from the parent
+_inherited_connections = []
+
+
+def _is_in_memory(connection):
+	name = connection.settings_dict["NAME"]
+	return connection.vendor == "sqlite" and (name == ":memory:" or "mode=memory" in name)
+
+
+def _init_worker():
+	# Workers started with the "spawn" method import nothing from the parent
+	if not apps.ready:
+		import django
+		django.setup()
+
+	# An inherited connection shares its socket with the parent's: closing it
+	# would end the parent's session. It is kept aside, unused, and the worker
+	# opens its own. An in-memory SQLite database is the worker's own copy.
+	for connection in connections.all():
+		if connection.connection is not None and not _is_in_memory(connection):
+			_inherited_connections.append(connection.connection)
+			connection.connection = None
+
+
+def _send_shard(job):
+	"""
+	Sends the message to the devices of one range, in a worker process.
+
+	:return: (BroadcastResult, None), or (None, the exception raised)
+	"""
+	model = apps.get_model(job["model"])
+	queryset = model.objects.all()
+	queryset.query = job["query"]
+	start, stop = job["pk_range"]
+	try:
+		result = queryset.filter(pk__gte=start, pk__lt=stop).send_message(
+			*job["args"], enqueue=False, **job["kwargs"]
+		)
+	except Exception as e:
+		return None, e
+	return result.compact(), None
+
+
+def sharded_send(queryset, args, kwargs, processes=None, shards=None):
+	"""
+	Sends the message to the active devices of the queryset from a pool of
+	`processes` (SHARD_PROCESSES, or one per CPU) processes, in `shards`
+	(SHARDS_PER_PROCESS per process by default) ranges of primary keys.
+	More shards than processes even out sparse ranges.
+
+	By default, the first error raised by a shard is raised once every shard
+	was sent to, like the querysets' send_message(). Raises
+	TransactionManagementError within atomic(), e.g. with ATOMIC_REQUESTS.
+
+	:return: BroadcastResult, the merged results of the shards in primary key order
+	"""
+	if any(connection.in_atomic_block for connection in connections.all()):
+		raise TransactionManagementError(
+			"Sharded sends can't run within atomic(): the workers don't see its uncommitted changes"
+		)
+
+	model = queryset.model
+	processes = processes or SETTINGS["SHARD_PROCESSES"] or multiprocessing.cpu_count()
+	shards = shards or processes * SETTINGS["SHARDS_PER_PROCESS"]
+	result = BroadcastResult(PLATFORMS.get(model._meta.model_name, model._meta.model_name))
+
+	# The jobs only go through the pool's pipes, to the workers forked here
+	jobs = [
+		_make_job(model, args, kwargs, query=queryset.query, pk_range=r) for r in _pk_ranges(queryset, shards)
+	]
+	if not jobs:
+		return result
+
+	pool = multiprocessing.Pool(min(processes, len(jobs)), initializer=_init_worker)
+	try:
+		outcomes = pool.map(_send_shard, jobs, chunksize=1)
+	finally:
+		pool.terminate()
+		pool.join()
+
+	errors = [error for shard_result, error in outcomes if error is not None]
+	if errors:
+		raise errors[0]
+	for shard_result, error in outcomes:
+		result.merge(shard_result)
+	return result
+
+
+class ShardedSendQuerySetMixin(object):
+	def send_message_sharded(self, *args, **kwargs):
+		"""
+		Sends the message from a pool of processes, see sharding.sharded_send().
+		Takes the arguments of send_message(), and the `processes` and `shards`
+		arguments of sharded_send().
+
+		:return: BroadcastResult
+		"""
+		options = dict((name, kwargs.pop(name)) for name in ("processes", "shards") if name in kwargs)
+		kwargs.pop("enqueue", None)
+		return sharded_send(self, args, kwargs, **options)
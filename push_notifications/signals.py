@@ -0,0 +1,33 @@
+"""
+Signals sent along the send paths, for instrumentation. The sender is the
+provider: "GCM", "FCM", "APNS", "WNS" or "WEBPUSH". Sending a signal without
+receivers costs a single check, see metrics.py for StatsD and Prometheus receivers.
+"""
+
+from django.dispatch import Signal
+
+
+# Before a request to the provider (a GCM/FCM or WNS POST, or an APNS frame).
+# Arguments: url (None for APNS), bytes_sent
+request_started = Signal()
+
+# After a request to the provider.
+# Arguments: url, elapsed (seconds), error (the exception raised, or None)
+request_finished = Signal()
+
+# When a connection to the provider is opened (every GCM/FCM and WNS request,
+# every APNS socket), or reused (APNS frames written to an open socket).
+# Arguments: reused
+connection_opened = Signal()
+
+# When the asynchronous pipeline enqueues a failed chunk again.
+# Arguments: attempt, delay, error
+send_retried = Signal()
+
+# When devices are deactivated, as the provider reported them unregistered.
+# Arguments: registration_ids
+devices_deactivated = Signal()
+
+# When the registration id of a device is replaced by its canonical id.
+# Arguments: old_registration_id, new_registration_id
+registration_id_changed = Signal()
@@ -0,0 +1,469 @@
+"""
+Web Push
+Payloads are encrypted with aes128gcm (RFC 8291) and requests are signed with
+VAPID (RFC 8292). Requires the cryptography package.
+https://developer.mozilla.org/en-US/docs/Web/API/Push_API
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from binascii import hexlify
+from collections import namedtuple
+from timeit import default_timer
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import six
+from django.utils.six.moves import http_client
+from django.utils.six.moves.urllib.parse import urlsplit
+
+try:
+	from cryptography.hazmat.backends import default_backend
+	from cryptography.hazmat.primitives import hashes, serialization
+	from cryptography.hazmat.primitives.asymmetric import ec
+	from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+	from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+	ec = None
+
+from . import NotificationError
+from .ratelimit import throttle
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from .signals import connection_opened, devices_deactivated, request_finished, request_started
+
+
+# The record size, every payload fits in a single record
+RECORD_SIZE = 4096
+# The maximum payload size: the record size minus the padding delimiter and the AEAD tag
+MAX_PAYLOAD_SIZE = RECORD_SIZE - 1 - 16
+
+WebPushResult = namedtuple("WebPushResult", ("endpoint", "status", "elapsed"))
+
+
+class WebPushError(NotificationError):
+	pass
+
+
+def _b64url_encode(data):
+	return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64url_decode(data):
+	if isinstance(data, six.text_type):
+		data = data.encode("ascii")
+	return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+def _check_cryptography():
+	if ec is None:
+		raise ImproperlyConfigured("The cryptography package is required to send WebPush notifications.")
+
+
+def _hkdf(salt, info, length, key_material):
+	# HKDF (RFC 5869) over HMAC-SHA256, a single block is enough for every key derived here
+	prk = hmac.new(salt, key_material, hashlib.sha256).digest()
+	return hmac.new(prk, info + b"\x01", hashlib.sha256).digest()[:length]
+
+
+def _public_key_bytes(public_key):
+	# The uncompressed point, 65 bytes
+	return public_key.public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+
+
+def _int_to_bytes(value, length=32):
+	return bytes(bytearray.fromhex("%0*x" % (length * 2, value)))
+
+
+def _load_public_key(data):
+	return ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), data)
+
+
+class WebPushEncryptor(object):
+	"""
+	Encrypts one payload for many subscriptions with aes128gcm, see RFC 8291.
+
+	The padded plaintext is built once per message. With `server_key`, the
+	ephemeral key pair and the header it ends are also computed once per message,
+	which halves the elliptic curve work per subscription: every subscription
+	still gets its own salt, and its own keys as they are derived from its
+	public key and auth secret.
+	"""
+
+	CEK_INFO = b"Content-Encoding: aes128gcm\x00\x01"
+	NONCE_INFO = b"Content-Encoding: nonce\x00\x01"
+
+	def __init__(self, payload, server_key=None):
+		_check_cryptography()
+		if len(payload) > MAX_PAYLOAD_SIZE:
+			raise WebPushError("The payload cannot exceed %i bytes" % (MAX_PAYLOAD_SIZE))
+		self.payload = payload
+		# A single record, ended by the \x02 padding delimiter
+		self.plaintext = payload + b"\x02"
+		self.server_key = server_key
+		if server_key is not None:
+			self.server_public = _public_key_bytes(server_key.public_key())
+			self.header_tail = self._header_tail(self.server_public)
+
+	def _header_tail(self, server_public):
+		return struct.pack("!IB", RECORD_SIZE, len(server_public)) + server_public
+
+	def encrypt(self, p256dh, auth, salt=None):
+		"""
+		:param p256dh: str: The base64url encoded public key of the subscription.
+		:param auth: str: The base64url encoded auth secret of the subscription.
+		:param salt: bytes: 16 random bytes, generated if None.
+		:return: bytes: The request body
+		"""
+		salt = salt or os.urandom(16)
+		if self.server_key is not None:
+			server_key, server_public, header_tail = self.server_key, self.server_public, self.header_tail
+		else:
+			server_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+			server_public = _public_key_bytes(server_key.public_key())
+			header_tail = self._header_tail(server_public)
+		user_public = _b64url_decode(p256dh)
+
+		shared_secret = server_key.exchange(ec.ECDH(), _load_public_key(user_public))
+		ikm = _hkdf(_b64url_decode(auth), b"WebPush: info\x00" + user_public + server_public, 32, shared_secret)
+		# The content encryption key and the nonce share the extract step
+		prk = hmac.new(salt, ikm, hashlib.sha256).digest()
+		cek = hmac.new(prk, self.CEK_INFO, hashlib.sha256).digest()[:16]
+		nonce = hmac.new(prk, self.NONCE_INFO, hashlib.sha256).digest()[:12]
+		return salt + header_tail + AESGCM(cek).encrypt(nonce, self.plaintext, None)
+
+
+def encrypt(payload, p256dh, auth, salt=None, server_key=None):
+	"""
+	Encrypts the payload for the subscription keys with aes128gcm, see RFC 8291.
+
+	:param payload: bytes: The payload, up to MAX_PAYLOAD_SIZE bytes.
+	:param p256dh: str: The base64url encoded public key of the subscription.
+	:param auth: str: The base64url encoded auth secret of the subscription.
+	:param salt: bytes: 16 random bytes, generated if None.
+	:param server_key: EllipticCurvePrivateKey: The ephemeral key, generated if None.
+	:return: bytes: The request body
+	"""
+	return WebPushEncryptor(payload, server_key).encrypt(p256dh, auth, salt)
+
+
+def _encrypt_batch(args):
+	"""
+	Encrypts a batch of subscriptions in a worker process of the encryption pool.
+	Returns the request bodies, or the exceptions raised, in order.
+	"""
+	payload, server_key, subscriptions = args
+	if server_key is not None:
+		server_key = serialization.load_der_private_key(server_key, password=None, backend=default_backend())
+	encryptor = WebPushEncryptor(payload, server_key)
+	bodies = []
+	for endpoint, p256dh, auth in subscriptions:
+		try:
+			bodies.append(encryptor.encrypt(p256dh, auth))
+		except (TypeError, ValueError) as e:
+			bodies.append(e)
+	return bodies
+
+
+def _encrypt_in_processes(encryptor, batches, processes):
+	"""
+	Encrypts the batches of subscriptions on a pool of `processes` processes.
+	Yields the request bodies of every batch, in order, while the next batches
+	are still being encrypted.
+	"""
+	server_key = None
+	if encryptor.server_key is not None:
+		server_key = encryptor.server_key.private_bytes(
+			serialization.Encoding.DER, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+		)
+	pool = multiprocessing.Pool(processes)
+	try:
+		for bodies in pool.imap(_encrypt_batch, [(encryptor.payload, server_key, batch) for batch in batches]):
+			yield bodies
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+_private_key = None
+
+
+def get_vapid_private_key():
+	"""
+	Returns the key of WP_PRIVATE_KEY: a PEM encoded key, the path to one, or
+	the base64url encoded private number of the key.
+	"""
+	global _private_key
+	_check_cryptography()
+	if _private_key is None:
+		value = SETTINGS.get("WP_PRIVATE_KEY")
+		if not value:
+			raise ImproperlyConfigured(
+				'You need to set PUSH_NOTIFICATIONS_SETTINGS["WP_PRIVATE_KEY"] to send messages through WebPush.'
+			)
+		if not value.startswith("-----BEGIN") and os.path.exists(value):
+			with open(value, "r") as f:
+				value = f.read()
+		if value.startswith("-----BEGIN"):
+			_private_key = serialization.load_pem_private_key(
+				value.encode("ascii"), password=None, backend=default_backend()
+			)
+		else:
+			_private_key = ec.derive_private_key(
+				int(hexlify(_b64url_decode(value)), 16), ec.SECP256R1(), default_backend()
+			)
+	return _private_key
+
+
+class VAPIDTokenCache(object):
+	"""
+	Signs a VAPID JWT once per push service origin, and reuses it until it is
+	about to expire.
+	"""
+
+	def __init__(self):
+		self._tokens = {}
+		self._lock = threading.Lock()
+
+	def clear(self):
+		with self._lock:
+			self._tokens.clear()
+
+	def get_authorization(self, origin):
+		"""
+		Returns the Authorization header of the requests to the origin.
+		"""
+		now = int(time.time())
+		with self._lock:
+			header, expires = self._tokens.get(origin, (None, 0))
+			# Renew the tokens an hour before they expire
+			if expires - now < 3600:
+				expires = now + SETTINGS["WP_JWT_EXPIRATION"]
+				header = self._sign(origin, expires)
+				self._tokens[origin] = (header, expires)
+		return header
+
+	def _sign(self, origin, expires):
+		private_key = get_vapid_private_key()
+		claims = dict(SETTINGS["WP_CLAIMS"], aud=origin, exp=expires)
+		segments = [
+			_b64url_encode(json.dumps(data, separators=(",", ":"), sort_keys=True).encode("utf-8"))
+			for data in ({"typ": "JWT", "alg": "ES256"}, claims)
+		]
+		signing_input = ".".join(segments).encode("ascii")
+		r, s = decode_dss_signature(private_key.sign(signing_input, ec.ECDSA(hashes.SHA256())))
+		token = "%s.%s" % (".".join(segments), _b64url_encode(_int_to_bytes(r) + _int_to_bytes(s)))
+		return "vapid t=%s, k=%s" % (token, _b64url_encode(_public_key_bytes(private_key.public_key())))
+
+
+vapid_tokens = VAPIDTokenCache()
+
+
+class _ConnectionPool(threading.local):
+	"""
+	Keep-alive connections, one per push service origin and thread.
+	"""
+
+	def __init__(self):
+		self.connections = {}
+
+	def get(self, scheme, netloc):
+		connection = self.connections.get((scheme, netloc))
+		if connection is not None:
+			return connection, True
+		connection_class = http_client.HTTPSConnection if scheme == "https" else http_client.HTTPConnection
+		connection = connection_class(netloc, timeout=SETTINGS["WP_ERROR_TIMEOUT"])
+		self.connections[(scheme, netloc)] = connection
+		return connection, False
+
+	def discard(self, scheme, netloc):
+		connection = self.connections.pop((scheme, netloc), None)
+		if connection is not None:
+			connection.close()
+
+
+_connections = _ConnectionPool()
+
+
+def _post(endpoint, body, headers):
+	"""
+	POSTs the body over the keep-alive connection to the origin of the endpoint.
+	A reused connection closed by the server is opened again.
+
+	:return: (status, response body)
+	"""
+	url = urlsplit(endpoint)
+	path = url.path + ("?" + url.query if url.query else "")
+	while True:
+		connection, reused = _connections.get(url.scheme, url.netloc)
+		connection_opened.send(sender="WEBPUSH", reused=reused)
+		try:
+			connection.request("POST", path, body, headers)
+			response = connection.getresponse()
+			data = response.read()
+		except (http_client.HTTPException, IOError):
+			_connections.discard(url.scheme, url.netloc)
+			if reused:
+				continue
+			raise
+		if response.getheader("Connection", "").lower() == "close":
+			_connections.discard(url.scheme, url.netloc)
+		return response.status, data
+
+
+def _webpush_send(endpoint, body, ttl=None, urgency=None, topic=None):
+	url = urlsplit(endpoint)
+	origin = "%s://%s" % (url.scheme, url.netloc)
+	headers = {
+		"Authorization": vapid_tokens.get_authorization(origin),
+		"Content-Encoding": "aes128gcm",
+		"Content-Type": "application/octet-stream",
+		"TTL": str(SETTINGS["WP_TTL"] if ttl is None else ttl),
+	}
+	if urgency:
+		headers["Urgency"] = urgency
+	if topic:
+		headers["Topic"] = topic
+
+	throttle("WEBPUSH", origin)
+	request_started.send(sender="WEBPUSH", url=endpoint, bytes_sent=len(body))
+	start = default_timer()
+	try:
+		status, data = _post(endpoint, body, headers)
+	except Exception as e:
+		request_finished.send(sender="WEBPUSH", url=endpoint, elapsed=default_timer() - start, error=e)
+		raise
+	elapsed = default_timer() - start
+
+	# 404 and 410 mean the subscription expired
+	if status >= 400 and status not in (404, 410):
+		error = WebPushError("HTTP %i: %s" % (status, data.decode("utf-8", "replace")))
+		request_finished.send(sender="WEBPUSH", url=endpoint, elapsed=elapsed, error=error)
+		raise error
+	request_finished.send(sender="WEBPUSH", url=endpoint, elapsed=elapsed, error=None)
+	return WebPushResult(endpoint, status, elapsed)
+
+
+def _encode_payload(data):
+	if isinstance(data, dict):
+		data = json.dumps(data, separators=(",", ":"), sort_keys=True)
+	if isinstance(data, six.text_type):
+		data = data.encode("utf-8")
+	return data
+
+
+def _webpush_deactivate(endpoints):
+	from .models import WebPushDevice
+
+	if endpoints:
+		WebPushDevice.objects.filter(registration_id__in=endpoints).update(active=False)
+		devices_deactivated.send(sender="WEBPUSH", registration_ids=endpoints)
+
+
+def webpush_send_message(endpoint, p256dh, auth, data, **kwargs):
+	"""
+	Sends a WebPush notification to a single subscription.
+	The device of an expired subscription is deactivated.
+
+	:param data: str|bytes|dict: The payload, dicts are sent as JSON.
+	:param ttl: int: Seconds the push service keeps the message. Defaults to WP_TTL.
+	:param urgency: str: "very-low", "low", "normal" or "high".
+	:param topic: str: Replaces the pending messages with the same topic.
+	:return: WebPushResult
+	"""
+	result = _webpush_send(endpoint, encrypt(_encode_payload(data), p256dh, auth), **kwargs)
+	if result.status in (404, 410):
+		_webpush_deactivate([endpoint])
+	return result
+
+
+def _run_pool(func, items, max_workers):
+	"""
+	Calls func on every item with up to max_workers threads. Returns the results,
+	or the exceptions raised, in order.
+	"""
+	results = [None] * len(items)
+	indexes = iter(range(len(items)))
+	lock = threading.Lock()
+
+	def work():
+		while True:
+			with lock:
+				index = next(indexes, None)
+			if index is None:
+				return
+			try:
+				results[index] = func(items[index])
+			except Exception as e:
+				results[index] = e
+
+	threads = [threading.Thread(target=work) for i in range(min(max_workers, len(items)))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return results
+
+
+def webpush_send_bulk_message(subscriptions, data, on_error=None, max_workers=None, processes=None, **kwargs):
+	"""
+	Sends a WebPush notification to many subscriptions. Every subscription is its own
+	request: they are sent concurrently, by up to max_workers (WP_MAX_WORKERS) threads
+	each reusing its connections. The devices of expired subscriptions are deactivated.
+
+	Encryption is the CPU bound part of a broadcast. With more subscriptions than
+	WP_ENCRYPTION_BATCH_SIZE, and `processes` (WP_ENCRYPTION_PROCESSES) above 1,
+	the subscriptions are encrypted by batches on a pool of processes while the
+	previous batches are sent. With WP_SHARED_SERVER_KEY, the ephemeral key pair
+	is generated once per message rather than once per subscription.
+
+	By default, the first error is raised once every subscription was sent to.
+	If `on_error` is set, on_error(endpoint, exception) is called instead, and the
+	result of the subscription is None.
+
+	:param subscriptions: list: (endpoint, p256dh, auth) tuples.
+	:param data: str|bytes|dict: The payload, dicts are sent as JSON.
+	:return: list of WebPushResult, in the order of the subscriptions
+	"""
+	server_key = None
+	if SETTINGS["WP_SHARED_SERVER_KEY"]:
+		_check_cryptography()
+		server_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+	encryptor = WebPushEncryptor(_encode_payload(data), server_key)
+	subscriptions = list(subscriptions)
+	max_workers = max_workers or SETTINGS["WP_MAX_WORKERS"]
+	processes = SETTINGS["WP_ENCRYPTION_PROCESSES"] if processes is None else processes
+	batch_size = SETTINGS["WP_ENCRYPTION_BATCH_SIZE"]
+
+	if processes > 1 and len(subscriptions) > batch_size:
+		def send(item):
+			endpoint, body = item
+			if isinstance(body, Exception):
+				raise body
+			return _webpush_send(endpoint, body, **kwargs)
+
+		batches = [subscriptions[i:i + batch_size] for i in range(0, len(subscriptions), batch_size)]
+		results = []
+		for i, bodies in enumerate(_encrypt_in_processes(encryptor, batches, processes)):
+			results += _run_pool(send, [(s[0], body) for s, body in zip(batches[i], bodies)], max_workers)
+	else:
+		def send(subscription):
+			endpoint, p256dh, auth = subscription
+			return _webpush_send(endpoint, encryptor.encrypt(p256dh, auth), **kwargs)
+
+		results = _run_pool(send, subscriptions, max_workers)
+
+	_webpush_deactivate([
+		result.endpoint for result in results if isinstance(result, WebPushResult) and result.status in (404, 410)
+	])
+
+	errors = [(subscription[0], result) for subscription, result in zip(subscriptions, results) if isinstance(result, Exception)]
+	if errors and on_error is None:
+		raise errors[0][1]
+	for endpoint, error in errors:
+		on_error(endpoint, error)
+	return [None if isinstance(result, Exception) else result for result in results]
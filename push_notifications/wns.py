@@ -6,7 +6,12 @@ https://msdn.microsoft.com/en-us/windows/uwp/controls-and-patterns/tiles-and-not
 """
 
 import json
+import re
+import sys
 import xml.etree.ElementTree as ET
+from collections import Counter, namedtuple
+from timeit import default_timer
+from xml.etree.ElementTree import _escape_attrib, _escape_cdata
 
 try:
 	from urllib.error import HTTPError
@@ -18,8 +23,11 @@ except ImportError:
 	from urllib import urlencode
 
 from django.core.exceptions import ImproperlyConfigured
+from django.utils import six
 from . import NotificationError
+from .ratelimit import throttle
 from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from .signals import connection_opened, request_finished, request_started
 
 
 class WNSError(NotificationError):
@@ -31,7 +39,51 @@ class WNSAuthenticationError(WNSError):
 
 
 class WNSNotificationResponseError(WNSError):
-	pass
+	def __init__(self, msg, status=None):
+		super(WNSNotificationResponseError, self).__init__(msg)
+		# The HTTP status returned by WNS
+		self.status = status
+
+
+# The outcome of a single notification request, built from the X-WNS-* response headers.
+# `elapsed` is the duration of the notification request in seconds.
+WNSResult = namedtuple("WNSResult", ("uri", "status", "msg_id", "device_connection_status", "elapsed"))
+
+
+class WNSBulkResult(object):
+	"""
+	Aggregates the `WNSResult` of every uri of a bulk send.
+	"""
+	def __init__(self, results):
+		self.results = results
+
+	def __iter__(self):
+		return iter(self.results)
+
+	def __len__(self):
+		return len(self.results)
+
+	@property
+	def elapsed(self):
+		""" Total time spent in notification requests, in seconds """
+		return sum(result.elapsed for result in self.results)
+
+	@property
+	def statuses(self):
+		""" Number of results per X-WNS-Status (received, dropped, channelthrottled) """
+		return Counter(result.status for result in self.results)
+
+	@property
+	def device_connection_statuses(self):
+		""" Number of results per X-WNS-DeviceConnectionStatus (connected, disconnected, tempdisconnected) """
+		return Counter(result.device_connection_status for result in self.results)
+
+	@property
+	def disconnected_uris(self):
+		return [
+			result.uri for result in self.results
+			if result.device_connection_status == "disconnected"
+		]
 
 
 def _wns_authenticate(scope="notify.windows.com"):
@@ -64,9 +116,13 @@ def _wns_authenticate(scope="notify.windows.com"):
 	data = urlencode(params).encode("utf-8")
 
 	request = Request(SETTINGS["WNS_ACCESS_URL"], data=data, headers=headers)
+	connection_opened.send(sender="WNS", reused=False)
+	request_started.send(sender="WNS", url=SETTINGS["WNS_ACCESS_URL"], bytes_sent=len(data))
+	start = default_timer()
 	try:
 		response = urlopen(request)
 	except HTTPError as err:
+		request_finished.send(sender="WNS", url=SETTINGS["WNS_ACCESS_URL"], elapsed=default_timer() - start, error=err)
 		if err.code == 400:
 			# One of your settings is probably jacked up.
 			# https://msdn.microsoft.com/en-us/library/windows/apps/xaml/hh868245
@@ -74,6 +130,7 @@ def _wns_authenticate(scope="notify.windows.com"):
 		raise err
 
 	oauth_data = response.read().decode("utf-8")
+	request_finished.send(sender="WNS", url=SETTINGS["WNS_ACCESS_URL"], elapsed=default_timer() - start, error=None)
 	try:
 		oauth_data = json.loads(oauth_data)
 	except Exception:
@@ -88,15 +145,18 @@ def _wns_authenticate(scope="notify.windows.com"):
 	return access_token
 
 
-def _wns_send(uri, data, wns_type="wns/toast"):
+def _wns_send(uri, data, wns_type="wns/toast", extra_headers=None, access_token=None):
 	"""
 	Sends a notification data and authentication to WNS.
 
 	:param uri: str: The device's unique notification URI
 	:param data: dict: The notification data to be sent.
-	:return:
+	:param extra_headers: dict: Extra headers, e.g. X-WNS-Cache-Policy.
+	:param access_token: str: An access token from _wns_authenticate(), requested when not given.
+	:return: WNSResult
 	"""
-	access_token = _wns_authenticate()
+	if access_token is None:
+		access_token = _wns_authenticate()
 
 	content_type = "text/xml"
 	if wns_type == "wns/raw":
@@ -108,16 +168,23 @@ def _wns_send(uri, data, wns_type="wns/toast"):
 		"Authorization": "Bearer %s" % (access_token),
 		"X-WNS-Type": wns_type,  # wns/toast | wns/badge | wns/tile | wns/raw
 	}
+	if extra_headers:
+		headers.update(extra_headers)
 
 	if type(data) is str:
 		data = data.encode("utf-8")
 
 	request = Request(uri, data, headers)
+	throttle("WNS", SETTINGS["WNS_PACKAGE_SECURITY_ID"])
 
 	# A lot of things can happen, let them know which one.
+	connection_opened.send(sender="WNS", reused=False)
+	request_started.send(sender="WNS", url=uri, bytes_sent=len(data))
+	start = default_timer()
 	try:
 		response = urlopen(request)
 	except HTTPError as err:
+		request_finished.send(sender="WNS", url=uri, elapsed=default_timer() - start, error=err)
 		if err.code == 400:
 			msg = "One or more headers were specified incorrectly or conflict with another header."
 		elif err.code == 401:
@@ -140,9 +207,20 @@ def _wns_send(uri, data, wns_type="wns/toast"):
 			msg = "The server is currently unavailable."
 		else:
 			raise err
-		raise WNSNotificationResponseError("HTTP %i: %s" % (err.code, msg))
+		raise WNSNotificationResponseError("HTTP %i: %s" % (err.code, msg), status=err.code)
 
-	return response.read().decode("utf-8")
+	response.read()
+	elapsed = default_timer() - start
+	request_finished.send(sender="WNS", url=uri, elapsed=elapsed, error=None)
+
+	headers = response.info()
+	return WNSResult(
+		uri=uri,
+		status=headers.get("X-WNS-Status"),
+		msg_id=headers.get("X-WNS-Msg-ID"),
+		device_connection_status=headers.get("X-WNS-DeviceConnectionStatus"),
+		elapsed=elapsed,
+	)
 
 
 def _wns_prepare_toast(data, **kwargs):
@@ -175,7 +253,9 @@ def _wns_prepare_toast(data, **kwargs):
 	return ET.tostring(root)
 
 
-def wns_send_message(uri, message=None, xml_data=None, raw_data=None, **kwargs):
+def wns_send_message(
+	uri, message=None, xml_data=None, raw_data=None, xml_template=None, context=None, **kwargs
+):
 	"""
 	Sends a notification request to WNS.
 	There are four notification types that WNS can send: toast, tile, badge and raw.
@@ -205,10 +285,16 @@ def wns_send_message(uri, message=None, xml_data=None, raw_data=None, **kwargs):
 	4. Passing a value to `raw_data` will create a `raw` notification and send the
 	input data as is.
 
+	5. Passing a `WNSTemplate` to `xml_template` will render it with `context`.
+	See `WNSTemplate` docs for more information.
+
 	:param uri: str: The device's unique notification uri.
 	:param message: str|dict: The notification data to be sent.
 	:param xml_data: dict: A dictionary containing data to be converted to an xml tree.
 	:param raw_data: str: Data to be sent via a `raw` notification.
+	:param xml_template: WNSTemplate: A compiled template to be rendered with `context`.
+	:param context: dict: The placeholder values used to render `xml_template`.
+	:return: WNSResult
 	"""
 	# Create a simple toast notification
 	if message:
@@ -220,9 +306,12 @@ def wns_send_message(uri, message=None, xml_data=None, raw_data=None, **kwargs):
 		prepared_data = _wns_prepare_toast(data=message, **kwargs)
 	# Create a toast/tile/badge notification from a dictionary
 	elif xml_data:
-		xml = dict_to_xml_schema(xml_data)
-		wns_type = "wns/%s" % xml.tag
-		prepared_data = ET.tostring(xml)
+		wns_type = "wns/%s" % next(iter(xml_data))
+		prepared_data = dict_to_xml_string(xml_data)
+	# Render a toast/tile/badge notification from a compiled template
+	elif xml_template:
+		wns_type = xml_template.wns_type
+		prepared_data = xml_template.render(context or {})
 	# Create a raw notification
 	elif raw_data:
 		wns_type = "wns/raw"
@@ -230,13 +319,16 @@ def wns_send_message(uri, message=None, xml_data=None, raw_data=None, **kwargs):
 	else:
 		raise TypeError(
 			"At least one of the following parameters must be set:"
-			"`message`, `xml_data`, `raw_data`"
+			"`message`, `xml_data`, `raw_data`, `xml_template`"
 		)
 
-	_wns_send(uri=uri, data=prepared_data, wns_type=wns_type)
+	return _wns_send(uri=uri, data=prepared_data, wns_type=wns_type)
 
 
-def wns_send_bulk_message(uri_list, message=None, xml_data=None, raw_data=None, **kwargs):
+def wns_send_bulk_message(
+	uri_list, message=None, xml_data=None, raw_data=None, xml_template=None, contexts=None, on_error=None,
+	**kwargs
+):
 	"""
 	WNS doesn't support bulk notification, so we loop through each uri.
 
@@ -244,13 +336,95 @@ def wns_send_bulk_message(uri_list, message=None, xml_data=None, raw_data=None,
 	:param message: str: The notification data to be sent.
 	:param xml_data: dict: A dictionary containing data to be converted to an xml tree.
 	:param raw_data: str: Data to be sent via a `raw` notification.
+	:param xml_template: WNSTemplate|dict|str: A template personalized for each uri.
+	It is compiled once if it isn't a `WNSTemplate` already.
+	:param contexts: dict: A mapping of uri to the context used to render `xml_template`.
+	:param on_error: callable: If set, a failed uri doesn't stop sending to the others:
+	on_error(uri, exception) is called, and its result has a status of None.
+	:return: WNSBulkResult
 	"""
-	if uri_list:
-		for uri in uri_list:
-			wns_send_message(
-				uri=uri, message=message, xml_data=xml_data,
-				raw_data=raw_data, **kwargs
-			)
+	results = []
+	if not uri_list:
+		return WNSBulkResult(results)
+
+	if xml_template:
+		if not isinstance(xml_template, WNSTemplate):
+			xml_template = WNSTemplate(xml_template)
+		contexts = contexts or {}
+
+	for uri in uri_list:
+		if xml_template:
+			message_kwargs = dict(xml_template=xml_template, context=contexts.get(uri))
+		else:
+			message_kwargs = dict(message=message, xml_data=xml_data, raw_data=raw_data)
+		message_kwargs.update(kwargs)
+		try:
+			results.append(wns_send_message(uri=uri, **message_kwargs))
+		except (WNSError, IOError) as e:
+			if on_error is None:
+				raise
+			on_error(uri, e)
+			results.append(WNSResult(uri, None, None, None, 0))
+
+	return WNSBulkResult(results)
+
+
+class WNSTemplate(object):
+	"""
+	A toast/tile/badge notification compiled once and rendered for each recipient
+	with plain string substitution, instead of building an xml tree per recipient.
+
+	Placeholders are written as `{name}` anywhere in text or attribute values.
+	Context values are converted to text and xml-escaped when rendered. e.g.:
+		template = WNSTemplate({
+			"toast": {
+				"children": {
+					"visual": {
+						"children": {
+							"binding": {
+								"attrs": {"template": "ToastText01"},
+								"children": {
+									"text": {"attrs": {"id": "1"}, "children": "Hi {name}!"},
+								},
+							},
+						},
+					},
+				},
+			},
+		})
+		template.render({"name": "Jane"})
+
+	:param xml: dict|str|bytes: The template, either as a dictionary in the
+	`dict_to_xml_schema` format or as an xml document.
+	"""
+	placeholder_re = re.compile(r"\{(\w+)\}")
+	root_tag_re = re.compile(r"<\s*([^\s/>?!]+)")
+
+	def __init__(self, xml):
+		if isinstance(xml, dict):
+			xml = dict_to_xml_string(xml)
+		if isinstance(xml, bytes):
+			xml = xml.decode("utf-8")
+
+		match = self.root_tag_re.search(xml)
+		if not match:
+			raise ValueError("Could not find the root element of the WNS template.")
+		self.wns_type = "wns/%s" % (match.group(1))
+
+		self.placeholders = frozenset(self.placeholder_re.findall(xml))
+		self._format = self.placeholder_re.sub(r"%(\1)s", xml.replace("%", "%%"))
+
+	def render(self, context):
+		"""
+		Renders the template for a single recipient.
+
+		:param context: dict: The value of every placeholder in the template.
+		:return: bytes
+		"""
+		values = {}
+		for name in self.placeholders:
+			values[name] = _escape_attrib(six.text_type(context[name]))
+		return (self._format % values).encode("utf-8")
 
 
 def dict_to_xml_schema(data):
@@ -319,6 +493,74 @@ def dict_to_xml_schema(data):
 		return root
 
 
+def dict_to_xml_string(data):
+	"""
+	Serializes a dictionary straight to XML, without building an intermediate
+	ElementTree. The dictionary format is the one described in `dict_to_xml_schema`
+	and the output is byte-identical to `ET.tostring(dict_to_xml_schema(data))`.
+
+	:param data: dict: Used to create the XML document. See `dict_to_xml_schema`.
+	:return: bytes
+	"""
+	for key, value in data.items():
+		buf = []
+		_write_element(buf, key, value, allow_text=False)
+		return "".join(buf).encode("us-ascii", "xmlcharrefreplace")
+
+
+# ElementTree sorts attributes before Python 3.8 and keeps insertion order after.
+_SORT_XML_ATTRS = sys.version_info < (3, 8)
+
+
+def _write_element(buf, tag, value, allow_text=True):
+	"""
+	Writes a single element, its attributes and its sub-elements to `buf`.
+
+	:param buf: list: The buffer the escaped XML fragments are appended to.
+	:param tag: str: The element tag.
+	:param value: dict: The sub-element dictionary. See `dict_to_xml_schema`.
+	:param allow_text: bool: Whether string `children` become the element text.
+	The root element never gets a text, mirroring `dict_to_xml_schema`.
+	"""
+	buf.append("<" + tag)
+	attrs = value.get("attrs", {}).items()
+	if _SORT_XML_ATTRS:
+		attrs = sorted(attrs)
+	for attr, attr_value in attrs:
+		buf.append(" %s=\"%s\"" % (attr, _escape_attrib(attr_value)))
+
+	children = value.get("children", None)
+	if isinstance(children, dict):
+		start = len(buf)
+		buf.append(">")
+		_write_sub_elements(buf, children)
+		if len(buf) == start + 1:
+			# No sub-element was written, self-close like ElementTree does
+			buf[start] = " />"
+		else:
+			buf.append("</%s>" % (tag))
+	elif allow_text and isinstance(children, str) and children:
+		buf.append(">%s</%s>" % (_escape_cdata(children), tag))
+	else:
+		buf.append(" />")
+
+
+def _write_sub_elements(buf, sub_dict):
+	"""
+	Writes the sub-elements described by `sub_dict` to `buf`.
+	This is the streaming counterpart of `_add_sub_elements_from_dict`.
+
+	:param buf: list: The buffer the escaped XML fragments are appended to.
+	:param sub_dict: dict: See `dict_to_xml_schema`.
+	"""
+	for key, value in sub_dict.items():
+		if isinstance(value, list):
+			for repeated_element in value:
+				_write_element(buf, key, repeated_element)
+		else:
+			_write_element(buf, key, value)
+
+
 def _add_sub_elements_from_dict(parent, sub_dict):
 	"""
 	Add SubElements to the parent element.
@@ -1,9 +1,20 @@
 from .test_models import *
+from .test_admin import *
 from .test_gcm_push_payload import *
+from .test_batching import *
 from .test_apns_push_payload import *
 from .test_management_commands import *
 from .test_apns_certfilecheck import *
 from .test_wns import *
+from .test_results import *
+from .test_pipeline import *
+from .test_probe import *
+from .test_dedup import *
+from .test_ratelimit import *
+from .test_scheduling import *
+from .test_sharding import *
+from .test_signals import *
+from .test_webpush import *
 
 # conditionally test rest_framework api if the DRF package is installed
 try:
@@ -0,0 +1,189 @@
+from django.contrib import messages
+from django.contrib.admin import site
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase
+from django.utils.six import StringIO
+from push_notifications.admin import DeviceAdmin, EstimatedCountPaginator, GCMDeviceAdmin, WNSDeviceAdmin
+from push_notifications.models import APNSDevice, GCMDevice, WNSDevice
+from push_notifications.pipeline import reset_broker
+from push_notifications.results import BroadcastResult
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from ._mock import mock
+
+
+class AdminActionsTestCase(TestCase):
+	def setUp(self):
+		self.request = RequestFactory().post("/")
+		for i in range(5):
+			APNSDevice.objects.create(registration_id="%064x" % (i))
+
+	def _admin(self, model_admin, **attrs):
+		model = {DeviceAdmin: APNSDevice, GCMDeviceAdmin: GCMDevice, WNSDeviceAdmin: WNSDevice}[model_admin]
+		model_admin = model_admin(model, site)
+		model_admin.__dict__.update(attrs)
+		model_admin.message_user = mock.Mock()
+		return model_admin
+
+	def test_send_message_per_device(self):
+		model_admin = self._admin(DeviceAdmin)
+		with mock.patch("push_notifications.models.APNSDevice.send_message", return_value="sent") as send:
+			model_admin.send_message(self.request, APNSDevice.objects.filter(registration_id__in=["%064x" % (0), "%064x" % (1)]))
+		self.assertEqual(send.call_count, 2)
+		model_admin.message_user.assert_called_once_with(self.request, "All messages were sent: sent, sent")
+
+	def test_send_message_large_selection_uses_queryset(self):
+		model_admin = self._admin(DeviceAdmin, max_single_sends=2)
+		result = BroadcastResult("apns")
+		result.add_recipients(["a"] * 5)
+		with mock.patch("push_notifications.models.APNSDeviceQuerySet.send_message", return_value=result) as send:
+			with mock.patch("push_notifications.models.APNSDevice.send_message") as send_single:
+				model_admin.send_message(self.request, APNSDevice.objects.all())
+		send.assert_called_once_with("Test single notification")
+		self.assertFalse(send_single.called)
+		model_admin.message_user.assert_called_once_with(self.request, "All messages were sent: apns: 5 sent, 0 failed")
+
+	def test_send_bulk_message_refused_without_pipeline(self):
+		model_admin = self._admin(DeviceAdmin, max_sync_sends=4)
+		with mock.patch("push_notifications.models.APNSDeviceQuerySet.send_message") as send:
+			model_admin.send_bulk_message(self.request, APNSDevice.objects.all())
+		self.assertFalse(send.called)
+		self.assertEqual(model_admin.message_user.call_args[1], {"level": messages.ERROR})
+
+	def test_send_bulk_message_enqueued(self):
+		model_admin = self._admin(DeviceAdmin, max_sync_sends=4)
+		with mock.patch.dict(SETTINGS, {"QUEUE_BROKER": "push_notifications.pipeline.LocalBroker"}):
+			with mock.patch("push_notifications.models.APNSDeviceQuerySet.send_message", return_value="42") as send:
+				model_admin.send_bulk_message(self.request, APNSDevice.objects.all())
+		send.assert_called_once_with("Test bulk notification")
+		model_admin.message_user.assert_called_once_with(
+			self.request, "The message was enqueued as job 42, push_worker sends it."
+		)
+
+	def test_prune_devices_in_bulk(self):
+		model_admin = self._admin(DeviceAdmin)
+		expired = [("%064x" % (i)).encode("ascii") for i in (1, 3, 7)]
+		with mock.patch("push_notifications.admin.get_expired_tokens", return_value=expired):
+			# A SELECT and an UPDATE
+			with self.assertNumQueries(2):
+				model_admin.prune_devices(self.request, APNSDevice.objects.exclude(registration_id="%064x" % (3)))
+		self.assertEqual(
+			list(APNSDevice.objects.filter(active=False).values_list("registration_id", flat=True)), ["%064x" % (1)]
+		)
+		model_admin.message_user.assert_called_once_with(self.request, "1 devices were deactivated.")
+
+	def test_prune_gcm_devices_probes(self):
+		GCMDevice.objects.create(registration_id="dead", cloud_message_type="FCM")
+		GCMDevice.objects.create(registration_id="alive", cloud_message_type="FCM")
+		model_admin = self._admin(GCMDeviceAdmin)
+		with mock.patch("push_notifications.probe.probe_devices", side_effect=lambda qs, **kwargs: (
+			[r for r in qs.values_list("registration_id", flat=True) if r == "dead"], []
+		)):
+			model_admin.prune_devices(self.request, GCMDevice.objects.all())
+		self.assertEqual(list(GCMDevice.objects.filter(active=False).values_list("registration_id", flat=True)), ["dead"])
+		model_admin.message_user.assert_called_once_with(self.request, "1 devices were deactivated.")
+
+	def test_prune_gcm_devices_probe_errors(self):
+		GCMDevice.objects.create(registration_id="abc", cloud_message_type="FCM")
+		model_admin = self._admin(GCMDeviceAdmin)
+		with mock.patch("push_notifications.probe.probe_devices", return_value=([], [IOError("down")])):
+			model_admin.prune_devices(self.request, GCMDevice.objects.all())
+		self.assertEqual(model_admin.message_user.call_args_list, [
+			mock.call(self.request, "2 probes failed: OSError('down')", level=messages.ERROR),
+			mock.call(self.request, "0 devices were deactivated."),
+		])
+
+	def test_prune_gcm_devices_refused(self):
+		GCMDevice.objects.create(registration_id="abc", cloud_message_type="FCM")
+		model_admin = self._admin(GCMDeviceAdmin, max_sync_probes=0)
+		with mock.patch("push_notifications.probe.probe_devices") as probe:
+			model_admin.prune_devices(self.request, GCMDevice.objects.all())
+		self.assertFalse(probe.called)
+		self.assertEqual(model_admin.message_user.call_args[1], {"level": messages.ERROR})
+
+	def test_prune_wns_devices_opt_in(self):
+		WNSDevice.objects.create(registration_id="https://wns.example.com/dead")
+		self.request.user = User(is_active=True, is_superuser=True)
+		self.assertNotIn("prune_devices", self._admin(WNSDeviceAdmin).get_actions(self.request))
+
+		model_admin = self._admin(WNSDeviceAdmin, wns_raw_probes=True)
+		self.assertIn("prune_devices", model_admin.get_actions(self.request))
+		with mock.patch("push_notifications.probe.probe_devices", return_value=(["https://wns.example.com/dead"], [])) as probe:
+			model_admin.prune_devices(self.request, WNSDevice.objects.all())
+		self.assertEqual(probe.call_args[1], {"concurrency": 8, "wns_raw_probes": True})
+		self.assertFalse(WNSDevice.objects.get().active)
+
+	def test_prune_gcm_devices_enqueued(self):
+		GCMDevice.objects.create(registration_id="dead", cloud_message_type="GCM")
+		GCMDevice.objects.create(registration_id="alive", cloud_message_type="FCM")
+		model_admin = self._admin(GCMDeviceAdmin, max_sync_probes=0)
+		with mock.patch.dict(SETTINGS, {
+			"QUEUE_BROKER": "push_notifications.pipeline.LocalBroker", "QUEUE_CONCURRENCY": {},
+		}):
+			reset_broker()
+			self.addCleanup(reset_broker)
+			with mock.patch("push_notifications.probe.probe_devices") as probe:
+				model_admin.prune_devices(self.request, GCMDevice.objects.all())
+				self.assertFalse(probe.called)
+			model_admin.message_user.assert_called_once_with(
+				self.request, "Pruning was enqueued as job 0, push_worker probes the devices and reports the progress."
+			)
+
+			out = StringIO()
+			with mock.patch("push_notifications.probe._probe_cm_chunk", side_effect=lambda ids, cloud_type: (
+				[r for r in ids if r == "dead"]
+			)):
+				call_command("push_worker", burst=True, timeout=0, stdout=out)
+		self.assertIn("job 1: gcm prune chunk 1/1: 1 devices deactivated, 0 probes failed", out.getvalue())
+		self.assertEqual(list(GCMDevice.objects.filter(active=False).values_list("registration_id", flat=True)), ["dead"])
+
+
+class AdminChangelistTestCase(TestCase):
+	def setUp(self):
+		self.request = RequestFactory().get("/")
+		self.user = User.objects.create(username="bob")
+		GCMDevice.objects.create(registration_id="abc", device_id="1f", cloud_message_type="FCM")
+		GCMDevice.objects.create(registration_id="abcd", device_id="2f", user=self.user, cloud_message_type="FCM")
+		self.model_admin = GCMDeviceAdmin(GCMDevice, site)
+
+	def _search(self, term):
+		queryset, use_distinct = self.model_admin.get_search_results(self.request, GCMDevice.objects.all(), term)
+		self.assertFalse(use_distinct)
+		return sorted(queryset.values_list("registration_id", flat=True))
+
+	def test_search_exact_matches(self):
+		self.assertEqual(self._search("abc"), ["abc"])
+		self.assertEqual(self._search(" 2f "), ["abcd"])
+		self.assertEqual(self._search("bob"), ["abcd"])
+		self.assertEqual(self._search("ab"), [])
+		self.assertEqual(self._search("not hex"), [])
+		self.assertEqual(self._search(""), ["abc", "abcd"])
+
+	def test_search_uses_registration_id_hash(self):
+		queryset, use_distinct = self.model_admin.get_search_results(self.request, GCMDevice.objects.all(), "abc")
+		sql = str(queryset.query)
+		self.assertIn("registration_id_hash", sql)
+		self.assertNotIn("LIKE", sql)
+
+	def test_changelist_selects_users(self):
+		self.assertEqual(self.model_admin.list_select_related, ("user",))
+		self.assertIs(self.model_admin.paginator, EstimatedCountPaginator)
+
+	def test_paginator_counts_exactly(self):
+		self.assertEqual(EstimatedCountPaginator(GCMDevice.objects.order_by("pk"), 1).count, 2)
+
+	def test_paginator_estimates_on_postgresql(self):
+		connection = mock.MagicMock(vendor="postgresql")
+		connection.ops.quote_name.side_effect = lambda name: '"%s"' % (name)
+		cursor = connection.cursor.return_value.__enter__.return_value
+		cursor.fetchone.return_value = (250000.0,)
+		with mock.patch("push_notifications.admin.connections", {"default": connection}):
+			self.assertEqual(EstimatedCountPaginator(GCMDevice.objects.order_by("pk"), 1).count, 250000)
+			cursor.execute.assert_called_once_with(
+				"SELECT reltuples FROM pg_class WHERE oid = %s::regclass", ['"push_notifications_gcmdevice"']
+			)
+
+			# Filtered, and small, tables are counted
+			self.assertEqual(EstimatedCountPaginator(GCMDevice.objects.filter(active=True).order_by("pk"), 1).count, 2)
+			cursor.fetchone.return_value = (10.0,)
+			self.assertEqual(EstimatedCountPaginator(GCMDevice.objects.order_by("pk"), 1).count, 2)
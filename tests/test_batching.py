@@ -0,0 +1,92 @@
+import json
+import threading
+from django.test import TestCase
+from push_notifications.batching import MicroBatcher, get_batcher
+from push_notifications.gcm import GCMError, send_message
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from ._mock import mock
+
+
+def fake_response(payload, content_type):
+	"""
+	Answers every registration id of a JSON request, with an error for the ones starting with "error-".
+	"""
+	results = []
+	for registration_id in json.loads(payload.decode("utf-8"))["registration_ids"]:
+		if registration_id.startswith("error-"):
+			results.append({"error": registration_id[len("error-"):]})
+		else:
+			results.append({"message_id": "id-%s" % (registration_id)})
+	failure = len([result for result in results if "error" in result])
+	return json.dumps({
+		"multicast_id": 1, "success": len(results) - failure, "failure": failure, "canonical_ids": 0,
+		"results": results,
+	})
+
+
+class MicroBatcherTestCase(TestCase):
+	def test_batches_identical_messages(self):
+		batcher = MicroBatcher(60, 3)
+		with mock.patch("push_notifications.gcm._fcm_send", side_effect=fake_response) as p:
+			pending = [batcher.submit(r, {"message": "Hello"}, None, "FCM") for r in ("a", "b", "c")]
+			other = batcher.submit("d", {"message": "Bye"}, None, "FCM")
+			self.assertEqual(p.call_count, 1)
+			self.assertEqual(json.loads(p.call_args[0][0].decode("utf-8")), {
+				"data": {"message": "Hello"}, "registration_ids": ["a", "b", "c"]
+			})
+			self.assertEqual([r.result(0) for r in pending], [{"message_id": "id-%s" % (r)} for r in "abc"])
+			self.assertFalse(other.done())
+
+			batcher.flush()
+			self.assertEqual(p.call_count, 2)
+		self.assertEqual(other.result(0), {"message_id": "id-d"})
+
+	def test_window(self):
+		batcher = MicroBatcher(0.01, 100)
+		with mock.patch("push_notifications.gcm._gcm_send", side_effect=fake_response) as p:
+			pending = [batcher.submit(r, {"message": "Hello"}, None, "GCM", time_to_live=60) for r in ("a", "b")]
+			self.assertEqual([r.result(5) for r in pending], [{"message_id": "id-a"}, {"message_id": "id-b"}])
+		p.assert_called_once_with(
+			b'{"data":{"message":"Hello"},"registration_ids":["a","b"],"time_to_live":60}', "application/json"
+		)
+
+	def test_errors_are_routed(self):
+		batcher = MicroBatcher(60, 100)
+		with mock.patch("push_notifications.gcm._fcm_send", side_effect=fake_response):
+			with mock.patch("push_notifications.gcm.GCMDevice.objects.filter"):
+				ok = batcher.submit("a", {}, None, "FCM")
+				dead = batcher.submit("error-NotRegistered", {}, None, "FCM")
+				failed = batcher.submit("error-Unavailable", {}, None, "FCM")
+				batcher.flush()
+		self.assertEqual(ok.result(0), {"message_id": "id-a"})
+		self.assertEqual(dead.result(0), {"error": "NotRegistered"})
+		with self.assertRaises(GCMError):
+			failed.result(0)
+
+	def test_request_error(self):
+		batcher = MicroBatcher(60, 100)
+		with mock.patch("push_notifications.gcm._fcm_send", side_effect=IOError("down")):
+			pending = [batcher.submit(r, {}, None, "FCM") for r in ("a", "b")]
+			batcher.flush()
+		for r in pending:
+			with self.assertRaises(IOError):
+				r.result(0)
+
+	def test_send_message_concurrently(self):
+		results = {}
+
+		def send(registration_id):
+			results[registration_id] = send_message(registration_id, {"message": "Hello"}, None, "FCM")
+
+		with mock.patch.dict(SETTINGS, {"CM_BATCH_WINDOW": 0.05, "CM_BATCH_SIZE": 4}):
+			with mock.patch("push_notifications.gcm._fcm_send", side_effect=fake_response) as p:
+				threads = [threading.Thread(target=send, args=(r,)) for r in "abcd"]
+				for thread in threads:
+					thread.start()
+				for thread in threads:
+					thread.join()
+		self.assertEqual(p.call_count, 1)
+		self.assertEqual(results, dict((r, {"message_id": "id-%s" % (r)}) for r in "abcd"))
+
+	def test_disabled_by_default(self):
+		self.assertIsNone(get_batcher())
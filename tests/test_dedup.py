@@ -0,0 +1,118 @@
+import threading
+import time
+from django.core.cache import caches
+from django.test import TestCase
+from push_notifications import dedup
+from push_notifications.models import APNSDevice, GCMDevice
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from ._mock import mock
+
+
+class LRUCacheTestCase(TestCase):
+	def test_eviction(self):
+		cache = dedup.LRUCache(max_size=2)
+		cache.set_many({"a": 1, "b": 2})
+		# "a" becomes the most recently used
+		self.assertEqual(cache.get_many(["a"]), {"a": 1})
+		cache.set_many({"c": 3})
+		self.assertEqual(cache.get_many(["a", "b", "c"]), {"a": 1, "c": 3})
+
+	def test_expiry(self):
+		cache = dedup.LRUCache()
+		with mock.patch("push_notifications.dedup.time", return_value=100):
+			cache.set_many({"a": 1}, timeout=10)
+		with mock.patch("push_notifications.dedup.time", return_value=109):
+			self.assertEqual(cache.get_many(["a"]), {"a": 1})
+		with mock.patch("push_notifications.dedup.time", return_value=110):
+			self.assertEqual(cache.get_many(["a"]), {})
+
+	def test_add(self):
+		cache = dedup.LRUCache(max_size=2)
+		with mock.patch("push_notifications.dedup.time", return_value=100):
+			self.assertTrue(cache.add("a", 1, timeout=10))
+			self.assertFalse(cache.add("a", 2, timeout=10))
+		with mock.patch("push_notifications.dedup.time", return_value=110):
+			# Expired keys are set again
+			self.assertTrue(cache.add("a", 3, timeout=10))
+			self.assertEqual(cache.get_many(["a"]), {"a": 3})
+
+
+class DedupTestCase(TestCase):
+	def setUp(self):
+		patcher = mock.patch("push_notifications.dedup._local_cache", dedup.LRUCache())
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_gcm_send_message_dedup(self):
+		GCMDevice.objects.create(registration_id="abc", cloud_message_type="GCM")
+		GCMDevice.objects.create(registration_id="def", cloud_message_type="GCM")
+
+		with mock.patch("push_notifications.gcm.send_bulk_message", return_value={}) as p:
+			result = GCMDevice.objects.all().send_message("Hello world", dedup_key="campaign-1")
+			self.assertEqual((result.total, result.skipped), (2, 0))
+
+			GCMDevice.objects.create(registration_id="ghi", cloud_message_type="GCM")
+			result = GCMDevice.objects.all().send_message("Hello world", dedup_key="campaign-1")
+			self.assertEqual((result.total, result.skipped), (1, 2))
+
+			result = GCMDevice.objects.all().send_message("Hello world", dedup_key="campaign-2")
+			self.assertEqual((result.total, result.skipped), (3, 0))
+
+		self.assertEqual(
+			[call[1]["registration_ids"] for call in p.call_args_list],
+			[["abc", "def"], ["ghi"], ["abc", "def", "ghi"]]
+		)
+
+	def test_apns_send_message_released_on_error(self):
+		APNSDevice.objects.create(registration_id="616263")
+
+		with mock.patch("push_notifications.apns.apns_send_bulk_message", side_effect=IOError) as p:
+			with self.assertRaises(IOError):
+				APNSDevice.objects.all().send_message("Hello world", dedup_key="campaign-1")
+		with mock.patch("push_notifications.apns.apns_send_bulk_message") as p:
+			APNSDevice.objects.all().send_message("Hello world", dedup_key="campaign-1")
+			APNSDevice.objects.all().send_message("Hello world", dedup_key="campaign-1")
+		p.assert_called_once_with(registration_ids=["616263"], alert="Hello world")
+
+	def test_django_cache(self):
+		self.addCleanup(caches["default"].clear)
+		with mock.patch.dict(SETTINGS, {"DEDUP_CACHE": "default"}):
+			self.assertEqual(dedup.claim("campaign-1", ["abc", "def"]), ["abc", "def"])
+			self.assertEqual(dedup.claim("campaign-1", ["abc", "ghi"]), ["ghi"])
+			dedup.release("campaign-1", ["abc"])
+			self.assertEqual(dedup.claim("campaign-1", ["abc", "def"]), ["abc"])
+		self.assertEqual(len(dedup.get_cache()), 0)
+
+	def test_claim_round_trips(self):
+		cache = dedup.LRUCache()
+		with mock.patch("push_notifications.dedup._local_cache", cache):
+			dedup.claim("campaign-1", ["abc"])
+			with mock.patch.object(cache, "get_many", wraps=cache.get_many) as get_many:
+				with mock.patch.object(cache, "add", wraps=cache.add) as add:
+					self.assertEqual(dedup.claim("campaign-1", ["abc", "def", "ghi"]), ["def", "ghi"])
+		# The ids already sent are looked up at once, only the others are added
+		get_many.assert_called_once_with([dedup._make_key("campaign-1", r) for r in ("abc", "def", "ghi")])
+		self.assertEqual(add.call_count, 2)
+
+	def test_concurrent_claims(self):
+		class SlowCache(dedup.LRUCache):
+			# Widens the window between looking registration ids up and recording them
+			def get_many(self, keys):
+				ret = super(SlowCache, self).get_many(keys)
+				time.sleep(0.05)
+				return ret
+
+		registration_ids = ["abc", "def", "ghi"]
+		claimed = []
+
+		def claim():
+			claimed.extend(dedup.claim("campaign-1", registration_ids))
+
+		with mock.patch("push_notifications.dedup._local_cache", SlowCache()):
+			threads = [threading.Thread(target=claim) for i in range(2)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+		# Every registration id is claimed exactly once
+		self.assertEqual(sorted(claimed), registration_ids)
@@ -1,5 +1,7 @@
+import json
 from django.test import TestCase
-from push_notifications.gcm import send_message, send_bulk_message
+from push_notifications.gcm import send_message, send_bulk_message, send_personalized_messages
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 from tests.test_models import GCM_PLAIN_RESPONSE, GCM_JSON_RESPONSE
 from ._mock import mock
 
@@ -27,3 +29,28 @@ class GCMPushPayloadTest(TestCase):
 			p.assert_called_once_with(
 				b'{"data":{"message":"Hello world"},"registration_ids":["abc","123"]}',
 				"application/json")
+
+	def test_personalized_push_payloads(self):
+		def respond(payload, content_type):
+			registration_ids = json.loads(payload.decode("utf-8"))["registration_ids"]
+			return json.dumps({
+				"multicast_id": 1, "success": len(registration_ids), "failure": 0, "canonical_ids": 0,
+				"results": [{"message_id": "id-%s" % (registration_id)} for registration_id in registration_ids],
+			})
+
+		messages = [
+			("a", {"message": "Hello", "b": 1, "a": 2}, None),
+			("b", {"message": "Hello Bob"}, None),
+			("c", {"a": 2, "b": 1, "message": "Hello"}, None),
+			("d", {"message": "Hello", "a": 2, "b": 1}, None),
+		]
+		with mock.patch.dict(SETTINGS, {"FCM_MAX_RECIPIENTS": 2}):
+			with mock.patch("push_notifications.gcm._fcm_send", side_effect=respond) as p:
+				results = send_personalized_messages(messages, "FCM", time_to_live=60)
+
+		self.assertEqual([json.loads(call[0][0].decode("utf-8")) for call in p.call_args_list], [
+			{"data": {"a": 2, "b": 1, "message": "Hello"}, "registration_ids": ["a", "c"], "time_to_live": 60},
+			{"data": {"a": 2, "b": 1, "message": "Hello"}, "registration_ids": ["d"], "time_to_live": 60},
+			{"data": {"message": "Hello Bob"}, "registration_ids": ["b"], "time_to_live": 60},
+		])
+		self.assertEqual(results, [{"message_id": "id-%s" % (r)} for r in "abcd"])
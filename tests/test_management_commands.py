@@ -1,4 +1,4 @@
-from django.core.management import call_command
+from django.core.management import call_command, CommandError
 from django.test import TestCase
 from ._mock import mock
 
@@ -21,3 +21,40 @@ class CommandsTestCase(TestCase):
 
 		device = APNSDevice.objects.get(pk=device.pk)
 		self.assertFalse(device.active)
+
+	def test_prune_devices_in_batches(self):
+		from django.utils.six import StringIO
+		from push_notifications.models import APNSDevice
+
+		for i in range(5):
+			APNSDevice.objects.create(registration_id="%064x" % (i))
+		expired = [("%064x" % (i)).encode("ascii") for i in (0, 1, 2, 4, 9)]
+
+		with mock.patch("push_notifications.models.get_expired_tokens", return_value=expired):
+			out = StringIO()
+			call_command("prune_devices", dry_run=True, batch_size=2, stdout=out)
+			self.assertEqual(APNSDevice.objects.filter(active=True).count(), 5)
+			self.assertEqual(out.getvalue().splitlines(), [
+				"APNS batch 1/3: would deactivate 2 devices",
+				"APNS batch 2/3: would deactivate 2 devices",
+				"APNS batch 3/3: would deactivate 0 devices",
+				"APNS: would deactivate 4 devices",
+			])
+
+			out = StringIO()
+			# A SELECT per batch, an UPDATE per batch with devices to deactivate
+			with self.assertNumQueries(3 + 2):
+				call_command("prune_devices", batch_size=2, stdout=out)
+			self.assertEqual(out.getvalue().splitlines()[-1], "APNS: deactivated 4 devices")
+
+		self.assertEqual(
+			list(APNSDevice.objects.filter(active=True).values_list("registration_id", flat=True)), ["%064x" % (3)]
+		)
+
+	def test_prune_devices_invalid_sizes(self):
+		with mock.patch("push_notifications.models.get_expired_tokens") as get_expired_tokens:
+			with self.assertRaisesMessage(CommandError, "--batch-size must be at least 1"):
+				call_command("prune_devices", batch_size=0)
+			with self.assertRaisesMessage(CommandError, "--concurrency must be at least 1"):
+				call_command("prune_devices", "--platform", "gcm", "--concurrency", "0")
+		self.assertFalse(get_expired_tokens.called)
@@ -1,8 +1,10 @@
 import json
 from django.test import TestCase
 from django.utils import timezone
+from push_notifications.fields import hash_registration_id
 from push_notifications.gcm import GCMError, send_bulk_message
-from push_notifications.models import GCMDevice, APNSDevice
+from push_notifications.models import GCMDevice, APNSDevice, WNSDevice, WebPushDevice
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 from ._mock import mock
 
 
@@ -166,6 +168,23 @@ class ModelTestCase(TestCase):
 			assert GCMDevice.objects.get(registration_id="abc1").active
 			assert not GCMDevice.objects.get(registration_id="abc2").active
 
+	def test_gcm_send_message_to_multiple_devices_result(self):
+		self._create_devices(["abc", "abc1", "abc2"])
+		self._create_fcm_devices(["def"])
+
+		with mock.patch(
+			"push_notifications.gcm._gcm_send", return_value=GCM_JSON_RESPONSE_ERROR
+		), mock.patch(
+			"push_notifications.gcm._fcm_send", return_value=GCM_JSON_RESPONSE
+		):
+			result = GCMDevice.objects.all().send_message("Hello world")
+
+		self.assertEqual((result.total, result.success, result.failure), (4, 2, 2))
+		self.assertEqual(len(result.timings), 2)
+		self.assertEqual(
+			sorted(result.failures()), [("abc", "NotRegistered"), ("abc2", "InvalidRegistration")]
+		)
+
 	def test_gcm_send_message_to_multiple_devices_with_error_b(self):
 		self._create_devices(["abc", "abc1", "abc2"])
 
@@ -179,6 +198,55 @@ class ModelTestCase(TestCase):
 			assert GCMDevice.objects.get(registration_id="abc1").active is True
 			assert GCMDevice.objects.get(registration_id="abc2").active is False
 
+	def test_gcm_send_message_to_multiple_devices_without_raising(self):
+		self._create_devices(["abc", "abc1", "abc2", "abc3"])
+		errors = []
+		responses = [GCM_JSON_RESPONSE_ERROR_B, IOError("Connection reset")]
+
+		def send(payload, content_type):
+			response = responses.pop(0)
+			if isinstance(response, Exception):
+				raise response
+			return response
+
+		with mock.patch.dict(SETTINGS, {"GCM_MAX_RECIPIENTS": 3}):
+			with mock.patch("push_notifications.gcm._gcm_send", side_effect=send):
+				result = GCMDevice.objects.all().send_message(
+					"Hello World", on_error=lambda registration_id, error: errors.append((registration_id, error))
+				)
+
+		self.assertEqual((result.total, result.failure), (4, 3))
+		self.assertEqual(list(result.failures()), [
+			("abc", "MismatchSenderId"), ("abc2", "InvalidRegistration"), ("abc3", IOError.__name__),
+		])
+		self.assertEqual([registration_id for registration_id, error in errors], ["abc", "abc2", "abc3"])
+		self.assertIsInstance(errors[2][1], IOError)
+		self.assertFalse(GCMDevice.objects.get(registration_id="abc2").active)
+
+	def test_gcm_send_bulk_message_raise_errors_false(self):
+		with mock.patch("push_notifications.gcm._gcm_send", return_value=GCM_JSON_RESPONSE_ERROR_B):
+			on_error = mock.Mock()
+			response = send_bulk_message(["abc", "abc1", "abc2"], {"message": "Hello"}, None, "GCM", on_error=on_error)
+		self.assertEqual(response["failure"], 2)
+		on_error.assert_has_calls([mock.call("abc", "MismatchSenderId"), mock.call("abc2", "InvalidRegistration")])
+
+		self._create_devices(["abc", "abc1", "abc2"])
+		with mock.patch("push_notifications.gcm._gcm_send", return_value=GCM_JSON_RESPONSE_ERROR_B):
+			result = GCMDevice.objects.all().send_message("Hello World", raise_errors=False)
+		self.assertEqual(result.failure, 2)
+
+	def test_wns_send_message_to_multiple_devices_without_raising(self):
+		from push_notifications.wns import WNSNotificationResponseError, WNSResult
+		WNSDevice.objects.create(registration_id="https://example.com/one")
+		WNSDevice.objects.create(registration_id="https://example.com/two")
+		error = WNSNotificationResponseError("HTTP 410: The channel expired.")
+
+		with mock.patch("push_notifications.wns.wns_send_message", side_effect=[
+			error, WNSResult("https://example.com/two", "received", "1", "connected", 0.1)
+		]):
+			result = WNSDevice.objects.order_by("pk").send_message("Hello World", raise_errors=False)
+		self.assertEqual(list(result.failures()), [("https://example.com/one", "WNSNotificationResponseError")])
+
 	def test_gcm_send_message_to_multiple_devices_with_canonical_id(self):
 		self._create_devices(["foo", "bar"])
 		with mock.patch(
@@ -212,6 +280,38 @@ class ModelTestCase(TestCase):
 		assert first_device.active is True
 		assert second_device.active is False
 
+	def test_gcm_canonical_id_held_by_other_cloud_type(self):
+		GCMDevice.objects.create(registration_id="foo", active=True)
+		GCMDevice.objects.create(registration_id="bar", active=True, cloud_message_type="FCM")
+		GCMDevice.objects.create(registration_id="baz", active=True)
+		GCMDevice.objects.create(registration_id="NEW_REGISTRATION_ID", active=True, cloud_message_type="FCM")
+		response = GCM_JSON_CANONICAL_ID_SAME_DEVICE_RESPONSE.replace('"bar"', '"NEW_REGISTRATION_ID"')
+		with mock.patch("push_notifications.gcm._gcm_send", return_value=response):
+			GCMDevice.objects.filter(cloud_message_type="GCM").order_by("pk").send_message("Hello World")
+
+		# The device holding the canonical ID isn't touched, the duplicate is deactivated
+		self.assertEqual(
+			list(GCMDevice.objects.order_by("pk").values_list("registration_id", "cloud_message_type", "active")), [
+				("foo", "GCM", False), ("bar", "FCM", True), ("baz", "GCM", True),
+				("NEW_REGISTRATION_ID", "FCM", True),
+			]
+		)
+
+	def test_gcm_canonical_id_held_by_inactive_device(self):
+		GCMDevice.objects.create(registration_id="foo", active=True)
+		GCMDevice.objects.create(registration_id="bar", active=True)
+		GCMDevice.objects.create(registration_id="NEW_REGISTRATION_ID", active=False, cloud_message_type="FCM")
+		response = GCM_JSON_CANONICAL_ID_SAME_DEVICE_RESPONSE.replace('"bar"', '"NEW_REGISTRATION_ID"')
+		with mock.patch("push_notifications.gcm._gcm_send", return_value=response):
+			GCMDevice.objects.filter(cloud_message_type="GCM").order_by("pk").send_message("Hello World")
+
+		# The stale inactive device is replaced by the device GCM reported the canonical ID of
+		self.assertEqual(
+			list(GCMDevice.objects.order_by("pk").values_list("registration_id", "cloud_message_type", "active")), [
+				("NEW_REGISTRATION_ID", "GCM", True), ("bar", "GCM", True),
+			]
+		)
+
 	def test_fcm_send_message(self):
 		device = GCMDevice.objects.create(registration_id="abc", cloud_message_type="FCM")
 		with mock.patch(
@@ -423,3 +523,191 @@ class ModelTestCase(TestCase):
 		self.assertIsNotNone(device.pk)
 		self.assertIsNotNone(device.date_created)
 		self.assertEqual(device.date_created.date(), timezone.now().date())
+
+
+class DeviceManagerRegisterTestCase(TestCase):
+	def test_register_creates_then_updates(self):
+		device, created = APNSDevice.objects.register("abc", name="iPhone")
+		self.assertTrue(created)
+		self.assertEqual(device.name, "iPhone")
+		self.assertTrue(device.active)
+		self.assertIsNotNone(device.date_created)
+
+		same_device, created = APNSDevice.objects.register("abc", active=False)
+		self.assertFalse(created)
+		self.assertEqual(same_device.pk, device.pk)
+		self.assertEqual(same_device.name, "iPhone")
+		self.assertFalse(same_device.active)
+		self.assertEqual(same_device.date_created, device.date_created)
+		self.assertEqual(APNSDevice.objects.count(), 1)
+
+	def test_register_without_unique_registration_id(self):
+		device, created = GCMDevice.objects.register("abc", device_id="0x1031af3b")
+		self.assertTrue(created)
+		same_device, created = GCMDevice.objects.register("abc", cloud_message_type="FCM")
+		self.assertFalse(created)
+		self.assertEqual(same_device.pk, device.pk)
+		self.assertEqual(same_device.cloud_message_type, "FCM")
+
+	def test_register_mysql_found_rows(self):
+		device = APNSDevice.objects.create(registration_id="abc")
+		connection = mock.MagicMock(vendor="mysql")
+		connection.ops.quote_name.side_effect = lambda name: "`%s`" % (name)
+		cursor = connection.cursor.return_value.__enter__.return_value
+		# An unchanged row counts as 1 affected row, like an insert
+		cursor.lastrowid, cursor.rowcount = device.pk, 1
+
+		with mock.patch("push_notifications.models.connections", {"default": connection}):
+			cursor.fetchone.return_value = (device.pk, )
+			self.assertEqual(APNSDevice.objects.register("abc"), (device, False))
+			cursor.fetchone.return_value = None
+			self.assertEqual(APNSDevice.objects.register("abc"), (device, True))
+		self.assertIn("ON DUPLICATE KEY UPDATE", cursor.execute.call_args[0][0])
+
+
+class RegistrationIDHashTestCase(TestCase):
+	def test_hash_maintained_on_save_and_update(self):
+		device = GCMDevice.objects.create(registration_id="abc")
+		self.assertEqual(device.registration_id_hash, hash_registration_id("abc"))
+
+		GCMDevice.objects.filter(pk=device.pk).update(registration_id="xyz")
+		device = GCMDevice.objects.get(pk=device.pk)
+		self.assertEqual(device.registration_id_hash, hash_registration_id("xyz"))
+
+		device.registration_id = "def"
+		device.save()
+		self.assertEqual(GCMDevice.objects.get(pk=device.pk).registration_id_hash, hash_registration_id("def"))
+
+	def test_hash_maintained_with_update_fields(self):
+		device = GCMDevice.objects.create(registration_id="a")
+		device.registration_id = "b"
+		device.save(update_fields=["registration_id"])
+		self.assertEqual(list(GCMDevice.objects.filter(registration_id="b")), [device])
+		self.assertFalse(GCMDevice.objects.filter(registration_id="a").exists())
+
+		# Saving other fields leaves the digest alone
+		device.name = "phone"
+		device.save(update_fields=("name",))
+		self.assertEqual(GCMDevice.objects.get(registration_id="b").name, "phone")
+
+	def test_lookups_use_hash(self):
+		device = WNSDevice.objects.create(registration_id="https://example.com/?token=abc")
+		queryset = WNSDevice.objects.filter(registration_id="https://example.com/?token=abc")
+		self.assertIn("registration_id_hash", str(queryset.query))
+		self.assertEqual(list(queryset), [device])
+
+		queryset = WNSDevice.objects.filter(registration_id__in=["https://example.com/?token=abc", "foo"])
+		self.assertIn("registration_id_hash", str(queryset.query))
+		self.assertEqual(list(queryset), [device])
+		self.assertFalse(WNSDevice.objects.filter(registration_id__in=[]).exists())
+
+
+class SendToUsersTestCase(TestCase):
+	def setUp(self):
+		from django.contrib.auth.models import User
+		self.user = User.objects.create(username="jane")
+		other_user = User.objects.create(username="bob")
+		self.gcm = GCMDevice.objects.create(registration_id="abc", user=self.user)
+		self.fcm = GCMDevice.objects.create(registration_id="def", user=self.user, cloud_message_type="FCM")
+		self.apns = APNSDevice.objects.create(registration_id="616263", user=self.user)
+		self.wns = WNSDevice.objects.create(registration_id="https://example.com/abc", user=self.user)
+		self.webpush = WebPushDevice.objects.create(
+			registration_id="https://push.example.com/abc", p256dh="key", auth="secret", user=self.user
+		)
+		self.expired_webpush = WebPushDevice.objects.create(
+			registration_id="https://push.example.com/def", p256dh="key2", auth="secret2", user=self.user
+		)
+		GCMDevice.objects.create(registration_id="xyz", user=self.user, active=False)
+		GCMDevice.objects.create(registration_id="other", user=other_user)
+
+	def test_send_to_users(self):
+		from push_notifications.models import DeviceSendResult, send_to_users
+		from push_notifications.webpush import WebPushResult
+		from push_notifications.wns import WNSBulkResult, WNSResult
+
+		def send_bulk_message(**kwargs):
+			if kwargs["cloud_type"] == "FCM":
+				kwargs["on_error"]("def", "Unavailable")
+
+		with mock.patch(
+			"push_notifications.gcm.send_bulk_message", side_effect=send_bulk_message
+		) as gcm, mock.patch("push_notifications.apns.apns_send_bulk_message") as apns, mock.patch(
+			"push_notifications.wns.wns_send_bulk_message",
+			return_value=WNSBulkResult([WNSResult("https://example.com/abc", "received", "1", "connected", 0.1)])
+		) as wns, mock.patch("push_notifications.webpush.webpush_send_bulk_message", return_value=[
+			WebPushResult("https://push.example.com/abc", 201, 0.1),
+			WebPushResult("https://push.example.com/def", 410, 0.1),
+		]) as webpush:
+			results = send_to_users(
+				[self.user.pk], "Hello world", title="Hi", extra={"foo": "bar"},
+				gcm_kwargs={"collapse_key": "test_key"}, apns_kwargs={"badge": 1}, webpush_kwargs={"ttl": 60}
+			)
+
+		self.assertEqual(sorted(results), sorted([
+			DeviceSendResult("gcm", self.gcm.pk, "abc", None),
+			DeviceSendResult("gcm", self.fcm.pk, "def", "Unavailable"),
+			DeviceSendResult("apns", self.apns.pk, "616263", None),
+			DeviceSendResult("wns", self.wns.pk, "https://example.com/abc", None),
+			DeviceSendResult("webpush", self.webpush.pk, "https://push.example.com/abc", None),
+			DeviceSendResult("webpush", self.expired_webpush.pk, "https://push.example.com/def", "Expired"),
+		]))
+		gcm.assert_any_call(
+			registration_ids=["def"], data_payload={"foo": "bar"},
+			notification_payload={"body": "Hello world", "title": "Hi"}, cloud_type="FCM", collapse_key="test_key",
+			on_error=mock.ANY
+		)
+		apns.assert_called_once_with(registration_ids=["616263"], alert="Hello world", badge=1, extra={"foo": "bar"})
+		wns.assert_called_once_with(uri_list=["https://example.com/abc"], message="Hello world", on_error=mock.ANY)
+		webpush.assert_called_once_with(
+			[("https://push.example.com/abc", "key", "secret"), ("https://push.example.com/def", "key2", "secret2")],
+			{"foo": "bar", "message": "Hello world"}, on_error=mock.ANY, ttl=60
+		)
+
+	def test_send_to_users_device_errors(self):
+		from push_notifications.models import DeviceSendResult, send_to_users
+		from push_notifications.wns import WNSNotificationResponseError, WNSResult
+
+		GCMDevice.objects.filter(user=self.user).update(cloud_message_type="FCM")
+		APNSDevice.objects.all().delete()
+		WebPushDevice.objects.all().delete()
+		wns2 = WNSDevice.objects.create(registration_id="https://example.com/def", user=self.user)
+		error = WNSNotificationResponseError("HTTP 406: The cloud service exceeded its throttle limit", status=406)
+
+		wns3 = WNSDevice.objects.create(registration_id="https://example.com/ghi", user=self.user)
+
+		def wns_send_message(uri, **kwargs):
+			if uri == "https://example.com/abc":
+				raise error
+			if uri == "https://example.com/ghi":
+				return WNSResult(uri, "channelthrottled", "1", "connected", 0.1)
+			return WNSResult(uri, "received", "1", "connected", 0.1)
+
+		with mock.patch.dict(SETTINGS, {"FCM_MAX_RECIPIENTS": 1}), mock.patch(
+			"push_notifications.gcm._fcm_send", side_effect=[
+				json.dumps({"failure": 1, "results": [{"error": "Unavailable"}]}),
+				json.dumps({"success": 1, "results": [{"message_id": "1"}]}),
+			]
+		), mock.patch("push_notifications.wns.wns_send_message", side_effect=wns_send_message):
+			results = send_to_users([self.user.pk], "Hello world", concurrent=False)
+
+		# The failures don't stop the other chunks and devices, which are reported as sent
+		self.assertEqual(sorted(results), sorted([
+			DeviceSendResult("gcm", self.gcm.pk, "abc", "Unavailable"),
+			DeviceSendResult("gcm", self.fcm.pk, "def", None),
+			DeviceSendResult("wns", self.wns.pk, "https://example.com/abc", error),
+			DeviceSendResult("wns", wns2.pk, "https://example.com/def", None),
+			DeviceSendResult("wns", wns3.pk, "https://example.com/ghi", "channelthrottled"),
+		]))
+
+	def test_send_to_users_platform_error(self):
+		from push_notifications.apns import APNSError
+		from push_notifications.models import send_to_users
+
+		with mock.patch(
+			"push_notifications.apns.apns_send_bulk_message", side_effect=APNSError("boom")
+		), mock.patch("push_notifications.gcm.send_bulk_message", return_value={}), mock.patch(
+			"push_notifications.wns.wns_send_bulk_message", return_value=[]
+		), mock.patch("push_notifications.webpush.webpush_send_bulk_message", return_value=[None, None]):
+			results = send_to_users([self.user.pk], "Hello world", concurrent=False)
+		self.assertEqual(len(results), 6)
+		self.assertEqual([r.platform for r in results if r.error is not None], ["apns"])
@@ -0,0 +1,201 @@
+import json
+from datetime import timedelta
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from django.utils.six import StringIO
+from push_notifications.models import APNSDevice, GCMDevice, PushJob
+from push_notifications.pipeline import DatabaseBroker, get_broker, process_job, reset_broker
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from ._mock import mock
+
+
+class PipelineTestCase(TestCase):
+	def setUp(self):
+		patcher = mock.patch.dict(SETTINGS, {
+			"QUEUE_BROKER": "push_notifications.pipeline.LocalBroker",
+			"QUEUE_CHUNK_SIZE": 2,
+			"QUEUE_RETRY_DELAY": 0,
+			# Threads don't share the test transaction
+			"QUEUE_CONCURRENCY": {},
+		})
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		reset_broker()
+		self.addCleanup(reset_broker)
+		for i in range(5):
+			GCMDevice.objects.create(registration_id="abc%d" % i, cloud_message_type="FCM")
+
+	def _run_worker(self):
+		out = StringIO()
+		call_command("push_worker", burst=True, timeout=0, stdout=out)
+		return out.getvalue()
+
+	def test_send_message_enqueues(self):
+		with mock.patch("push_notifications.gcm.send_bulk_message") as p:
+			job_id = GCMDevice.objects.filter(registration_id__in=["abc0", "abc1", "abc2"]).send_message(
+				"Hello world", title="Hi", extra={"foo": "bar"}
+			)
+			self.assertFalse(p.called)
+		self.assertEqual(len(get_broker()), 1)
+
+		with mock.patch("push_notifications.gcm.send_bulk_message", return_value={}) as p:
+			out = self._run_worker()
+		self.assertEqual(
+			sorted(call[1]["registration_ids"] for call in p.call_args_list), [["abc0", "abc1"], ["abc2"]]
+		)
+		for call in p.call_args_list:
+			self.assertEqual(call[1]["notification_payload"], {"body": "Hello world", "title": "Hi"})
+			self.assertEqual(call[1]["data_payload"], {"foo": "bar"})
+		self.assertIn("job %s: gcm: 3 devices split in 2 jobs" % (job_id), out)
+		self.assertIn("job %s: gcm: 2 sent, 0 failed" % (job_id + 1), out)
+		self.assertEqual(len(get_broker()), 0)
+
+	def test_broadcast_split_in_jobs(self):
+		pks = list(GCMDevice.objects.order_by("pk").values_list("pk", flat=True))
+		broker = get_broker()
+		GCMDevice.objects.all().send_message("Hello world")
+		job_id, job = broker.dequeue(timeout=0)
+		with mock.patch.dict(SETTINGS, {"QUEUE_CONCURRENCY": {"gcm": 2}}):
+			with mock.patch("push_notifications.gcm.send_bulk_message") as p:
+				process_job(broker, job)
+		# Nothing is sent by the job of the whole audience, it is split in jobs of two chunks
+		self.assertFalse(p.called)
+		jobs = [broker.dequeue(timeout=0)[1] for i in range(len(broker))]
+		self.assertEqual([job["pks"] for job in jobs], [pks[:4], pks[4:]])
+		self.assertEqual([job["args"] for job in jobs], [["Hello world", None]] * 2)
+
+	def test_job_audience(self):
+		pks = list(GCMDevice.objects.order_by("pk").values_list("pk", flat=True))
+		GCMDevice.objects.filter(pk=pks[4]).update(active=False)
+		# A single aggregate query, whatever the size of the audience
+		with self.assertNumQueries(1):
+			GCMDevice.objects.filter(registration_id__in=["abc1", "abc2", "abc4"], cloud_message_type="FCM").send_message(
+				"Hello world"
+			)
+		job_id, job = get_broker().dequeue(timeout=0)
+		self.assertEqual(job["filter"], {"registration_id__in": ["abc1", "abc2", "abc4"], "cloud_message_type__exact": "FCM"})
+		self.assertEqual(job["pk_range"], [pks[1], pks[2] + 1])
+		self.assertNotIn("pk_runs", job)
+
+		# Filters through relations are stored as runs of consecutive primary keys
+		GCMDevice.objects.filter(pk=pks[2]).update(active=False)
+		GCMDevice.objects.filter(user__isnull=True).exclude(registration_id="abc3").send_message("Hello world")
+		job_id, job = get_broker().dequeue(timeout=0)
+		self.assertEqual(job["pk_runs"], [[pks[0], pks[1] + 1]])
+		self.assertNotIn("filter", job)
+
+	def test_audience_read_by_pages(self):
+		pks = list(GCMDevice.objects.order_by("pk").values_list("pk", flat=True))
+		GCMDevice.objects.filter(pk=pks[1]).update(active=False)
+		broker = get_broker()
+		GCMDevice.objects.filter(cloud_message_type="FCM").send_message("Hello world")
+		with mock.patch("push_notifications.pipeline.DISPATCH_BATCHES", 1):
+			results, failed = process_job(broker, broker.dequeue(timeout=0)[1])
+			self.assertEqual(results, ["gcm: 2 devices split in 1 jobs, the next devices are read by job 2"])
+			jobs = [broker.dequeue(timeout=0)[1] for i in range(len(broker))]
+			self.assertEqual(jobs[0]["pks"], [pks[0], pks[2]])
+			self.assertNotIn("filter", jobs[0])
+			self.assertEqual(jobs[1]["pk_range"], [pks[2] + 1, pks[4] + 1])
+			process_job(broker, jobs[1])
+		jobs = [broker.dequeue(timeout=0)[1] for i in range(len(broker))]
+		self.assertEqual(jobs[0]["pks"], pks[3:])
+		# The last job reads an empty range
+		self.assertEqual(jobs[1]["pk_range"], [pks[4] + 1, pks[4] + 1])
+		self.assertEqual(process_job(broker, jobs[1]), (["gcm: 0 devices split in 0 jobs"], 0))
+
+	def test_send_message_not_enqueued(self):
+		with mock.patch("push_notifications.gcm.send_bulk_message", return_value={}) as p:
+			GCMDevice.objects.all().send_message("Hello world", enqueue=False)
+		self.assertTrue(p.called)
+		self.assertEqual(len(get_broker()), 0)
+
+	def test_failed_chunks_retried(self):
+		GCMDevice.objects.all().send_message("Hello world")
+
+		def send(registration_ids, **kwargs):
+			if "abc2" in registration_ids:
+				raise IOError("Connection reset")
+			return {}
+
+		with mock.patch.dict(SETTINGS, {"QUEUE_MAX_RETRIES": 2}):
+			with mock.patch("push_notifications.gcm.send_bulk_message", side_effect=send) as p:
+				out = self._run_worker()
+
+		# The failing chunk is tried three times, the other two once
+		self.assertEqual(p.call_count, 5)
+		self.assertEqual(out.count("1 chunks failed"), 3)
+		self.assertEqual(len(get_broker()), 0)
+
+	def test_only_transient_failures_retried(self):
+		GCMDevice.objects.all().send_message("Hello world")
+		errors = {"abc1": "Unavailable", "abc3": "NotRegistered"}
+
+		def send(payload, content_type):
+			registration_ids = json.loads(payload.decode("utf-8"))["registration_ids"]
+			results = [
+				{"error": errors[r]} if r in errors else {"message_id": "1"} for r in registration_ids
+			]
+			failure = len([result for result in results if "error" in result])
+			return json.dumps({
+				"success": len(results) - failure, "failure": failure, "canonical_ids": 0, "results": results
+			})
+
+		with mock.patch.dict(SETTINGS, {"QUEUE_MAX_RETRIES": 1}):
+			with mock.patch("push_notifications.gcm._fcm_send", side_effect=send) as p:
+				out = self._run_worker()
+
+		sent = [json.loads(call[0][0].decode("utf-8"))["registration_ids"] for call in p.call_args_list]
+		# The delivered devices and the unregistered one aren't sent again
+		self.assertEqual(sorted(sent), [["abc0", "abc1"], ["abc1"], ["abc2", "abc3"], ["abc4"]])
+		self.assertEqual(out.count("1 chunks failed"), 2)
+		self.assertFalse(GCMDevice.objects.get(registration_id="abc3").active)
+
+	def test_apns_job(self):
+		APNSDevice.objects.create(registration_id="616263")
+		APNSDevice.objects.all().send_message("Hello world", badge=1)
+		with mock.patch("push_notifications.apns.apns_send_bulk_message") as p:
+			self._run_worker()
+		p.assert_called_once_with(registration_ids=["616263"], alert="Hello world", badge=1)
+
+	def test_worker_requires_broker(self):
+		from django.core.management.base import CommandError
+		with mock.patch.dict(SETTINGS, {"QUEUE_BROKER": None}):
+			reset_broker()
+			with self.assertRaises(CommandError):
+				self._run_worker()
+
+
+class DatabaseBrokerTestCase(TestCase):
+	def test_enqueue_dequeue(self):
+		broker = DatabaseBroker(visibility_timeout=60, poll_interval=0)
+		first = broker.enqueue({"n": 1})
+		broker.enqueue({"n": 2}, delay=60)
+
+		self.assertEqual(broker.dequeue(timeout=0), (first, {"n": 1}))
+		# The dequeued job is hidden until acked, the other one isn't available yet
+		self.assertIsNone(broker.dequeue(timeout=0))
+		broker.ack(first)
+		self.assertEqual(PushJob.objects.count(), 1)
+
+	def test_visibility_timeout(self):
+		broker = DatabaseBroker(visibility_timeout=60, poll_interval=0)
+		job_id = broker.enqueue({"n": 1})
+		broker.dequeue(timeout=0)
+		PushJob.objects.filter(pk=job_id).update(available_at=timezone.now() - timedelta(seconds=1))
+		self.assertEqual(broker.dequeue(timeout=0), (job_id, {"n": 1}))
+
+	def test_failed_job_not_acked(self):
+		with mock.patch.dict(SETTINGS, {
+			"QUEUE_BROKER": "push_notifications.pipeline.DatabaseBroker",
+			"QUEUE_BROKER_OPTIONS": {"visibility_timeout": 60, "poll_interval": 0},
+		}):
+			reset_broker()
+			self.addCleanup(reset_broker)
+			job_id = get_broker().enqueue({"n": 1})
+			err = StringIO()
+			with mock.patch("push_notifications.pipeline.process_job", side_effect=ValueError("boom")):
+				call_command("push_worker", burst=True, timeout=0, stdout=StringIO(), stderr=err)
+		self.assertIn("job %s: ValueError" % (job_id), err.getvalue())
+		# Left for another worker once the visibility timeout expires
+		self.assertTrue(PushJob.objects.filter(pk=job_id).exists())
@@ -0,0 +1,97 @@
+import json
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+from push_notifications.models import GCMDevice, WNSDevice
+from push_notifications.probe import probe_devices
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from push_notifications.wns import WNSNotificationResponseError
+from ._mock import mock
+
+
+def cm_send(payload, content_type):
+	# Devices named "dead..." are unregistered, "gone..." invalid
+	values = json.loads(payload.decode("utf-8"))
+	assert values["dry_run"] is True
+	results = []
+	for registration_id in values["registration_ids"]:
+		if registration_id.startswith("dead"):
+			results.append({"error": "NotRegistered"})
+		elif registration_id.startswith("gone"):
+			results.append({"error": "InvalidRegistration"})
+		elif registration_id.startswith("busy"):
+			results.append({"error": "Unavailable"})
+		else:
+			results.append({"message_id": "fake_message_id"})
+	return json.dumps({"multicast_id": 1, "results": results})
+
+
+def wns_send(uri, data, wns_type, extra_headers, access_token):
+	assert (wns_type, extra_headers) == ("wns/raw", {"X-WNS-Cache-Policy": "no-cache"})
+	assert access_token == "token"
+	if uri.endswith("/expired"):
+		raise WNSNotificationResponseError("HTTP 410: The channel expired.", status=410)
+	if uri.endswith("/throttled"):
+		raise WNSNotificationResponseError("HTTP 406: The cloud service exceeded its throttle limit", status=406)
+
+
+class ProbeTestCase(TestCase):
+	def setUp(self):
+		for registration_id in ("ok1", "dead1", "ok2", "gone1", "busy1", "dead2", "ok3"):
+			GCMDevice.objects.create(registration_id=registration_id + "-gcm", cloud_message_type="GCM")
+			GCMDevice.objects.create(registration_id=registration_id, cloud_message_type="FCM")
+		GCMDevice.objects.create(registration_id="dead-inactive", cloud_message_type="FCM", active=False)
+		for name in ("ok", "expired", "throttled"):
+			WNSDevice.objects.create(registration_id="https://wns.example.com/" + name)
+
+	def test_probe_fcm_devices(self):
+		with mock.patch.dict(SETTINGS, {"FCM_MAX_RECIPIENTS": 3}):
+			with mock.patch("push_notifications.gcm._fcm_send", side_effect=cm_send) as send:
+				dead, errors = probe_devices(GCMDevice.objects.filter(cloud_message_type="FCM"), concurrency=2)
+		self.assertEqual(send.call_count, 3)
+		self.assertEqual(sorted(dead), ["dead1", "dead2", "gone1"])
+		self.assertEqual(errors, [])
+		# Probing deactivates nothing
+		self.assertEqual(GCMDevice.objects.filter(active=False).count(), 1)
+
+	@mock.patch("push_notifications.wns._wns_authenticate", return_value="token")
+	def test_probe_wns_devices(self, authenticate):
+		with mock.patch("push_notifications.wns._wns_send", side_effect=wns_send):
+			dead, errors = probe_devices(WNSDevice.objects.all(), wns_raw_probes=True)
+		self.assertEqual(dead, ["https://wns.example.com/expired"])
+		self.assertEqual([e.status for e in errors], [406])
+		# The probes share one access token
+		authenticate.assert_called_once_with()
+
+	@mock.patch("push_notifications.wns._wns_send")
+	def test_probe_wns_devices_requires_opt_in(self, send):
+		with self.assertRaises(ValueError):
+			probe_devices(WNSDevice.objects.all())
+		with self.assertRaises(CommandError):
+			call_command("prune_devices", platforms=["wns"], stdout=StringIO())
+		send.assert_not_called()
+		self.assertFalse(WNSDevice.objects.filter(active=False).exists())
+
+	def test_prune_devices_probes(self):
+		out, err = StringIO(), StringIO()
+		with mock.patch("push_notifications.gcm._fcm_send", side_effect=cm_send):
+			with mock.patch("push_notifications.gcm._gcm_send", side_effect=cm_send):
+				with mock.patch("push_notifications.wns._wns_send", side_effect=wns_send):
+					with mock.patch("push_notifications.wns._wns_authenticate", return_value="token"):
+						call_command(
+							"prune_devices", platforms=["gcm", "wns"], wns_raw_probes=True, stdout=out, stderr=err
+						)
+
+		self.assertEqual(
+			sorted(GCMDevice.objects.filter(active=False).values_list("registration_id", flat=True)),
+			["dead-inactive", "dead1", "dead1-gcm", "dead2", "dead2-gcm", "gone1", "gone1-gcm"]
+		)
+		self.assertEqual(
+			list(WNSDevice.objects.filter(active=False).values_list("registration_id", flat=True)),
+			["https://wns.example.com/expired"]
+		)
+		self.assertEqual(
+			[line for line in out.getvalue().splitlines() if ": " in line and "batch" not in line],
+			["GCM: deactivated 3 devices", "FCM: deactivated 3 devices", "WNS: deactivated 1 devices"]
+		)
+		self.assertIn("WNS probe failed", err.getvalue())
@@ -0,0 +1,76 @@
+from django.core.cache import caches
+from django.test import TestCase
+from push_notifications import ratelimit
+from push_notifications.gcm import send_bulk_message
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from ._mock import mock
+
+
+class TokenBucketTestCase(TestCase):
+	def test_acquire(self):
+		with mock.patch("push_notifications.ratelimit.default_timer", return_value=100):
+			bucket = ratelimit.TokenBucket(rate=10, burst=2)
+			with mock.patch("push_notifications.ratelimit.sleep") as sleep:
+				self.assertEqual(bucket.acquire(), 0)
+				self.assertEqual(bucket.acquire(), 0)
+				self.assertFalse(sleep.called)
+				# The bucket is empty, a token is refilled every 0.1 seconds
+				self.assertAlmostEqual(bucket.acquire(), 0.1)
+				self.assertAlmostEqual(bucket.acquire(), 0.2)
+				self.assertEqual(sleep.call_count, 2)
+
+		with mock.patch("push_notifications.ratelimit.default_timer", return_value=101):
+			with mock.patch("push_notifications.ratelimit.sleep") as sleep:
+				self.assertEqual(bucket.acquire(), 0)
+				self.assertFalse(sleep.called)
+
+	def test_cache_bucket(self):
+		self.addCleanup(caches["default"].clear)
+		bucket = ratelimit.CacheTokenBucket(rate=2, burst=2, cache="default", key="test")
+		with mock.patch("push_notifications.ratelimit.time", side_effect=[10.9, 10.9, 11.0, 11.2, 13]):
+			with mock.patch("push_notifications.ratelimit.sleep") as sleep:
+				self.assertEqual(bucket.acquire(), 0)
+				self.assertEqual(bucket.acquire(), 0)
+				# The bucket is empty, a token is refilled every 0.5 seconds
+				self.assertAlmostEqual(bucket.acquire(), 0.4)
+				self.assertAlmostEqual(bucket.acquire(), 0.7)
+				self.assertEqual(sleep.call_count, 2)
+				# Refilled up to the burst
+				self.assertEqual(bucket.acquire(), 0)
+				self.assertEqual(caches["default"].get("test"), (1, 13))
+
+
+class RateLimitTestCase(TestCase):
+	def setUp(self):
+		ratelimit.reset_buckets()
+		self.addCleanup(ratelimit.reset_buckets)
+
+	def test_get_bucket(self):
+		limits = {"FCM": {"rate": 10}, "APNS:/certs/b.pem": {"rate": 5, "burst": 20}}
+		with mock.patch.dict(SETTINGS, {"RATE_LIMITS": limits}):
+			fcm = ratelimit.get_bucket("FCM", "key")
+			self.assertEqual((fcm.rate, fcm.burst), (10, 10))
+			self.assertIs(ratelimit.get_bucket("FCM", "other key"), fcm)
+			self.assertIsNone(ratelimit.get_bucket("GCM", "key"))
+			self.assertIsNone(ratelimit.get_bucket("APNS", "/certs/a.pem"))
+			apns = ratelimit.get_bucket("APNS", "/certs/b.pem")
+			self.assertEqual((apns.rate, apns.burst), (5, 20))
+
+	def test_credentials_not_in_keys(self):
+		limits = {"FCM:secret-key": {"rate": 10, "cache": "default"}}
+		with mock.patch.dict(SETTINGS, {"RATE_LIMITS": limits}):
+			bucket = ratelimit.get_bucket("FCM", "secret-key")
+		self.assertIsInstance(bucket, ratelimit.CacheTokenBucket)
+		self.assertTrue(bucket.key.startswith("push_notifications:ratelimit:FCM:"))
+		self.assertNotIn("secret-key", bucket.key)
+		self.assertNotIn("secret-key", "".join(ratelimit._buckets))
+
+	def test_gcm_requests_throttled(self):
+		response = mock.MagicMock()
+		response.read.return_value = b'{"results": [{"message_id": "1"}, {"message_id": "2"}]}'
+		settings = {"GCM_API_KEY": "key", "GCM_MAX_RECIPIENTS": 2, "RATE_LIMITS": {"GCM": {"rate": 1}}}
+		with mock.patch.dict(SETTINGS, settings):
+			with mock.patch("push_notifications.gcm.urlopen", return_value=response):
+				with mock.patch("push_notifications.ratelimit.TokenBucket.acquire") as acquire:
+					send_bulk_message(["a", "b", "c", "d"], {"message": "Hello"}, None, "GCM")
+		self.assertEqual(acquire.call_count, 2)
@@ -1,6 +1,9 @@
 from django.test import TestCase
 from rest_framework.serializers import ValidationError
 from push_notifications.api.rest_framework import APNSDeviceSerializer, GCMDeviceSerializer
+from push_notifications.models import APNSDevice, GCMDevice
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from tests._mock import mock
 
 
 GCM_DRF_INVALID_HEX_ERROR = {'device_id': [u"Device ID is not a valid hex number"]}
@@ -118,3 +121,57 @@ class GCMDeviceSerializerTestCase(TestCase):
 			"device_id": "e87a4e72d634997c",
 		})
 		self.assertTrue(serializer.is_valid())
+
+
+class DeviceListSerializerTestCase(TestCase):
+	def test_bulk_create(self):
+		serializer = GCMDeviceSerializer(data=[
+			{"registration_id": "foo", "device_id": "0x01"},
+			{"registration_id": "bar", "name": "Nexus 5"},
+		], many=True)
+		serializer.is_valid(raise_exception=True)
+		serializer.save()
+		self.assertEqual(len(serializer.created), 2)
+		self.assertEqual(GCMDevice.objects.get(registration_id="bar").name, "Nexus 5")
+		self.assertEqual(GCMDevice.objects.get(registration_id="foo").device_id, 1)
+
+	def test_bulk_create_duplicate(self):
+		GCMDevice.objects.create(registration_id="foo")
+		serializer = GCMDeviceSerializer(data=[
+			{"registration_id": "foo"}, {"registration_id": "bar"},
+		], many=True)
+		self.assertFalse(serializer.is_valid())
+
+		serializer = GCMDeviceSerializer(data=[
+			{"registration_id": "baz"}, {"registration_id": "baz"},
+		], many=True)
+		self.assertFalse(serializer.is_valid())
+
+	def test_bulk_update_on_duplicate(self):
+		GCMDevice.objects.create(registration_id="foo", name="old")
+		APNSDevice.objects.create(registration_id="ae" * 32, name="old")
+		with mock.patch.dict(SETTINGS, {"UPDATE_ON_DUPLICATE_REG_ID": True}):
+			serializer = GCMDeviceSerializer(data=[
+				{"registration_id": "foo", "name": "new", "cloud_message_type": "FCM"},
+				{"registration_id": "bar"},
+			], many=True)
+			serializer.is_valid(raise_exception=True)
+			serializer.save()
+			self.assertEqual(len(serializer.created), 1)
+			self.assertEqual(len(serializer.updated), 1)
+
+			serializer = APNSDeviceSerializer(data=[{"registration_id": "ae" * 32, "name": "new"}], many=True)
+			serializer.is_valid(raise_exception=True)
+			serializer.save()
+
+		device = GCMDevice.objects.get(registration_id="foo")
+		self.assertEqual((device.name, device.cloud_message_type), ("new", "FCM"))
+		self.assertEqual(GCMDevice.objects.count(), 2)
+		self.assertEqual(APNSDevice.objects.get().name, "new")
+
+	def test_register_context_skips_unique_check(self):
+		APNSDevice.objects.create(registration_id="ae" * 32)
+		serializer = APNSDeviceSerializer(data={"registration_id": "ae" * 32}, context={"register": True})
+		self.assertTrue(serializer.is_valid())
+		serializer = APNSDeviceSerializer(data={"registration_id": "ae" * 32})
+		self.assertFalse(serializer.is_valid())
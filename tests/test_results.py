@@ -0,0 +1,51 @@
+from django.test import TestCase
+from push_notifications.results import BroadcastResult
+
+
+class BroadcastResultTestCase(TestCase):
+	def test_counts_and_failures(self):
+		result = BroadcastResult("gcm")
+		self.assertEqual(result.add_recipients(["a", "b", "c"]), 0)
+		self.assertEqual(result.add_recipients(["d", "e"]), 3)
+		result.add_failure(1, "NotRegistered")
+		result.add_failure(3, "Unavailable")
+		result.add_failure(4, "NotRegistered")
+		result.add_timing(0.25)
+		result.add_timing(0.5)
+
+		self.assertEqual((result.total, result.success, result.failure), (5, 2, 3))
+		self.assertEqual(result.elapsed, 0.75)
+		self.assertEqual(result.errors, ["NotRegistered", "Unavailable"])
+		self.assertEqual(result.error_counts, {"NotRegistered": 2, "Unavailable": 1})
+		self.assertEqual(
+			list(result.failures()), [("b", "NotRegistered"), ("d", "Unavailable"), ("e", "NotRegistered")]
+		)
+		self.assertEqual(str(result), "gcm: 2 sent, 3 failed")
+
+	def test_empty(self):
+		result = BroadcastResult("apns")
+		self.assertEqual((result.total, result.success, result.failure, result.elapsed), (0, 0, 0, 0))
+		self.assertEqual(list(result.failures()), [])
+
+	def test_merge_and_compact(self):
+		first = BroadcastResult("gcm")
+		first.add_recipients(["a", "b", "c"])
+		first.add_failure(1, "NotRegistered")
+		first.add_timing(0.25)
+		second = BroadcastResult("gcm")
+		second.add_recipients(["d", "e"])
+		second.add_recipients(["f"])
+		second.add_failure(0, "Unavailable")
+		second.add_failure(2, "NotRegistered")
+		second.skipped = 2
+		second.add_timing(0.5)
+
+		self.assertEqual(list(second.compact().failures()), [("d", "Unavailable"), ("f", "NotRegistered")])
+		self.assertEqual(second.total, 3)
+
+		result = first.merge(second)
+		self.assertEqual((result.total, result.failure, result.skipped, result.elapsed), (6, 3, 2, 0.75))
+		self.assertEqual(
+			list(result.failures()), [("b", "NotRegistered"), ("d", "Unavailable"), ("f", "NotRegistered")]
+		)
+		self.assertEqual(result.errors, ["NotRegistered", "Unavailable"])
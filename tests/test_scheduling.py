@@ -0,0 +1,81 @@
+from datetime import datetime, time, timedelta
+import pytz
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import TestCase
+from push_notifications.models import APNSDevice, GCMDevice
+from push_notifications.pipeline import get_broker, reset_broker
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from ._mock import mock
+
+
+class ScheduleMessageTestCase(TestCase):
+	def setUp(self):
+		patcher = mock.patch.dict(SETTINGS, {
+			"QUEUE_BROKER": "push_notifications.pipeline.LocalBroker",
+			"QUEUE_CHUNK_SIZE": 2,
+		})
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		reset_broker()
+		self.addCleanup(reset_broker)
+
+	def test_window(self):
+		for i in range(5):
+			GCMDevice.objects.create(registration_id="abc%d" % i, cloud_message_type="FCM")
+		start = datetime.now(pytz.utc) + timedelta(hours=1)
+
+		scheduled = GCMDevice.objects.all().schedule_message(
+			"Hello world", title="Hi", start=start, window=timedelta(minutes=30)
+		)
+		self.assertEqual(
+			[send_at for send_at, job_id in scheduled],
+			[start, start + timedelta(minutes=10), start + timedelta(minutes=20)]
+		)
+		self.assertEqual(len(get_broker()), 3)
+		# Nothing is released before the start
+		self.assertIsNone(get_broker().dequeue(timeout=0))
+
+	def test_released_chunks_sent(self):
+		for i in range(3):
+			GCMDevice.objects.create(registration_id="abc%d" % i, cloud_message_type="GCM")
+		GCMDevice.objects.all().schedule_message("Hello world", window=timedelta(seconds=0))
+
+		with mock.patch("push_notifications.gcm.send_bulk_message", return_value={}) as p:
+			call_command("push_worker", burst=True, timeout=0)
+		self.assertEqual(
+			sorted(call[1]["registration_ids"] for call in p.call_args_list), [["abc0", "abc1"], ["abc2"]]
+		)
+
+	def test_local_time(self):
+		APNSDevice.objects.create(registration_id="01", name="Europe/Paris")
+		APNSDevice.objects.create(registration_id="02", name="America/New_York")
+		APNSDevice.objects.create(registration_id="03", name="Europe/Paris")
+		APNSDevice.objects.create(registration_id="04", name="Not a time zone")
+		start = datetime(2030, 1, 15, 12, 0, tzinfo=pytz.utc)
+
+		with mock.patch("django.utils.timezone.get_default_timezone", return_value=pytz.utc):
+			scheduled = APNSDevice.objects.all().schedule_message(
+				"Hello world", start=start, local_time=time(10, 0), timezone_field="name"
+			)
+		self.assertEqual([send_at for send_at, job_id in scheduled], [
+			datetime(2030, 1, 15, 15, 0, tzinfo=pytz.utc),
+			# 10:00 has passed in Paris, it's sent the next day
+			datetime(2030, 1, 16, 9, 0, tzinfo=pytz.utc),
+			datetime(2030, 1, 16, 10, 0, tzinfo=pytz.utc),
+		])
+
+	def test_requires_broker(self):
+		with mock.patch.dict(SETTINGS, {"QUEUE_BROKER": None}):
+			reset_broker()
+			with self.assertRaises(ImproperlyConfigured):
+				GCMDevice.objects.all().schedule_message("Hello world")
+
+	def test_without_pytz(self):
+		GCMDevice.objects.create(registration_id="abc", cloud_message_type="FCM")
+		with mock.patch.dict("sys.modules", {"pytz": None}):
+			self.assertEqual(len(GCMDevice.objects.all().schedule_message("Hello world")), 1)
+			with self.assertRaises(ImproperlyConfigured):
+				GCMDevice.objects.all().schedule_message(
+					"Hello world", local_time=time(9), timezone_field="name"
+				)
@@ -0,0 +1,89 @@
+import json
+from django.db import connection, transaction
+from django.db.transaction import TransactionManagementError
+from django.test import TransactionTestCase
+from push_notifications import sharding
+from push_notifications.gcm import GCMError
+from push_notifications.models import GCMDevice
+from push_notifications.sharding import _pk_ranges
+from ._mock import mock
+
+
+def gcm_send(data, content_type):
+	# Devices named "bad..." are unavailable
+	registration_ids = json.loads(data)["registration_ids"]
+	results = [
+		{"error": "Unavailable"} if registration_id.startswith("bad") else {"message_id": "0:1"}
+		for registration_id in registration_ids
+	]
+	failure = sum(1 for result in results if "error" in result)
+	return json.dumps({
+		"multicast_id": 1, "success": len(results) - failure, "failure": failure, "canonical_ids": 0,
+		"results": results,
+	})
+
+
+# The workers can't see the uncommitted devices of a TestCase
+class ShardedSendTestCase(TransactionTestCase):
+	def setUp(self):
+		GCMDevice.objects.bulk_create(
+			GCMDevice(registration_id="%s%i" % ("bad" if i % 4 == 0 else "dev", i), cloud_message_type="GCM")
+			for i in range(10)
+		)
+		GCMDevice.objects.create(registration_id="inactive", active=False)
+
+	def test_pk_ranges(self):
+		pks = list(GCMDevice.objects.filter(active=True).values_list("pk", flat=True))
+		ranges = _pk_ranges(GCMDevice.objects.all(), 3)
+		self.assertEqual(len(ranges), 3)
+		self.assertEqual((ranges[0][0], ranges[-1][1]), (min(pks), max(pks) + 1))
+		self.assertEqual(
+			sorted(pk for start, stop in ranges for pk in pks if start <= pk < stop), sorted(pks)
+		)
+		self.assertEqual(_pk_ranges(GCMDevice.objects.filter(registration_id="none"), 3), [])
+
+	def test_send_message_sharded(self):
+		with mock.patch("push_notifications.gcm._gcm_send", side_effect=gcm_send):
+			result = GCMDevice.objects.all().send_message_sharded(
+				"Hello", processes=2, shards=3, raise_errors=False
+			)
+		self.assertEqual((result.platform, result.total, result.failure), ("gcm", 10, 3))
+		self.assertEqual(
+			list(result.failures()), [("bad0", "Unavailable"), ("bad4", "Unavailable"), ("bad8", "Unavailable")]
+		)
+		self.assertEqual(len(result.timings), 3)
+
+	def test_send_message_sharded_raises(self):
+		with mock.patch("push_notifications.gcm._gcm_send", side_effect=gcm_send):
+			with self.assertRaises(GCMError):
+				GCMDevice.objects.filter(registration_id__startswith="bad").send_message_sharded(
+					"Hello", processes=2
+				)
+
+	def test_parent_connection_kept(self):
+		connection.ensure_connection()
+		parent_connection = connection.connection
+		with mock.patch("push_notifications.gcm._gcm_send", side_effect=gcm_send):
+			GCMDevice.objects.filter(registration_id__startswith="dev").send_message_sharded("Hello", processes=2)
+		self.assertIs(connection.connection, parent_connection)
+
+	def test_refused_within_atomic(self):
+		with mock.patch("push_notifications.gcm._gcm_send") as send:
+			with transaction.atomic():
+				with self.assertRaises(TransactionManagementError):
+					GCMDevice.objects.all().send_message_sharded("Hello", processes=2)
+		self.assertFalse(send.called)
+
+	def test_worker_sets_inherited_connections_aside(self):
+		inherited = mock.MagicMock(vendor="postgresql", settings_dict={"NAME": "push"})
+		in_memory = mock.MagicMock(vendor="sqlite", settings_dict={"NAME": ":memory:"})
+		sockets = inherited.connection, in_memory.connection
+		with mock.patch("push_notifications.sharding.connections") as connections:
+			with mock.patch("push_notifications.sharding._inherited_connections", []) as kept:
+				connections.all.return_value = [inherited, in_memory]
+				sharding._init_worker()
+		# Never closed, which would end the parent's session
+		self.assertEqual(kept, [sockets[0]])
+		self.assertIsNone(inherited.connection)
+		self.assertFalse(sockets[0].close.called)
+		self.assertIs(in_memory.connection, sockets[1])
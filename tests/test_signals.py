@@ -0,0 +1,77 @@
+from django.test import TestCase
+from push_notifications import signals
+from push_notifications.apns import apns_send_bulk_message
+from push_notifications.gcm import _handler_cm_message_json, send_bulk_message
+from push_notifications.metrics import StatsdMetrics
+from push_notifications.models import GCMDevice
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from ._mock import mock
+
+
+class SignalsTestCase(TestCase):
+	def _connect(self, signal):
+		receiver = mock.Mock()
+		signal.connect(receiver)
+		self.addCleanup(signal.disconnect, receiver)
+		return receiver
+
+	def test_gcm_request_signals(self):
+		started = self._connect(signals.request_started)
+		finished = self._connect(signals.request_finished)
+		response = mock.MagicMock()
+		response.read.return_value = b'{"results": [{"message_id": "1"}]}'
+
+		with mock.patch.dict(SETTINGS, {"FCM_API_KEY": "key"}):
+			with mock.patch("push_notifications.gcm.urlopen", return_value=response):
+				send_bulk_message(["abc"], {"message": "Hello"}, None, "FCM")
+			with mock.patch("push_notifications.gcm.urlopen", side_effect=IOError):
+				with self.assertRaises(IOError):
+					send_bulk_message(["abc"], {"message": "Hello"}, None, "FCM")
+
+		self.assertEqual(started.call_count, 2)
+		self.assertEqual(started.call_args[1]["sender"], "FCM")
+		self.assertEqual(started.call_args[1]["bytes_sent"], len(b'{"data":{"message":"Hello"},"registration_ids":["abc"]}'))
+		self.assertEqual([call[1]["error"] is None for call in finished.call_args_list], [True, False])
+
+	def test_apns_connection_reused(self):
+		opened = self._connect(signals.connection_opened)
+		with mock.patch("push_notifications.apns._apns_create_socket_to_push"):
+			apns_send_bulk_message(["616263", "646566"], "Hello")
+		self.assertEqual([call[1]["reused"] for call in opened.call_args_list], [True, True])
+
+	def test_devices_deactivated(self):
+		deactivated = self._connect(signals.devices_deactivated)
+		changed = self._connect(signals.registration_id_changed)
+		GCMDevice.objects.create(registration_id="abc", cloud_message_type="GCM")
+		GCMDevice.objects.create(registration_id="def", cloud_message_type="GCM")
+		_handler_cm_message_json(["abc", "def"], {
+			"failure": 1, "canonical_ids": 1,
+			"results": [{"error": "NotRegistered"}, {"message_id": "1", "registration_id": "ghi"}],
+		}, "GCM")
+
+		deactivated.assert_called_once_with(signal=signals.devices_deactivated, sender="GCM", registration_ids=["abc"])
+		changed.assert_called_once_with(
+			signal=signals.registration_id_changed, sender="GCM", old_registration_id="def", new_registration_id="ghi"
+		)
+
+
+class StatsdMetricsTestCase(TestCase):
+	def test_metrics(self):
+		metrics = StatsdMetrics(prefix="push").connect()
+		self.addCleanup(metrics.disconnect)
+		with mock.patch.object(metrics, "socket") as sock:
+			signals.request_started.send(sender="FCM", url="http://localhost", bytes_sent=120)
+			signals.request_finished.send(sender="FCM", url="http://localhost", elapsed=0.25, error=IOError())
+			signals.devices_deactivated.send(sender="APNS", registration_ids=["abc", "def"])
+		self.assertEqual([call[0][0] for call in sock.sendto.call_args_list], [
+			b"push.fcm.bytes_sent:120|c",
+			b"push.fcm.requests:1|c",
+			b"push.fcm.request_errors:1|c",
+			b"push.fcm.request_time:250.000|ms",
+			b"push.apns.deactivations:2|c",
+		])
+
+		metrics.disconnect()
+		with mock.patch.object(metrics, "socket") as sock:
+			signals.request_started.send(sender="FCM", url="http://localhost", bytes_sent=120)
+		self.assertFalse(sock.sendto.called)
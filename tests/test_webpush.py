@@ -0,0 +1,218 @@
+import json
+import os
+import struct
+from unittest import skipIf
+from django.test import TestCase
+from push_notifications import webpush
+from push_notifications.models import WebPushDevice
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from push_notifications.webpush import (
+	WebPushError, _b64url_decode, _b64url_encode, _hkdf, _post, _public_key_bytes, encrypt,
+	webpush_send_bulk_message
+)
+from ._mock import mock
+
+try:
+	from cryptography.hazmat.backends import default_backend
+	from cryptography.hazmat.primitives import hashes, serialization
+	from cryptography.hazmat.primitives.asymmetric import ec
+	from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+	from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+	ec = None
+
+
+def generate_subscription():
+	key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+	auth = os.urandom(16)
+	return key, auth, _b64url_encode(_public_key_bytes(key.public_key())), _b64url_encode(auth)
+
+
+def decrypt(body, key, auth):
+	salt, record_size, key_length = body[:16], struct.unpack("!I", body[16:20])[0], ord(body[20:21])
+	server_public = body[21:21 + key_length]
+	user_public = _public_key_bytes(key.public_key())
+	shared_secret = key.exchange(ec.ECDH(), webpush._load_public_key(server_public))
+	ikm = _hkdf(auth, b"WebPush: info\x00" + user_public + server_public, 32, shared_secret)
+	cek = _hkdf(salt, b"Content-Encoding: aes128gcm\x00", 16, ikm)
+	nonce = _hkdf(salt, b"Content-Encoding: nonce\x00", 12, ikm)
+	plaintext = AESGCM(cek).decrypt(nonce, body[21 + key_length:], None)
+	assert record_size == 4096
+	return plaintext.rstrip(b"\x00")[:-1]
+
+
+if ec is not None:
+	VAPID_KEY = ec.generate_private_key(ec.SECP256R1(), default_backend())
+	VAPID_PEM = VAPID_KEY.private_bytes(
+		serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+	).decode("ascii")
+
+
+@skipIf(ec is None, "WebPush requires the cryptography package")
+class WebPushTestCase(TestCase):
+	def setUp(self):
+		patcher = mock.patch.dict(SETTINGS, {"WP_PRIVATE_KEY": VAPID_PEM, "WP_CLAIMS": {"sub": "mailto:a@b.c"}})
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		webpush._private_key = None
+		webpush.vapid_tokens.clear()
+
+	def test_encrypt_round_trip(self):
+		key, auth, p256dh, auth_b64 = generate_subscription()
+		body = encrypt(b"Hello world", p256dh, auth_b64)
+		self.assertEqual(decrypt(body, key, auth), b"Hello world")
+		# Every message has its own salt and ephemeral key
+		self.assertNotEqual(body[:86], encrypt(b"Hello world", p256dh, auth_b64)[:86])
+
+	def test_encrypt_rfc8291_example(self):
+		# https://tools.ietf.org/html/rfc8291#appendix-A
+		server_key = ec.derive_private_key(
+			int(webpush.hexlify(_b64url_decode("yfWPiYE-n46HLnH0KqZOF1fJJU3MYrct3AELtAQ-oRw")), 16),
+			ec.SECP256R1(), default_backend()
+		)
+		body = encrypt(
+			b"When I grow up, I want to be a watermelon",
+			"BCVxsr7N_eNgVRqvHtD0zTZsEc6-VV-JvLexhqUzORcxaOzi6-AYWXvTBHm4bjyPjs7Vd8pZGH6SRpkNtoIAiw4",
+			"BTBZMqHH6r4Tts7J_aSIgg", salt=_b64url_decode("DGv6ra1nlYgDCS1FRnbzlw"), server_key=server_key
+		)
+		self.assertEqual(_b64url_encode(body), (
+			"DGv6ra1nlYgDCS1FRnbzlwAAEABBBP4z9KsN6nGRTbVYI_c7VJSPQTBtkgcy27mlmlMoZIIgDll6e3vCYLocInmYWAmS6TlzAC8wEqKK6PBru3jl"
+			"7A_yl95bQpu6cVPTpK4Mqgkf1CXztLVBSt2Ks3oZwbuwXPXLWyouBWLVWGNWQexSgSxsj_Qulcy4a-fN"
+		))
+
+	def test_encrypt_payload_too_large(self):
+		key, auth, p256dh, auth_b64 = generate_subscription()
+		with self.assertRaises(WebPushError):
+			encrypt(b"x" * 4096, p256dh, auth_b64)
+
+	def test_vapid_token_cached_per_origin(self):
+		with mock.patch.object(webpush.vapid_tokens, "_sign", wraps=webpush.vapid_tokens._sign) as sign:
+			header = webpush.vapid_tokens.get_authorization("https://push.example.com")
+			self.assertEqual(webpush.vapid_tokens.get_authorization("https://push.example.com"), header)
+			webpush.vapid_tokens.get_authorization("https://other.example.com")
+		self.assertEqual(sign.call_count, 2)
+
+		token, key = header[len("vapid t="):].split(", k=")
+		self.assertEqual(_b64url_decode(key), _public_key_bytes(VAPID_KEY.public_key()))
+		segments = token.split(".")
+		claims = json.loads(_b64url_decode(segments[1]).decode("utf-8"))
+		self.assertEqual(claims["aud"], "https://push.example.com")
+		self.assertEqual(claims["sub"], "mailto:a@b.c")
+		signature = _b64url_decode(segments[2])
+		VAPID_KEY.public_key().verify(
+			encode_dss_signature(int(webpush.hexlify(signature[:32]), 16), int(webpush.hexlify(signature[32:]), 16)),
+			".".join(segments[:2]).encode("ascii"), ec.ECDSA(hashes.SHA256())
+		)
+
+	def test_private_key_from_private_number(self):
+		number = VAPID_KEY.private_numbers().private_value
+		SETTINGS["WP_PRIVATE_KEY"] = _b64url_encode(webpush._int_to_bytes(number))
+		self.assertEqual(webpush.get_vapid_private_key().private_numbers().private_value, number)
+
+	@mock.patch("push_notifications.webpush.http_client.HTTPSConnection")
+	def test_post_reuses_connections(self, connection_class):
+		connection = connection_class.return_value
+		connection.getresponse.return_value.status = 201
+		connection.getresponse.return_value.read.return_value = b""
+		connection.getresponse.return_value.getheader.return_value = ""
+		webpush._connections.connections.clear()
+
+		self.assertEqual(_post("https://push.example.com/a", b"data", {}), (201, b""))
+		self.assertEqual(_post("https://push.example.com/b", b"data", {}), (201, b""))
+		self.assertEqual(connection_class.call_count, 1)
+		connection.request.assert_called_with("POST", "/b", b"data", {})
+
+		# A reused connection closed by the server is opened again
+		connection.request.side_effect = [IOError("Connection reset"), None]
+		self.assertEqual(_post("https://push.example.com/c", b"data", {}), (201, b""))
+		self.assertEqual(connection_class.call_count, 2)
+		webpush._connections.connections.clear()
+
+	def test_send_bulk_message_encrypts_per_subscription(self):
+		subscriptions = [generate_subscription() for i in range(3)]
+		sent = {}
+
+		def post(endpoint, body, headers):
+			sent[endpoint] = (body, headers)
+			return 201, b""
+
+		with mock.patch("push_notifications.webpush._post", side_effect=post):
+			results = webpush_send_bulk_message(
+				[("https://push.example.com/%i" % (i), s[2], s[3]) for i, s in enumerate(subscriptions)],
+				{"title": "Hello"}, ttl=60, max_workers=2
+			)
+		self.assertEqual([r.status for r in results], [201, 201, 201])
+		for i, (key, auth, p256dh, auth_b64) in enumerate(subscriptions):
+			body, headers = sent["https://push.example.com/%i" % (i)]
+			self.assertEqual(decrypt(body, key, auth), b'{"title":"Hello"}')
+			self.assertEqual(headers["TTL"], "60")
+			self.assertEqual(headers["Content-Encoding"], "aes128gcm")
+			self.assertTrue(headers["Authorization"].startswith("vapid t="))
+
+	def _send_and_decrypt(self, n, **kwargs):
+		subscriptions = [generate_subscription() for i in range(n)]
+		sent = {}
+
+		def post(endpoint, body, headers):
+			sent[endpoint] = body
+			return 201, b""
+
+		with mock.patch("push_notifications.webpush._post", side_effect=post):
+			results = webpush_send_bulk_message(
+				[("https://push.example.com/%i" % (i), s[2], s[3]) for i, s in enumerate(subscriptions)] +
+				[("https://push.example.com/invalid", "invalid", "invalid")],
+				"Hello", on_error=lambda endpoint, error: None, **kwargs
+			)
+		self.assertEqual([r.endpoint for r in results[:n]], ["https://push.example.com/%i" % (i) for i in range(n)])
+		self.assertIsNone(results[n])
+		for i, (key, auth, p256dh, auth_b64) in enumerate(subscriptions):
+			self.assertEqual(decrypt(sent["https://push.example.com/%i" % (i)], key, auth), b"Hello")
+		return [sent["https://push.example.com/%i" % (i)] for i in range(n)]
+
+	def test_send_bulk_message_shared_server_key(self):
+		with mock.patch.dict(SETTINGS, {"WP_SHARED_SERVER_KEY": True}):
+			bodies = self._send_and_decrypt(3)
+		# The same ephemeral key, but distinct salts
+		self.assertEqual(len(set(body[21:86] for body in bodies)), 1)
+		self.assertEqual(len(set(body[:16] for body in bodies)), 3)
+
+	def test_send_bulk_message_process_pool(self):
+		for shared in (False, True):
+			with mock.patch.dict(SETTINGS, {"WP_SHARED_SERVER_KEY": shared, "WP_ENCRYPTION_BATCH_SIZE": 2}):
+				self._send_and_decrypt(5, processes=2)
+
+	def _create_devices(self, n):
+		for i in range(n):
+			key, auth, p256dh, auth_b64 = generate_subscription()
+			WebPushDevice.objects.create(
+				registration_id="https://push.example.com/%i" % (i), p256dh=p256dh, auth=auth_b64
+			)
+
+	def test_queryset_send_message_deactivates_expired(self):
+		self._create_devices(3)
+		statuses = {"https://push.example.com/1": 410}
+		with mock.patch(
+			"push_notifications.webpush._post", side_effect=lambda e, b, h: (statuses.get(e, 201), b"")
+		):
+			result = WebPushDevice.objects.all().send_message("Hello")
+
+		self.assertEqual((result.total, result.failure), (3, 1))
+		self.assertEqual(list(result.failures()), [("https://push.example.com/1", "Expired")])
+		self.assertEqual(
+			list(WebPushDevice.objects.filter(active=False).values_list("registration_id", flat=True)),
+			["https://push.example.com/1"]
+		)
+
+	def test_queryset_send_message_errors(self):
+		self._create_devices(3)
+		statuses = {"https://push.example.com/2": 500}
+		post = mock.Mock(side_effect=lambda e, b, h: (statuses.get(e, 201), b"Internal error"))
+		with mock.patch("push_notifications.webpush._post", post):
+			with self.assertRaises(WebPushError):
+				WebPushDevice.objects.all().send_message("Hello")
+			# Every subscription is sent to before raising
+			self.assertEqual(post.call_count, 3)
+
+			result = WebPushDevice.objects.all().send_message("Hello", raise_errors=False)
+		self.assertEqual(list(result.failures()), [("https://push.example.com/2", "WebPushError")])
+		self.assertEqual(result.success, 2)
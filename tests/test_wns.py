@@ -1,7 +1,9 @@
 import xml.etree.ElementTree as ET
+from collections import Counter
 from django.test import TestCase
 from push_notifications.wns import (
-	dict_to_xml_schema, wns_send_bulk_message, wns_send_message
+	WNSBulkResult, WNSNotificationResponseError, WNSResult, WNSTemplate, _wns_send, dict_to_xml_schema,
+	dict_to_xml_string, wns_send_bulk_message, wns_send_message
 )
 from ._mock import mock
 
@@ -16,10 +18,10 @@ class WNSSendMessageTestCase(TestCase):
 		wns_send_message(uri="one", message="test message")
 		mock_method.assert_called_with(uri="one", data="this is expected", wns_type="wns/toast")
 
-	@mock.patch("push_notifications.wns.dict_to_xml_schema", return_value=ET.Element("toast"))
+	@mock.patch("push_notifications.wns.dict_to_xml_string", return_value=b"<toast />")
 	@mock.patch("push_notifications.wns._wns_send")
 	def test_send_message_calls_wns_send_with_xml(self, mock_method, _):
-		wns_send_message(uri="one", xml_data={"key": "value"})
+		wns_send_message(uri="one", xml_data={"toast": {"attrs": {"key": "value"}}})
 		mock_method.assert_called_with(uri="one", data=b"<toast />", wns_type="wns/toast")
 
 	def test_send_message_raises_TypeError_if_one_of_the_data_params_arent_filled(self):
@@ -27,6 +29,32 @@ class WNSSendMessageTestCase(TestCase):
 			wns_send_message(uri="one")
 
 
+	@mock.patch("push_notifications.wns._wns_send")
+	def test_send_message_calls_wns_send_with_template(self, mock_method):
+		template = WNSTemplate("<tile><visual>{count}</visual></tile>")
+		wns_send_message(uri="one", xml_template=template, context={"count": 3})
+		mock_method.assert_called_with(
+			uri="one", data=b"<tile><visual>3</visual></tile>", wns_type="wns/tile"
+		)
+
+
+class WNSSendTestCase(TestCase):
+	@mock.patch("push_notifications.wns._wns_authenticate", return_value="token")
+	@mock.patch("push_notifications.wns.urlopen")
+	def test_wns_send_returns_result_from_headers(self, mock_urlopen, _):
+		mock_urlopen.return_value.info.return_value = {
+			"X-WNS-Status": "received",
+			"X-WNS-Msg-ID": "1ACE6E1D4D2B9BB5",
+			"X-WNS-DeviceConnectionStatus": "connected",
+		}
+		result = _wns_send(uri="https://db5.notify.windows.com/?token=one", data="<toast />")
+		self.assertEqual(result.uri, "https://db5.notify.windows.com/?token=one")
+		self.assertEqual(result.status, "received")
+		self.assertEqual(result.msg_id, "1ACE6E1D4D2B9BB5")
+		self.assertEqual(result.device_connection_status, "connected")
+		self.assertGreaterEqual(result.elapsed, 0)
+
+
 class WNSSendBulkMessageTestCase(TestCase):
 	def setUp(self):
 		pass
@@ -44,6 +72,73 @@ class WNSSendBulkMessageTestCase(TestCase):
 		)
 
 
+	@mock.patch("push_notifications.wns._wns_send")
+	def test_send_bulk_message_renders_template_per_uri(self, mock_method):
+		xml_data = {"toast": {"attrs": {"launch": "{launch}"}, "children": {"text": {"children": "Hi {name}"}}}}
+		wns_send_bulk_message(
+			uri_list=["one", "two"], xml_template=xml_data, contexts={
+				"one": {"launch": "id=1", "name": "Jane"},
+				"two": {"launch": "id=2&x=\"y\"", "name": "<Bob>"},
+			}
+		)
+		mock_method.assert_has_calls([
+			mock.call(uri="one", data=b'<toast launch="id=1"><text>Hi Jane</text></toast>', wns_type="wns/toast"),
+			mock.call(
+				uri="two", data=b'<toast launch="id=2&amp;x=&quot;y&quot;"><text>Hi &lt;Bob&gt;</text></toast>',
+				wns_type="wns/toast"
+			),
+		])
+
+
+	@mock.patch("push_notifications.wns.wns_send_message")
+	def test_send_bulk_message_aggregates_results(self, mock_method):
+		mock_method.side_effect = [
+			WNSResult("one", "received", "1", "connected", 0.25),
+			WNSResult("two", "dropped", None, "disconnected", 0.5),
+		]
+		result = wns_send_bulk_message(uri_list=["one", "two"], message="test message")
+		self.assertIsInstance(result, WNSBulkResult)
+		self.assertEqual(len(result), 2)
+		self.assertEqual(result.elapsed, 0.75)
+		self.assertEqual(result.statuses, {"received": 1, "dropped": 1})
+		self.assertEqual(result.device_connection_statuses, {"connected": 1, "disconnected": 1})
+		self.assertEqual(result.disconnected_uris, ["two"])
+
+
+	@mock.patch("push_notifications.wns.wns_send_message")
+	def test_send_bulk_message_on_error(self, mock_method):
+		error = WNSNotificationResponseError("HTTP 410: The channel expired.")
+		mock_method.side_effect = [WNSResult("one", "received", "1", "connected", 0.1), error]
+		on_error = mock.Mock()
+		result = wns_send_bulk_message(uri_list=["one", "two"], message="test message", on_error=on_error)
+		on_error.assert_called_once_with("two", error)
+		self.assertEqual(result.statuses, Counter({"received": 1, None: 1}))
+
+		mock_method.side_effect = [error]
+		with self.assertRaises(WNSNotificationResponseError):
+			wns_send_bulk_message(uri_list=["two"], message="test message")
+
+
+class WNSTemplateTestCase(TestCase):
+	def test_render(self):
+		template = WNSTemplate(b'<?xml version="1.0"?><badge value="{count}" extra="100%" />')
+		self.assertEqual(template.wns_type, "wns/badge")
+		self.assertEqual(template.placeholders, frozenset(["count"]))
+		self.assertEqual(
+			template.render({"count": 5}), b'<?xml version="1.0"?><badge value="5" extra="100%" />'
+		)
+
+	def test_render_non_ascii(self):
+		template = WNSTemplate({"toast": {"children": {"text": {"children": "{name} \u2603"}}}})
+		self.assertEqual(
+			template.render({"name": "\u00e9"}), "<toast><text>\u00e9 &#9731;</text></toast>".encode("utf-8")
+		)
+
+	def test_render_missing_placeholder(self):
+		with self.assertRaises(KeyError):
+			WNSTemplate("<toast>{name}</toast>").render({})
+
+
 class WNSDictToXmlSchemaTestCase(TestCase):
 	def setUp(self):
 		pass
@@ -158,3 +253,50 @@ class WNSDictToXmlSchemaTestCase(TestCase):
 		self.assertEqual(binding.attrib, {"template": "ToastText02"})
 		children = binding.getchildren()
 		self.assertEqual(len(children), 4)
+
+
+class WNSDictToXmlStringTestCase(TestCase):
+	def assertSameAsElementTree(self, xml_data):
+		self.assertEqual(dict_to_xml_string(xml_data), ET.tostring(dict_to_xml_schema(xml_data)))
+
+	def test_simple_xml_from_dict(self):
+		self.assertSameAsElementTree({
+			"toast": {
+				"attrs": {"launch": "param", "duration": "short"},
+				"children": {
+					"visual": {
+						"children": {
+							"binding": {
+								"attrs": {"template": "ToastText02"},
+								"children": {
+									"text": [
+										{"attrs": {"id": "1"}, "children": "first text"},
+										{"attrs": {"id": "2"}, "children": "second text"},
+									],
+									"image": [
+										{"attrs": {"src": "src1"}},
+										{"attrs": {"src": "src2"}},
+									]
+								}
+							}
+						}
+					}
+				}
+			}
+		})
+
+	def test_escaping(self):
+		self.assertSameAsElementTree({
+			"toast": {
+				"attrs": {"launch": "a=1&b=\"<2>\"\n"},
+				"children": {
+					"text": {"children": "Fish & <Chips> \u00e9\u2603"},
+				}
+			}
+		})
+
+	def test_empty_elements(self):
+		self.assertSameAsElementTree({"badge": {"attrs": {"value": "1"}}})
+		self.assertSameAsElementTree({"badge": {"children": {}}})
+		self.assertSameAsElementTree({"badge": {"children": "ignored at the root"}})
+		self.assertSameAsElementTree({"tile": {"children": {"visual": {"children": ""}, "empty": []}}})